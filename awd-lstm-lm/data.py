@@ -1,56 +1,230 @@
 import os
-import torch
+import json
+import hashlib
 
-from collections import Counter
+import numpy as np
+
+
+class WordTable(object):
+    """Read-only list of words, stored as a single string (the words, each followed by a newline) plus the offsets of the words."""
+    def __init__(self, table, offsets):
+        self.table = table
+        self.offsets = offsets  # len(self) + 1 offsets; the last one is len(table)
+
+    @classmethod
+    def fromlist(cls, words):
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum([len(word) + 1 for word in words], out=offsets[1:])
+        return cls(''.join(word + '\n' for word in words), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.table[self.offsets[idx]:self.offsets[idx + 1] - 1]
+
+    def __iter__(self):
+        return iter(self.table.split('\n')[:len(self)])
 
 
 class Dictionary(object):
+    # While the vocabulary is built (tokenization), the words are kept in the
+    # idx2word list and the word2idx dict. finalize() then sorts the ids by
+    # decreasing frequency, optionally truncates the vocabulary, and replaces
+    # idx2word by a compact WordTable; word2idx is only rebuilt if needed.
+    # counts[token_id] is the number of occurrences of each token (until
+    # finalize(), counts may have spare room at the end).
     def __init__(self):
-        self.word2idx = {}
         self.idx2word = []
-        self.counter = Counter()
-        self.total = 0
+        self._word2idx = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    @property
+    def word2idx(self):
+        if self._word2idx is None:
+            self._word2idx = {word: token_id for token_id, word in enumerate(self.idx2word)}
+        return self._word2idx
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
 
     def add_word(self, word):
         if word not in self.word2idx:
             self.idx2word.append(word)
             self.word2idx[word] = len(self.idx2word) - 1
         token_id = self.word2idx[word]
-        self.counter[token_id] += 1
-        self.total += 1
-        return self.word2idx[word]
+        self._growcounts(token_id + 1)
+        self.counts[token_id] += 1
+        return token_id
+
+    def add_counts(self, counts):
+        # Adds the counts (indexed by token id) of a whole token stream at once
+        self._growcounts(len(counts))
+        self.counts[:len(counts)] += counts
+
+    def _growcounts(self, size):
+        # Makes room for at least size counts (doubling, so that adding words one by one stays linear)
+        if size > len(self.counts):
+            counts = np.zeros(max(size, 2 * len(self.counts)), dtype=np.int64)
+            counts[:len(self.counts)] = self.counts
+            self.counts = counts
+
+    def finalize(self, freqs, mincount=0, maxvocab=0, unk='<unk>'):
+        """Sorts the ids by decreasing freqs (ties keep their order), and maps
+        the words with freqs < mincount, and all but the maxvocab most frequent
+        ones, to unk (added if needed). Returns the array that maps the old ids
+        to the new ones."""
+        words = list(self.idx2word)
+        freqs = np.asarray(freqs, dtype=np.int64)
+        counts = np.zeros(len(words), dtype=np.int64)  # self.counts may be shorter (words never counted) or longer (spare room)
+        counts[:min(len(words), len(self.counts))] = self.counts[:len(words)]
+        order = np.argsort(-freqs, kind='stable')
+        nkeep = int(np.sum(freqs >= mincount))
+        if maxvocab:
+            nkeep = min(nkeep, maxvocab)
+        if nkeep < len(words):
+            unkid = self.word2idx.get(unk)
+            if unkid is None:
+                unkid = len(words)
+                words.append(unk)
+                freqs, counts = np.append(freqs, 0), np.append(counts, 0)
+            kept = order[:nkeep]
+            kept = kept[kept != unkid][:(maxvocab - 1) if maxvocab else None]  # unk takes one of the maxvocab entries
+            dropped = np.ones(len(words), dtype=bool)
+            dropped[kept] = False
+            dropped[unkid] = False
+            freqs[unkid] += freqs[dropped].sum()
+            counts[unkid] += counts[dropped].sum()
+            order = np.append(kept, unkid)
+            order = order[np.argsort(-freqs[order], kind='stable')]
+        remap = np.empty(len(words), dtype=np.int64)
+        remap[order] = np.arange(len(order))
+        if len(order) < len(words):
+            remap[dropped] = remap[unkid]
+        self.counts = counts[order]
+        self.idx2word = WordTable.fromlist([words[token_id] for token_id in order])
+        self._word2idx = None
+        return remap
 
     def __len__(self):
         return len(self.idx2word)
 
 
+# The token streams of a Corpus (train, valid, test) are NumPy arrays of
+# token ids: uint16 if the vocabulary is small enough, int32 otherwise.
+# Token ids are sorted by decreasing frequency in the training set, so that
+# the buckets of splitcross.SplitCrossEntropyLoss are frequency buckets.
+# Corpus.save() writes the vocabulary and the streams into a cache directory
+# (one .npy file per stream), and Corpus.load() reopens them memory-mapped, so
+# that reloading a large corpus costs no tokenization and almost no memory.
+# utils.batchify() converts the streams to LongTensors.
+
+SPLITS = ('train', 'valid', 'test')
+CHUNKSIZE = 1 << 24  # Characters read at once by the tokenizer
+FORMAT = 2  # Version of the cache format (2: frequency-sorted ids)
+
+
 class Corpus(object):
-    def __init__(self, path):
+    def __init__(self, path=None, mincount=0, maxvocab=0):
+        # mincount, maxvocab: if > 0, words seen less than mincount times in the training set, and all but the
+        # maxvocab most frequent words, are replaced by <unk>
         self.dictionary = Dictionary()
-        self.train = self.tokenize(os.path.join(path, 'train.txt'))
-        self.valid = self.tokenize(os.path.join(path, 'valid.txt'))
-        self.test = self.tokenize(os.path.join(path, 'test.txt'))
+        if path is not None:
+            streams = [self.tokenize(os.path.join(path, split + '.txt')) for split in SPLITS]
+            remap = self.dictionary.finalize(np.bincount(streams[0], minlength=len(self.dictionary)), mincount, maxvocab)
+            for split, stream in zip(SPLITS, streams):
+                setattr(self, split, remap[stream].astype(streamdtype(len(self.dictionary))))
 
     def tokenize(self, path):
-        """Tokenizes a text file."""
+        """Tokenizes a text file, in a single streaming pass; returns the token ids in order of first occurrence, before finalize()."""
         assert os.path.exists(path)
-        # Add words to the dictionary
-        with open(path, 'r') as f:
-            tokens = 0
-            for line in f:
-                words = line.split() + ['<eos>']
-                tokens += len(words)
-                for word in words:
-                    self.dictionary.add_word(word)
-
-        # Tokenize file content
+        word2idx, idx2word = self.dictionary.word2idx, self.dictionary.idx2word
+        ids = np.empty(CHUNKSIZE // 4, dtype=np.int32)  # Grown by doubling
+        ntokens = 0
+        rest = ''
         with open(path, 'r') as f:
-            ids = torch.LongTensor(tokens)
-            token = 0
-            for line in f:
-                words = line.split() + ['<eos>']
-                for word in words:
-                    ids[token] = self.dictionary.word2idx[word]
-                    token += 1
-
+            while True:
+                chunk = f.read(CHUNKSIZE)
+                # Only complete lines are tokenized; the last, partial line is kept for the next chunk
+                lines = (rest + chunk).split('\n')
+                rest = lines.pop() if chunk else ''
+                if not chunk and lines == ['']:
+                    break
+                chunkids = []
+                for line in lines:
+                    words = line.split()
+                    words.append('<eos>')
+                    for word in words:
+                        token_id = word2idx.get(word)
+                        if token_id is None:
+                            token_id = word2idx[word] = len(idx2word)
+                            idx2word.append(word)
+                        chunkids.append(token_id)
+                if ntokens + len(chunkids) > len(ids):
+                    ids = np.resize(ids, max(2 * len(ids), ntokens + len(chunkids)))
+                ids[ntokens:ntokens + len(chunkids)] = chunkids
+                ntokens += len(chunkids)
+                if not chunk:
+                    break
+        ids = ids[:ntokens]
+        self.dictionary.add_counts(np.bincount(ids, minlength=len(idx2word)))
         return ids
+
+    def save(self, cachedir, settings=None):
+        """Writes the vocabulary and the token streams into cachedir (see Corpus.load)."""
+        os.makedirs(cachedir, exist_ok=True)
+        for split in SPLITS:
+            np.save(os.path.join(cachedir, split + '.npy'), getattr(self, split))
+        np.save(os.path.join(cachedir, 'counts.npy'), self.dictionary.counts)
+        np.save(os.path.join(cachedir, 'offsets.npy'), self.dictionary.idx2word.offsets)
+        with open(os.path.join(cachedir, 'vocab.txt'), 'w') as f:
+            f.write(self.dictionary.idx2word.table)
+        # Written last: a cache without index is incomplete, and is rebuilt
+        with open(os.path.join(cachedir, 'index.json'), 'w') as f:
+            json.dump(dict(settings or {}, vocabsize=len(self.dictionary)), f)
+
+    @classmethod
+    def load(cls, cachedir):
+        """Reopens a corpus saved by Corpus.save, with memory-mapped token streams."""
+        corpus = cls()
+        with open(os.path.join(cachedir, 'vocab.txt')) as f:
+            corpus.dictionary.idx2word = WordTable(f.read(), np.load(os.path.join(cachedir, 'offsets.npy')))
+        corpus.dictionary._word2idx = None
+        corpus.dictionary.counts = np.load(os.path.join(cachedir, 'counts.npy'))
+        for split in SPLITS:
+            setattr(corpus, split, np.load(os.path.join(cachedir, split + '.npy'), mmap_mode='r'))
+        return corpus
+
+
+def streamdtype(vocabsize):
+    # Smallest dtype that can hold all the token ids
+    return np.uint16 if vocabsize <= np.iinfo(np.uint16).max + 1 else np.int32
+
+
+def sources(path):
+    # Sizes and modification times of the text files of the corpus in path, to detect stale caches
+    return {split: [os.path.getsize(os.path.join(path, split + '.txt')), os.path.getmtime(os.path.join(path, split + '.txt'))] for split in SPLITS}
+
+
+def load_corpus(path, cachedir=None, mincount=0, maxvocab=0):
+    """Returns the corpus of the text files in path, from the cache in cachedir if it is up to date (otherwise, tokenizes the files and fills the cache)."""
+    if cachedir is None:
+        # Shared by all the scripts (main.py, test.py, finetune.py, pointer.py, generate.py)
+        cachedir = 'corpus.{}'.format(hashlib.md5(path.encode()).hexdigest())
+        if mincount or maxvocab:
+            cachedir += '.min{}.max{}'.format(mincount, maxvocab)
+    settings = {'format': FORMAT, 'sources': sources(path), 'mincount': mincount, 'maxvocab': maxvocab}
+    try:
+        with open(os.path.join(cachedir, 'index.json')) as f:
+            index = json.load(f)
+        uptodate = all(index.get(key) == value for key, value in settings.items())
+    except (IOError, ValueError):
+        uptodate = False
+    if uptodate:
+        print('Loading cached dataset...')
+        return Corpus.load(cachedir)
+    print('Producing dataset...')
+    corpus = Corpus(path, mincount, maxvocab)
+    corpus.save(cachedir, settings)
+    return corpus
@@ -17,6 +17,10 @@ parser = argparse.ArgumentParser(description='PyTorch PTB Language Model')
 # Model parameters.
 parser.add_argument('--data', type=str, default='./data/penn',
                     help='location of the data corpus')
+parser.add_argument('--mincount', type=int, default=0,
+                    help='replace the words seen less than this many times in the training set by <unk>')
+parser.add_argument('--maxvocab', type=int, default=0,
+                    help='if > 0, keep only this many words (the most frequent ones, including <unk>)')
 parser.add_argument('--model', type=str, default='LSTM',
                     help='type of recurrent net (LSTM, QRNN)')
 parser.add_argument('--checkpoint', type=str, default='./model.pt',
@@ -57,7 +61,7 @@ if args.cuda:
 else:
     model.cpu()
 
-corpus = data.Corpus(args.data)
+corpus = data.load_corpus(args.data, mincount=args.mincount, maxvocab=args.maxvocab)
 ntokens = len(corpus.dictionary)
 hidden = model.init_hidden(1)
 input = Variable(torch.rand(1, 1).mul(ntokens).long(), volatile=True)
@@ -0,0 +1,406 @@
+# Backpropamine: differentiable neuromdulated plasticity.
+#
+# Copyright (c) 2018-2019 Uber Technologies, Inc.
+#
+# Licensed under the Uber Non-Commercial License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at the root directory of this project.
+#
+# See the License file in this repository for the specific language governing
+# permissions and limitations under the License.
+
+
+# Fused update of Hebbian traces, shared by all the plastic networks.
+#
+# Every plastic network computes, at each time step, a batched outer product
+# of two activity vectors (deltahebb, BS x N x M), multiplies it by a
+# (possibly neuromodulated) plasticity rate eta, adds it to the Hebbian trace
+# and constrains the result. Written naively, each of these operations
+# allocates a new BS x N x M tensor, and autograd keeps most of them alive
+# until the end of the episode.
+#
+# hebbupdate() does the same computation with a single output buffer, and its
+# hand-written backward pass only saves the two activity vectors, eta and the
+# incoming/outgoing traces (which are kept alive by the rest of the graph
+# anyway). deltahebb itself is never stored.
+#
+# When no gradients are needed (evaluation, data collection), hebbupdate() and
+# clipadd() can also write the updated trace into an existing buffer (out=),
+# which may be the incoming trace itself: the trace is then updated in place,
+# without allocating anything of size BS x N x M (except for the 'softclip'
+# mode and for per-connection etas, which need one temporary).
+
+import torch
+
+
+# Possible values for 'mode':
+# 'add'      : hebb + eta * deltahebb (purely additive, no constraint; addpw=1, or cliptype 'aditya')
+# 'clip'     : clamp(hebb + eta * deltahebb, -clipval, clipval) (hard clip; addpw=3, or cliptype 'clip')
+# 'softclip' : hebb + relu(eta * deltahebb) * (1 - hebb) - relu(-eta * deltahebb) * (1 + hebb), then hard-clipped for safety (addpw=2)
+# 'decay'    : (1 - eta) * hebb + eta * deltahebb (exponential decay; addpw=0, or cliptype 'decay')
+MODES = ('add', 'clip', 'softclip', 'decay')
+
+
+def _eta3(eta):
+    # eta may be a single number (shape (1,)), one value per batch element
+    # (BS x 1 x 1), one value per row (BS x N x 1), one value per column
+    # (BS x 1 x M, as with 'fanout' neuromodulation) or one value per
+    # connection (N x M). We always manipulate it as a 3D tensor.
+    if eta.dim() > 3:
+        raise ValueError("eta must have at most 3 dimensions")
+    return eta.reshape((1,) * (3 - eta.dim()) + tuple(eta.shape))
+
+
+def _factors(x, y, eta3):
+    # Folds eta into the activity vectors whenever it is constant along rows
+    # or columns, so that eta * deltahebb can be computed by a single
+    # (batched) matrix product. Returns None for the second factor if eta
+    # varies along both dimensions and must be applied densely.
+    if eta3.size(2) == 1:
+        return (x * eta3[:, :, 0]).unsqueeze(2), y.unsqueeze(1)
+    if eta3.size(1) == 1:
+        return x.unsqueeze(2), (y * eta3[:, 0, :]).unsqueeze(1)
+    return x.unsqueeze(2), None
+
+
+def _delta(x, y, eta3):
+    # Computes eta * deltahebb, with deltahebb = x y^T (batched)
+    xf, yf = _factors(x, y, eta3)
+    if yf is None:
+        return torch.bmm(xf, y.unsqueeze(1)).mul_(eta3)
+    return torch.bmm(xf, yf)
+
+
+def _sumto(t, shape):
+    # Sums a BS x N x M gradient down to a broadcastable shape (the reverse of broadcasting)
+    for dim in range(3):
+        if shape[dim] == 1 and t.size(dim) != 1:
+            t = t.sum(dim, keepdim=True)
+    return t
+
+
+class HebbUpdate(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, hebb, x, y, eta, mode, clipval):
+        eta3 = _eta3(eta)
+        if mode == 'decay':
+            # (1 - eta) * hebb + eta * deltahebb, computed in the output buffer
+            out = hebb * (1 - eta3)
+            xf, yf = _factors(x, y, eta3)
+            if yf is None:
+                out.add_(_delta(x, y, eta3))
+            else:
+                out.baddbmm_(xf, yf)
+        elif mode == 'softclip':
+            # relu(d) * (1 - hebb) - relu(-d) * (1 + hebb) == d - |d| * hebb
+            delta = _delta(x, y, eta3)
+            out = hebb + delta
+            out.sub_(delta.abs_().mul_(hebb)).clamp_(min=-clipval, max=clipval)
+        elif mode in ('add', 'clip'):
+            xf, yf = _factors(x, y, eta3)
+            if yf is None:
+                out = hebb + _delta(x, y, eta3)
+            else:
+                out = torch.baddbmm(hebb, xf, yf)
+            if mode == 'clip':
+                out.clamp_(min=-clipval, max=clipval)
+        else:
+            raise ValueError("Unknown Hebbian update mode: " + str(mode))
+        ctx.mode, ctx.clipval = mode, clipval
+        # hebb is only needed by the soft clip and the decay; the output is
+        # only needed to know where the hard clip was active
+        ctx.save_for_backward(hebb if mode in ('softclip', 'decay') else None, x, y, eta,
+                out if mode in ('clip', 'softclip') else None)
+        return out
+
+    @staticmethod
+    def backward(ctx, gradout):
+        hebb, x, y, eta, out = ctx.saved_tensors
+        mode, clipval = ctx.mode, ctx.clipval
+        needhebb, needx, needy, needeta = ctx.needs_input_grad[:4]
+        eta3 = _eta3(eta)
+        gradhebb = gradx = grady = gradeta = None
+
+        # Gradient through the final clip, if any (the trace only receives
+        # gradient where it was not clipped)
+        if mode in ('clip', 'softclip'):
+            gradout = gradout * (out.abs() < clipval).type_as(gradout)
+
+        # graddelta is the gradient with respect to d = eta * deltahebb
+        if mode == 'softclip':
+            delta = _delta(x, y, eta3)
+            if needhebb:
+                gradhebb = gradout * (1 - delta.abs())
+            graddelta = gradout * (1 - hebb * torch.sign(delta))
+            del delta
+        else:
+            graddelta = gradout
+            if needhebb:
+                gradhebb = gradout * (1 - eta3) if mode == 'decay' else gradout
+
+        # Everything below only involves products of graddelta with the
+        # activity vectors; deltahebb is never reconstructed densely (except
+        # for the gradient of a per-connection eta).
+        rowvar, colvar = eta3.size(1) != 1, eta3.size(2) != 1
+        if rowvar and colvar:
+            gde = graddelta * eta3
+            if needx:
+                gradx = torch.bmm(gde, y.unsqueeze(2)).squeeze(2)
+            if needy:
+                grady = torch.bmm(x.unsqueeze(1), gde).squeeze(1)
+            if needeta:
+                gradeta = graddelta * torch.bmm(x.unsqueeze(2), y.unsqueeze(1))
+        elif colvar:
+            if needx:
+                gradx = torch.bmm(graddelta, (y * eta3[:, 0, :]).unsqueeze(2)).squeeze(2)
+            if needy or needeta:
+                gx = torch.bmm(x.unsqueeze(1), graddelta).squeeze(1)  # sum_i graddelta_ij x_i
+                if needy:
+                    grady = gx * eta3[:, 0, :]
+                if needeta:
+                    gradeta = (gx * y).unsqueeze(1)
+        else:
+            if needy:
+                grady = torch.bmm((x * eta3[:, :, 0]).unsqueeze(1), graddelta).squeeze(1)
+            if needx or needeta:
+                gy = torch.bmm(graddelta, y.unsqueeze(2)).squeeze(2)  # sum_j graddelta_ij y_j
+                if needx:
+                    gradx = gy * eta3[:, :, 0]
+                if needeta:
+                    gradeta = (gy * x).unsqueeze(2)
+
+        if needeta:
+            gradeta = _sumto(gradeta, eta3.shape)
+            if mode == 'decay':
+                gradeta = gradeta - _sumto(gradout * hebb, eta3.shape)
+            gradeta = gradeta.reshape(eta.shape)
+
+        return gradhebb, gradx, grady, gradeta, None, None
+
+
+def _checkout(out, *tensors):
+    # In-place updates are only possible when autograd doesn't need the old values
+    if torch.is_grad_enabled() and any(t.requires_grad for t in tensors if torch.is_tensor(t)):
+        raise RuntimeError("Hebbian traces can only be updated in place without gradients (use torch.no_grad())")
+
+
+def _hebbupdate_out(out, hebb, x, y, eta, mode, clipval):
+    # Same computation as HebbUpdate.forward, written into out (which may be hebb itself)
+    eta3 = _eta3(eta)
+    xf, yf = _factors(x, y, eta3)
+    if mode == 'decay':
+        torch.mul(hebb, 1 - eta3, out=out)
+        if yf is None:
+            out.add_(_delta(x, y, eta3))
+        else:
+            out.baddbmm_(xf, yf)
+    elif mode == 'softclip':
+        # hebb + d - |d| * hebb
+        delta = _delta(x, y, eta3)
+        if out is not hebb:
+            out.copy_(hebb)
+        out.addcmul_(out, delta.abs(), value=-1).add_(delta).clamp_(min=-clipval, max=clipval)
+    else:
+        if out is not hebb:
+            out.copy_(hebb)
+        if yf is None:
+            out.add_(_delta(x, y, eta3))
+        else:
+            out.baddbmm_(xf, yf)
+        if mode == 'clip':
+            out.clamp_(min=-clipval, max=clipval)
+    return out
+
+
+def hebbupdate(hebb, x, y, eta, mode='clip', clipval=1.0, out=None):
+    # Returns the updated Hebbian trace, i.e. hebb updated with eta * deltahebb
+    # (with deltahebb = x y^T, batched) according to 'mode' (see MODES above).
+    #
+    # hebb: BS x N x M (or a LowRankHebb, see below) ; x: BS x N (indexes rows of hebb) ; y: BS x M (indexes columns of hebb)
+    # eta: shape (1,), BS x 1 x 1, BS x N x 1, BS x 1 x M or N x M
+    # out: optional BS x N x M buffer (possibly hebb itself) that receives the result; only without gradients
+    if mode not in MODES:
+        raise ValueError("Unknown Hebbian update mode: " + str(mode))
+    if isinstance(hebb, LowRankHebb):
+        if (mode, float(clipval)) != (hebb.mode, hebb.clipval):
+            raise ValueError("Low-rank Hebbian trace was created for a different update mode")
+        return hebb.update(x, y, eta)
+    if not torch.is_tensor(eta):
+        eta = torch.full((1,), float(eta), dtype=hebb.dtype, device=hebb.device)
+    if out is not None:
+        _checkout(out, hebb, x, y, eta)
+        return _hebbupdate_out(out, hebb, x, y, eta, mode, float(clipval))
+    return HebbUpdate.apply(hebb, x.contiguous(), y.contiguous(), eta, mode, float(clipval))
+
+
+def clipadd(trace, eta, delta, clipval=1.0, out=None):
+    # Returns clamp(trace + eta * delta, -clipval, clipval), for a dense delta (e.g. the incorporation of an
+    # eligibility trace into plastic weights, with eta: BS x 1 x 1), optionally written into out (possibly trace itself)
+    if out is None:
+        return torch.clamp(trace + eta * delta, min=-clipval, max=clipval)
+    _checkout(out, trace, eta, delta)
+    if out is not trace:
+        out.copy_(trace)
+    return out.addcmul_(eta, delta).clamp_(min=-clipval, max=clipval)
+
+
+# Translates the 'addpw' parameter used by the maze and stimulus-response experiments into a mode
+ADDPWMODES = {0: 'decay', 1: 'add', 2: 'softclip', 3: 'clip'}
+
+# Translates the 'cliptype' parameter used by the plastic LSTMs into a mode
+# (with 'aditya', clipping only occurs when the trace is read, not when it is updated)
+CLIPTYPEMODES = {'decay': 'decay', 'clip': 'clip', 'aditya': 'add'}
+
+
+
+# Low-rank Hebbian traces.
+#
+# With the purely additive ('add') and hard-clipped ('clip') rules, as long as
+# the clip has never been reached, the Hebbian trace is just the sum of the
+# (rank-1) updates made so far:
+#     hebb = sum_k u_k v_k^T    (batched; u: BS x K x N, v: BS x K x M)
+# where u_k and v_k are the activity vectors of step k, with eta folded in.
+# For short episodes (K << HS), storing the factors takes O(K.HS) memory per
+# batch element instead of O(HS^2). The factors are written into buffers of
+# 'maxrank' rows allocated once by zeros(), at a write index (the rank).
+#
+# The plastic part of the recurrent product, (alpha * hebb) h, is computed
+# from the factors without ever building the BS x HS x HS trace. When alpha is
+# a scalar, or one value per row or per column (more generally, a rank-1
+# matrix a b^T), it is folded into the factors and the product costs O(K.HS).
+# A full alpha matrix cannot be folded: the product then costs O(K.HS^2) (one
+# GEMM), which only saves memory, not time, over dense traces.
+#
+# In 'clip' mode, we keep an upper bound on the magnitude of every element of
+# the trace (sum_k max|u_k| max|v_k|, for each batch element), on the device.
+# Whether it exceeds clipval (i.e. whether the clip might actually do
+# something, so that the trace would no longer be low-rank) is only read back
+# when the trace is next used, without stalling the device. Then, or when more
+# than 'maxrank' updates would be stored, the trace is converted to a normal
+# dense tensor and the network simply carries on with dense traces for the
+# rest of the episode.
+
+def _alphavectors(alpha, n, m):
+    # If alpha (broadcast to N x M) is a b^T, with a: N (or None) and b: M (or None), returns (a, b).
+    # Returns None for a full alpha matrix.
+    if not torch.is_tensor(alpha) or alpha.numel() == 1:
+        return alpha, None
+    shape = tuple(alpha.shape[-2:]) if alpha.dim() >= 2 else (1,) + tuple(alpha.shape)
+    if shape[0] == 1:
+        return None, alpha.reshape(m)
+    if shape[1] == 1:
+        return alpha.reshape(n), None
+    return None
+
+
+class LowRankHebb(object):
+
+    def __init__(self, u, v, rank, bound, maxrank, mode, clipval, overflow=None):
+        # u: BS x maxrank x N, v: BS x maxrank x M; only the first 'rank' factors are in use
+        if mode not in ('add', 'clip'):
+            raise ValueError("Low-rank Hebbian traces only support the 'add' and 'clip' modes")
+        self.u, self.v, self.k, self.bound = u, v, rank, bound
+        self.maxrank, self.mode, self.clipval = maxrank, mode, float(clipval)
+        self.overflow = overflow  # Pending clip check: (flag, event), see _settle()
+        self.clipped = None  # Dense trace, if the clip check failed
+
+    @staticmethod
+    def zeros(bs, n, m, maxrank, mode='clip', clipval=1.0, device=None, dtype=torch.float32):
+        # An all-zero trace (no factors yet), equivalent to torch.zeros(bs, n, m)
+        return LowRankHebb(torch.zeros(bs, maxrank, n, device=device, dtype=dtype), torch.zeros(bs, maxrank, m, device=device, dtype=dtype),
+                0, torch.zeros(bs, device=device, dtype=dtype), maxrank, mode, clipval)
+
+    def to(self, *args, **kwargs):
+        if self._settle() is not None:
+            return self.clipped.to(*args, **kwargs)
+        return LowRankHebb(self.u.to(*args, **kwargs), self.v.to(*args, **kwargs), self.k, self.bound.to(*args, **kwargs),
+                self.maxrank, self.mode, self.clipval)
+
+    def rank(self):
+        return self.k
+
+    def factors(self):
+        # The factors in use (BS x rank x N, BS x rank x M)
+        return self.u[:, :self.k], self.v[:, :self.k]
+
+    def _settle(self):
+        # Reads the result of the last clip check, if any; if the bound was exceeded, builds the actual
+        # (clipped) dense trace. Returns it, or None if the trace is still exactly low-rank.
+        if self.overflow is not None:
+            flag, event = self.overflow
+            self.overflow = None
+            if event is not None:
+                event.synchronize()  # Only waits for the check itself, not for the work queued after it
+            if bool(flag):
+                self.clipped = torch.clamp(self.dense(), min=-self.clipval, max=self.clipval)
+        return self.clipped
+
+    def dense(self):
+        # The equivalent BS x N x M trace (before clipping)
+        u, v = self.factors()
+        return torch.bmm(u.transpose(1, 2), v)
+
+    def mv(self, alpha, h):
+        # Returns (alpha * hebb) h, batched (BS x N), for h: BS x M and alpha: N x M (or broadcastable to it)
+        # (this is the plastic part of the recurrent input when the *rows* of hebb are the input weights of a neuron)
+        if self._settle() is not None:
+            return torch.bmm(alpha * self.clipped, h.unsqueeze(2)).squeeze(2)
+        u, v = self.factors()
+        ab = _alphavectors(alpha, u.size(2), v.size(2))
+        if ab is None:
+            # [(alpha * u_k v_k^T) h]_i = u_ki [alpha (v_k * h)]_i
+            return (u * torch.matmul(v * h.unsqueeze(1), alpha.t())).sum(1)
+        # (a b^T * u_k v_k^T) h = a * u_k (v_k . (b * h))
+        a, b = ab
+        out = torch.bmm(u.transpose(1, 2), torch.bmm(v, (h if b is None else h * b).unsqueeze(2))).squeeze(2)
+        return out if a is None else out * a
+
+    def vm(self, h, alpha):
+        # Returns h^T (alpha * hebb), batched (BS x M), for h: BS x N and alpha: N x M (or broadcastable to it)
+        # (this is the plastic part of the recurrent input when the *columns* of hebb are the input weights of a neuron)
+        if self._settle() is not None:
+            return torch.bmm(h.unsqueeze(1), alpha * self.clipped).squeeze(1)
+        u, v = self.factors()
+        ab = _alphavectors(alpha, u.size(2), v.size(2))
+        if ab is None:
+            # [h^T (alpha * u_k v_k^T)]_j = v_kj [(h * u_k)^T alpha]_j
+            return (v * torch.matmul(u * h.unsqueeze(1), alpha)).sum(1)
+        # h^T (a b^T * u_k v_k^T) = b * v_k ((a * h) . u_k)
+        a, b = ab
+        out = torch.bmm(v.transpose(1, 2), torch.bmm(u, (h if a is None else h * a).unsqueeze(2))).squeeze(2)
+        return out if b is None else out * b
+
+    def update(self, x, y, eta):
+        # Same as hebbupdate(dense trace, x, y, eta, self.mode, self.clipval), but returns a
+        # LowRankHebb as long as the result may be exactly low-rank (otherwise a dense tensor)
+        if self._settle() is not None:
+            return hebbupdate(self.clipped, x, y, eta, self.mode, self.clipval)
+        eta3 = _eta3(eta)
+        xf, yf = _factors(x, y, eta3)
+        if yf is None or self.k == self.maxrank:
+            # One eta per connection, or too many factors: go dense
+            return hebbupdate(self.dense(), x, y, eta, self.mode, self.clipval)
+        xf = xf.transpose(1, 2)
+        if torch.is_grad_enabled() and (xf.requires_grad or yf.requires_grad or self.u.requires_grad or self.v.requires_grad):
+            # Out of place (the previous buffers may be needed for the backward pass); autograd only records the index
+            index = torch.full((1,), self.k, dtype=torch.long, device=xf.device)
+            u, v = self.u.index_copy(1, index, xf.to(self.u.dtype)), self.v.index_copy(1, index, yf.to(self.v.dtype))
+        else:
+            u, v = self.u, self.v
+            u[:, self.k].copy_(xf[:, 0])
+            v[:, self.k].copy_(yf[:, 0])
+        overflow, bound = None, self.bound
+        if self.mode == 'clip':
+            bound = bound + (xf.detach().abs().max(2)[0] * yf.detach().abs().max(2)[0]).view(-1)
+            flag = (bound > self.clipval).any()
+            if flag.is_cuda:
+                # Read back asynchronously, when the trace is next used
+                hostflag = torch.empty((), dtype=torch.bool, pin_memory=True)
+                hostflag.copy_(flag, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+                overflow = (hostflag, event)
+            else:
+                overflow = (flag, None)
+        return LowRankHebb(u, v, self.k + 1, bound, self.maxrank, self.mode, self.clipval, overflow)
@@ -13,11 +13,15 @@ import pdb
 import data
 import model
 
-from utils import batchify, get_batch, repackage_hidden
+from utils import BPTTStream, repackage_hidden
 
 parser = argparse.ArgumentParser(description='PyTorch PennTreeBank RNN/LSTM Language Model')
 parser.add_argument('--data', type=str, default='data/penn/',
                     help='location of the data corpus')
+parser.add_argument('--mincount', type=int, default=0,
+                    help='replace the words seen less than this many times in the training set by <unk>')
+parser.add_argument('--maxvocab', type=int, default=0,
+                    help='if > 0, keep only this many words (the most frequent ones, including <unk>)')
 parser.add_argument('--model', type=str, default='PLASTICLSTM',
                     help='type of recurrent net (LSTM, QRNN, GRU, PLASTICLSTM, MYLSTM, FASTPLASTICLSTM, SIMPLEPLASTICLSTM)')
 parser.add_argument('--alphatype', type=str, default='full',
@@ -30,6 +34,8 @@ parser.add_argument('--cliptype', type=str, default='clip',
                     help="clip type (decay, clip, aditya)")
 parser.add_argument('--hebboutput', type=str, default='i2c',
                     help='output used for hebbian computations (i2c, h2co, cell, hidden)')
+parser.add_argument('--jit', action='store_true',
+                    help='for PLASTICLSTM, SIMPLEPLASTICLSTM and FASTPLASTICLSTM, run each layer over the whole sequence in a scripted loop (see mylstm.PlasticLSTMCell)')
 parser.add_argument('--emsize', type=int, default=400,
                     help='size of word embeddings')
 parser.add_argument('--nhid', type=int, default=1150,
@@ -120,21 +126,13 @@ def model_load(fn):
         model, criterion, optimizer = torch.load(f)
 
 import os
-import hashlib
-fn = 'corpus.{}.data'.format(hashlib.md5(args.data.encode()).hexdigest())
-if os.path.exists(fn):
-    print('Loading cached dataset...')
-    corpus = torch.load(fn)
-else:
-    print('Producing dataset...')
-    corpus = data.Corpus(args.data)
-    torch.save(corpus, fn)
+corpus = data.load_corpus(args.data, mincount=args.mincount, maxvocab=args.maxvocab)
 
 eval_batch_size = 10
 test_batch_size = 1
-train_data = batchify(corpus.train, args.batch_size, args)
-val_data = batchify(corpus.valid, eval_batch_size, args)
-test_data = batchify(corpus.test, test_batch_size, args)
+train_data = BPTTStream(corpus.train, args.batch_size, args)
+val_data = BPTTStream(corpus.valid, eval_batch_size, args)
+test_data = BPTTStream(corpus.test, test_batch_size, args)
 
 
 #train_data = train_data[:5000,:]   # For debugging
@@ -156,6 +154,7 @@ myparams['modultype'] = args.modultype
 myparams['modulout'] = args.modulout
 myparams['hebboutput'] = args.hebboutput
 myparams['alphatype'] = args.alphatype
+myparams['jit'] = args.jit
 
 suffix = '_SqUsq_'+args.model+'_'+myparams['cliptype']+'_cv'+str(myparams['clipval'])+'_'+myparams['modultype']+'_'+myparams['modulout']+'_'+myparams['hebboutput']+'_'+myparams['alphatype']+'_asgdtime'+str(args.asgdtime)+'_agdiv'+str(int(args.agdiv))+'_lr'+str(args.lr)+'_'+str(args.nlayers)+'l_'+str(args.nhid)+'h_'+str(args.proplstm)+'lstm_rngseed'+str(args.seed)
 print("Suffix:", suffix)
@@ -178,6 +177,7 @@ if args.resume:
             elif rnn.zoneout > 0: rnn.zoneout = args.wdrop
 ###
 if not criterion:
+    # Token ids are sorted by decreasing frequency (see data.py), so each split is a frequency bucket
     splits = []
     if ntokens > 500000:
         # One Billion
@@ -214,8 +214,7 @@ def evaluate(data_source, batch_size=10):
         total_loss = 0
         ntokens = len(corpus.dictionary)
         hidden = model.init_hidden(batch_size)
-        for i in range(0, data_source.size(0) - 1, args.bptt):
-            data, targets = get_batch(data_source, i, args, evaluation=True)
+        for data, targets in data_source.iterate(data_source.schedule(args.bptt)):
             output, hidden = model(data, hidden)
             total_loss += len(data) * criterion(model.decoder.weight, model.decoder.bias, output, targets).data
             hidden = repackage_hidden(hidden)
@@ -230,19 +229,14 @@ def train():
     start_time = time.time()
     ntokens = len(corpus.dictionary)
     hidden = model.init_hidden(args.batch_size)
-    batch, i = 0, 0
-    while i < train_data.size(0) - 1 - 1:
-        bptt = args.bptt if np.random.random() < 0.95 else args.bptt / 2.
-        # Prevent excessively small or negative sequence lengths
-        seq_len = max(5, int(np.random.normal(bptt, 5)))
-        # There's a very small chance that it could select a very long sequence length resulting in OOM
-        # NOTE: this was commented out in smerity's code!
-        seq_len = min(seq_len, args.bptt + 10)
+    # The random sequence lengths of the whole epoch are drawn up front
+    schedule = train_data.schedule(args.bptt, variable=True)
+    for batch, (data, targets) in enumerate(train_data.iterate(schedule)):
+        seq_len = len(data)
 
         lr2 = optimizer.param_groups[0]['lr']
         optimizer.param_groups[0]['lr'] = lr2 * seq_len / args.bptt
         model.train()
-        data, targets = get_batch(train_data, i, args, seq_len=seq_len)
 
         # Starting each batch, we detach the hidden state from how it was previously produced.
         # If we didn't, the model would try backpropagating all the way to start of the dataset.
@@ -284,13 +278,10 @@ def train():
             elapsed = time.time() - start_time
             print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:05.5f} | ms/batch {:5.2f} | '
                     'loss {:5.2f} | ppl {:8.2f} | bpc {:8.3f}'.format(
-                epoch, batch, len(train_data) // args.bptt, optimizer.param_groups[0]['lr'],
+                epoch, batch, len(schedule), optimizer.param_groups[0]['lr'],
                 elapsed * 1000 / args.log_interval, cur_loss, math.exp(cur_loss), cur_loss / math.log(2)))
             total_loss = 0
             start_time = time.time()
-        ###
-        batch += 1
-        i += seq_len
 
 # Loop over epochs.
 lr = args.lr
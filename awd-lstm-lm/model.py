@@ -10,6 +10,9 @@ import random, pdb
 
 import mylstm
 
+# Plastic LSTM layers that can be run over whole sequences by a scripted mylstm.PlasticLSTMCell (see RNNModel.scriptedcell())
+SCRIPTEDTYPES = ('PLASTICLSTM', 'SIMPLEPLASTICLSTM', 'FASTPLASTICLSTM')
+
 class RNNModel(nn.Module):
     """Container module with an encoder, a recurrent module, and a decoder."""
 
@@ -85,8 +88,26 @@ class RNNModel(nn.Module):
         self.dropouth = dropouth
         self.dropoute = dropoute
         self.tie_weights = tie_weights
+        # For the plastic LSTMs: process each layer's whole sequence through a scripted mylstm.PlasticLSTMCell (see scriptedcell())
+        self.jit = params.get('jit', 0)
+
+
 
+    def scriptedcell(self, l):
+        # Scripted version of layer l (SCRIPTEDTYPES only), sharing its parameters.
+        # Built on first use; cached outside of the module tree, so that it
+        # appears neither in the state_dict nor in pickled models.
+        # Rebuilt if the model has moved to another device or dtype since.
+        cells = self.__dict__.setdefault('_scriptedcells', {})
+        key = (l, self.rnns[l].alpha.device, self.rnns[l].alpha.dtype)
+        if key not in cells:
+            cells[key] = torch.jit.script(mylstm.PlasticLSTMCell(self.rnns[l]))
+        return cells[key]
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_scriptedcells', None)
+        return state
 
     def reset(self):
         if self.rnn_type == 'QRNN': [r.reset() for r in self.rnns]
@@ -115,6 +136,9 @@ class RNNModel(nn.Module):
             # new_h is a tuple of 2 elements, each of size 1 x batch_size x nb_hidden (last h and last c)
             if self.rnn_type != 'MYLSTM' and self.rnn_type != 'MYFASTLSTM' and self.rnn_type != 'SIMPLEPLASTICLSTM' and self.rnn_type != 'PLASTICLSTM' and self.rnn_type != 'FASTPLASTICLSTM' and self.rnn_type != 'SPLITLSTM':
                 raw_output, new_h = rnn(raw_output, hidden[l])
+            elif self.rnn_type in SCRIPTEDTYPES and getattr(self, 'jit', 0):
+                # Input projections of the whole sequence in one matrix multiplication, recurrence in a scripted loop
+                raw_output, new_h = self.scriptedcell(l).scan(raw_output, tuple(hidden[l]))
             else:
                 single_h = hidden[l]  # actually a tuple, includes the h and the c (and for plastic LTMS, includes Hebb as third element!)
                 singleouts = []
@@ -9,6 +9,8 @@
 
 
 
+from typing import List, Tuple
+
 import torch
 from torch import nn
 from torch.autograd import Variable
@@ -18,6 +20,8 @@ import numpy as np
 
 import pdb
 
+import hebbtrace  # Fused Hebbian trace updates
+
 
 
 # SimplePlasticLSTM is a full-fledged implementation of Plastic LSTMs that uses
@@ -90,7 +94,7 @@ class SimplePlasticLSTM(nn.Module):
         # the same neuromodulation to all the inputs to a given cell, while letting neuromodulation differ from 
         # cell to cell, as required for the fanout concept.
         
-        myeta = self.modfanout(myeta).squeeze().unsqueeze(1)              
+        myeta = self.modfanout(myeta)  # BatchSize x 1 x NHidden (also with BatchSize = 1)              
 
         hebb = torch.clamp(hebb + myeta * deltahebb, min=-2.0, max=2.0)
 
@@ -213,14 +217,15 @@ class PlasticLSTM(nn.Module):
         # Now we need to compute the updates to the Hebbian traces, including any neuromodulation.
 
         # For the Hebbian computation, what counts as "output"?
+        # deltahebb is the batched outer product of hidden[0] with this output (computed within hebbtrace.hebbupdate below)
         if self.hebboutput == 'i2c':
-            deltahebb = torch.bmm(hidden[0].unsqueeze(2), inputstocell.unsqueeze(1))
+            hebbout = inputstocell
         elif self.hebboutput == 'h2co': 
-            deltahebb = torch.bmm(hidden[0].unsqueeze(2), h2coutput.unsqueeze(1))
+            hebbout = h2coutput
         elif self.hebboutput == 'cell': 
-            deltahebb = torch.bmm(hidden[0].unsqueeze(2), cell.unsqueeze(1))
+            hebbout = cell
         elif self.hebboutput == 'hidden': 
-            deltahebb = torch.bmm(hidden[0].unsqueeze(2), hactiv.unsqueeze(1)) 
+            hebbout = hactiv
         else: 
             raise ValueError("Must choose Hebbian target output")
 
@@ -244,17 +249,15 @@ class PlasticLSTM(nn.Module):
             # the same neuromodulation to all the inputs to a given cell, while letting neuromodulation differ from 
             # cell to cell, as required for the fanout concept.
             
-            myeta = self.modfanout(myeta).squeeze().unsqueeze(1)              
+            myeta = self.modfanout(myeta)  # BatchSize x 1 x NHidden (also with BatchSize = 1)              
 
         # Various possible ways to clip the Hebbian trace 
-        if self.cliptype == 'decay':    # Exponential decay
-            hebb = (1 - myeta) * hebb + myeta * deltahebb
-        elif self.cliptype == 'clip':   # Just a hard clip
-            hebb = torch.clamp(hebb + myeta * deltahebb, min=-self.clipval, max=self.clipval)
-        elif self.cliptype == 'aditya': # For this one, the clipping only occurs a posteriori (see above); hebb itself can grow arbitrarily
-            hebb = hebb + myeta * deltahebb   
-        else: 
+        # 'decay': exponential decay, hebb = (1 - myeta) * hebb + myeta * deltahebb
+        # 'clip': just a hard clip, hebb = torch.clamp(hebb + myeta * deltahebb, min=-self.clipval, max=self.clipval)
+        # 'aditya': the clipping only occurs a posteriori (see above); hebb itself can grow arbitrarily, hebb = hebb + myeta * deltahebb
+        if self.cliptype not in hebbtrace.CLIPTYPEMODES:
             raise ValueError("Must choose clip type")
+        hebb = hebbtrace.hebbupdate(hebb, hidden[0], hebbout, myeta, hebbtrace.CLIPTYPEMODES[self.cliptype], self.clipval)
 
 
         # Note that "hactiv" (i.e. the new h-state) is duplicated in the return
@@ -268,6 +271,149 @@ class PlasticLSTM(nn.Module):
 
 
 
+# PlasticLSTMCell computes exactly the same thing as a given PlasticLSTM,
+# SimplePlasticLSTM or MyFastPlasticLSTM, with which it shares all its
+# parameters, but the configuration (cliptype, modultype, hebboutput,
+# modulout) is resolved once at construction into TorchScript constants, so
+# that it can be compiled with torch.jit.script. The weights are grouped as in
+# MyFastPlasticLSTM: x to (f, i, o, c), and h to (f, i, o, c), where the
+# h-to-c block is w (transposed) for the PlasticLSTMs.
+# scan() processes a whole sequence (seq_len x batch_size x isize) at once:
+# the input projections of all the time steps are computed by a single
+# (seq_len * batch_size) x 4hsize matrix multiplication, and only the
+# recurrence runs in the scripted loop, writing each output into a
+# preallocated seq_len x batch_size x hsize buffer. This removes the per-token
+# Python overhead of the loop in model.py. The Hebbian update uses plain tensor
+# operations here, since the fused update of hebbtrace.py cannot be scripted.
+
+class PlasticLSTMCell(nn.Module):
+
+    __constants__ = ['cliptype', 'modultype', 'hebboutput', 'fanout', 'clipval', 'tanhclip', 'hasw', 'hsize']
+
+    xweights: List[torch.Tensor]
+    xbiases: List[torch.Tensor]
+    hweights: List[torch.Tensor]
+    hbiases: List[torch.Tensor]
+
+    def __init__(self, lstm):
+        super(PlasticLSTMCell, self).__init__()
+        cliptypes = {'decay': 0, 'clip': 1, 'aditya': 2}
+        modultypes = {'none': 0, 'modplasth2mod': 1, 'modplastc2mod': 2}
+        hebboutputs = {'i2c': 0, 'h2co': 1, 'cell': 2, 'hidden': 3}
+        # SimplePlasticLSTM has no configuration: it uses the defaults of PlasticLSTM
+        cliptype, modultype = getattr(lstm, 'cliptype', 'clip'), getattr(lstm, 'modultype', 'modplasth2mod')
+        hebboutput, modulout = getattr(lstm, 'hebboutput', 'i2c'), getattr(lstm, 'modulout', 'fanout')
+        if isinstance(lstm, MyFastPlasticLSTM):
+            hebboutput = 'i2c'  # MyFastPlasticLSTM ignores 'hebboutput'
+        if cliptype not in cliptypes:
+            raise ValueError("Must choose clip type")
+        if modultype not in modultypes:
+            raise ValueError("Must choose modulation type")
+        if hebboutput not in hebboutputs:
+            raise ValueError("Must choose Hebbian target output")
+        self.cliptype = cliptypes[cliptype]
+        self.modultype = modultypes[modultype]
+        self.hebboutput = hebboutputs[hebboutput]
+        self.fanout = modultype != 'none' and modulout == 'fanout'
+        self.clipval = float(getattr(lstm, 'clipval', 2.0))
+        self.hsize = lstm.hsize
+
+        # Parameters that this configuration doesn't use are replaced by (unused) placeholders
+        placeholder = torch.zeros(1, device=lstm.alpha.device, dtype=lstm.alpha.dtype)
+        self.alpha = lstm.alpha
+        if isinstance(lstm, MyFastPlasticLSTM):
+            self.xweights, self.xbiases = [lstm.x2f_i_opt_c.weight], [lstm.x2f_i_opt_c.bias]
+            self.hweights, self.hbiases = [lstm.h2f_i_opt_c.weight], [lstm.h2f_i_opt_c.bias]
+            self.w, self.hasw = placeholder, False
+            self.tanhclip = True  # With 'aditya', MyFastPlasticLSTM reads clipval * tanh(hebb) rather than the clipped hebb
+        else:
+            self.xweights = [lstm.x2f.weight, lstm.x2i.weight, lstm.x2opt.weight, lstm.x2c.weight]
+            self.xbiases = [lstm.x2f.bias, lstm.x2i.bias, lstm.x2opt.bias, lstm.x2c.bias]
+            self.hweights = [lstm.h2f.weight, lstm.h2i.weight, lstm.h2opt.weight]  # w is appended by weights()
+            self.hbiases = [lstm.h2f.bias, lstm.h2i.bias, lstm.h2opt.bias]  # w has no bias: zeros are appended by weights()
+            self.w, self.hasw = lstm.w, True
+            self.tanhclip = False
+        self.eta = lstm.eta if self.modultype == 0 else placeholder
+        self.h2modw = lstm.h2mod.weight if self.modultype != 0 else placeholder
+        self.h2modb = lstm.h2mod.bias if self.modultype != 0 else placeholder
+        self.modfanoutw = lstm.modfanout.weight if self.fanout else placeholder
+        self.modfanoutb = lstm.modfanout.bias if self.fanout else placeholder
+
+    def weights(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        # The grouped weights and biases from x and from h (4hsize x isize, 4hsize, 4hsize x hsize, 4hsize)
+        hweights, hbiases = self.hweights, self.hbiases
+        if self.hasw:
+            # Each *column* of w contains the inputs to a single cell, i.e. each row of its transpose
+            hweights = hweights + [self.w.t()]
+            hbiases = hbiases + [torch.zeros_like(hbiases[0])]
+        return torch.cat(self.xweights, 0), torch.cat(self.xbiases, 0), torch.cat(hweights, 0), torch.cat(hbiases, 0)
+
+    def step(self, xproj, hidden: Tuple[torch.Tensor, torch.Tensor, torch.Tensor], hw, hb) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        # One time step, from the input projections xproj (batch_size x 4hsize) and the grouped weights from h
+        hsize = self.hsize
+        hebb = hidden[2]
+        hproj = F.linear(hidden[0], hw, hb)
+        gates = torch.sigmoid(xproj[:, :3*hsize] + hproj[:, :3*hsize])
+        fgt, ipt, opt = gates[:, :hsize], gates[:, hsize:2*hsize], gates[:, 2*hsize:]
+
+        if self.cliptype == 2:
+            if self.tanhclip:
+                readhebb = self.clipval * torch.tanh(hebb)
+            else:
+                readhebb = torch.clamp(hebb, min=-self.clipval, max=self.clipval)
+        else:
+            readhebb = hebb
+        h2coutput = hproj[:, 3*hsize:] + hidden[0].unsqueeze(1).bmm(torch.mul(self.alpha, readhebb)).squeeze(1)
+        inputstocell = torch.tanh(xproj[:, 3*hsize:] + h2coutput)
+        cell = torch.mul(fgt, hidden[1]) + torch.mul(ipt, inputstocell)
+        hactiv = torch.mul(opt, torch.tanh(cell))
+
+        if self.hebboutput == 0:
+            hebbout = inputstocell
+        elif self.hebboutput == 1:
+            hebbout = h2coutput
+        elif self.hebboutput == 2:
+            hebbout = cell
+        else:
+            hebbout = hactiv
+
+        if self.modultype == 0:
+            myeta = self.eta
+        elif self.modultype == 1:
+            myeta = torch.tanh(F.linear(hactiv, self.h2modw, self.h2modb)).unsqueeze(2)
+        else:
+            myeta = torch.tanh(F.linear(cell, self.h2modw, self.h2modb)).unsqueeze(2)
+        if self.fanout:
+            myeta = F.linear(myeta, self.modfanoutw, self.modfanoutb)  # BatchSize x 1 x NHidden
+
+        deltahebb = torch.bmm(hidden[0].unsqueeze(2), hebbout.unsqueeze(1))
+        if self.cliptype == 0:
+            hebb = (1 - myeta) * hebb + myeta * deltahebb
+        elif self.cliptype == 1:
+            hebb = torch.clamp(hebb + myeta * deltahebb, min=-self.clipval, max=self.clipval)
+        else:
+            hebb = hebb + myeta * deltahebb
+
+        return hactiv, (hactiv, cell, hebb)
+
+    def forward(self, inputs, hidden: Tuple[torch.Tensor, torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        xw, xb, hw, hb = self.weights()
+        return self.step(F.linear(inputs, xw, xb), hidden, hw, hb)
+
+    @torch.jit.export
+    def scan(self, inputs, hidden: Tuple[torch.Tensor, torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        # Runs the cell over a whole sequence; returns the outputs (seq_len x batch_size x hsize) and the last (h, c, hebb)
+        seqlen, bsz = inputs.size(0), inputs.size(1)
+        xw, xb, hw, hb = self.weights()
+        xprojs = F.linear(inputs.reshape(seqlen * bsz, inputs.size(2)), xw, xb).view(seqlen, bsz, 4 * self.hsize)
+        outputs = torch.empty([seqlen, bsz, self.hsize], dtype=inputs.dtype, device=inputs.device)
+        for z in range(seqlen):
+            output, hidden = self.step(xprojs[z], hidden, hw, hb)
+            outputs[z] = output
+        return outputs, hidden
+
+
+
 # This is a slightly faster implementation of Plastic Lstms: cut time by ~30%  by grouping all matrix multiplications into two. Not fully debugged, use at own risk.
 class MyFastPlasticLSTM(nn.Module):
     def __init__(self, isize, hsize, params):
@@ -352,7 +498,7 @@ class MyFastPlasticLSTM(nn.Module):
 
 
         #if self.hebboutput == 'i2c':
-        deltahebb = torch.bmm(hidden[0].unsqueeze(2), inputtoc.unsqueeze(1))
+        # deltahebb is the batched outer product of hidden[0] and inputtoc (computed within hebbtrace.hebbupdate below)
         if self.modultype == 'none':
             myeta = self.eta
         elif self.modultype == 'modplasth2mod':
@@ -368,16 +514,11 @@ class MyFastPlasticLSTM(nn.Module):
             # The output of the following line has shape BatchSize x 1 x NHidden, i.e. 1 line and NHidden columns for each 
             # batch element. When multiplying by hebb (BatchSize x NHidden x NHidden), broadcasting will provide a different
             # value of myeta for each cell but the same value for all inputs of a cell, as required by fanout concept.
-             myeta = self.modfanout(myeta).squeeze().unsqueeze(1)              
+             myeta = self.modfanout(myeta)  # BatchSize x 1 x NHidden (also with BatchSize = 1)              
 
-        if self.cliptype == 'decay':
-            hebb = (1 - myeta) * hebb + myeta * deltahebb
-        elif self.cliptype == 'clip':
-            hebb = torch.clamp(hebb + myeta * deltahebb, min=-self.clipval, max=self.clipval)
-        elif self.cliptype == 'aditya' :
-            hebb = hebb + myeta * deltahebb   
-        else: 
+        if self.cliptype not in hebbtrace.CLIPTYPEMODES:
             raise ValueError("Must choose clip type")
+        hebb = hebbtrace.hebbupdate(hebb, hidden[0], inputtoc, myeta, hebbtrace.CLIPTYPEMODES[self.cliptype], self.clipval)
 
         hidden = (hactiv, cell, hebb)
         activout = hactiv 
@@ -470,3 +611,34 @@ class MyFastLSTM(nn.Module):
         return activout, hidden #, hebb, et, pw
 
 
+
+if __name__ == '__main__':
+    # Checks that the scripted PlasticLSTMCell computes the same outputs, Hebbian traces and gradients as the eager
+    # plastic LSTMs (including with batch size 1, where the neuromodulation must still broadcast per batch element)
+    torch.manual_seed(0)
+    ISIZE, HSIZE, SEQLEN = 5, 7, 4
+    params = {'cliptype': 'clip', 'modultype': 'modplasth2mod', 'modulout': 'fanout', 'hebboutput': 'i2c', 'clipval': 2.0, 'alphatype': 'perneuron'}
+    for lstmtype in (PlasticLSTM, SimplePlasticLSTM, MyFastPlasticLSTM):
+        for bsz in (1, 3):
+            lstm = lstmtype(ISIZE, HSIZE, params)
+            with torch.no_grad():
+                lstm.alpha.fill_(.5)  # Large enough for the traces to matter
+            cell = torch.jit.script(PlasticLSTMCell(lstm))
+            inputs = torch.randn(SEQLEN, bsz, ISIZE)
+            results = []
+            for scripted in (False, True):
+                lstm.zero_grad()
+                hidden = (torch.zeros(bsz, HSIZE), torch.zeros(bsz, HSIZE), torch.zeros(bsz, HSIZE, HSIZE))
+                if scripted:
+                    outputs, hidden = cell.scan(inputs, hidden)
+                else:
+                    outputs = []
+                    for z in range(SEQLEN):
+                        output, hidden = lstm(inputs[z], hidden)
+                        outputs.append(output)
+                    outputs = torch.stack(outputs)
+                (outputs.sum() + hidden[2].sum()).backward()
+                results.append([outputs, hidden[2]] + [p.grad.clone() for p in lstm.parameters()])
+            maxdiff = max(float((a - b).abs().max()) for a, b in zip(*results))
+            print(lstmtype.__name__, 'batch size', bsz, 'max. difference', maxdiff)
+            assert maxdiff < 1e-4
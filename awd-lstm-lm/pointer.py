@@ -4,22 +4,28 @@ import math
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
+import torch.nn.functional as F
 
 import data
 import model
 
-from utils import batchify, get_batch, repackage_hidden
+from utils import BPTTStream, repackage_hidden
 
 parser = argparse.ArgumentParser(description='PyTorch PennTreeBank RNN/LSTM Language Model')
 parser.add_argument('--data', type=str, default='data/penn',
                     help='location of the data corpus')
+parser.add_argument('--mincount', type=int, default=0,
+                    help='replace the words seen less than this many times in the training set by <unk>')
+parser.add_argument('--maxvocab', type=int, default=0,
+                    help='if > 0, keep only this many words (the most frequent ones, including <unk>)')
 parser.add_argument('--model', type=str, default='LSTM',
                     help='type of recurrent net (LSTM, QRNN)')
 parser.add_argument('--save', type=str,default='best.pt',
                     help='model to use the pointer over')
 parser.add_argument('--cuda', action='store_false',
                     help='use CUDA')
+parser.add_argument('--numgpu', type=int, default=0,
+                    help='which GPU to use? (no effect if GPU not used at all)')
 parser.add_argument('--bptt', type=int, default=5000,
                     help='sequence length')
 parser.add_argument('--window', type=int, default=3785,
@@ -34,90 +40,78 @@ args = parser.parse_args()
 # Load data
 ###############################################################################
 
-corpus = data.Corpus(args.data)
+corpus = data.load_corpus(args.data, mincount=args.mincount, maxvocab=args.maxvocab)
 
 eval_batch_size = 1
 test_batch_size = 1
-#train_data = batchify(corpus.train, args.batch_size)
-val_data = batchify(corpus.valid, test_batch_size, args)
-test_data = batchify(corpus.test, test_batch_size, args)
+val_data = BPTTStream(corpus.valid, test_batch_size, args)
+test_data = BPTTStream(corpus.test, test_batch_size, args)
 
 ###############################################################################
 # Build the model
 ###############################################################################
 
 ntokens = len(corpus.dictionary)
-criterion = nn.CrossEntropyLoss()
-
-def one_hot(idx, size, cuda=True):
-    a = np.zeros((1, size), np.float32)
-    a[0][idx] = 1
-    v = Variable(torch.from_numpy(a))
-    if cuda: v = v.cuda()
-    return v
 
 def evaluate(data_source, batch_size=10, window=args.window):
-    # Turn on evaluation mode which disables dropout.
+    # Pointer sentinel cache: the vocabulary distribution of the model is mixed
+    # with an attention over the last 'window' positions, each of which points
+    # to the word that followed it. The history is a ring buffer of these
+    # words (ids) and of the last-layer hidden states; for each BPTT chunk,
+    # the attentions of all positions over their windows are computed at once,
+    # from the history followed by the chunk itself (position t of the chunk
+    # attends to positions t to t + window - 1 of this sequence). Only the
+    # probabilities of the targets are computed, so that memory is
+    # O(window * nhid) rather than O(window * ntokens).
     if args.model == 'QRNN': model.reset()
     model.eval()
     total_loss = 0
-    ntokens = len(corpus.dictionary)
     hidden = model.init_hidden(batch_size)
-    next_word_history = None
-    pointer_history = None
-    for i in range(0, data_source.size(0) - 1, args.bptt):
-        if i > 0: print(i, len(data_source), math.exp(total_loss / i))
-        data, targets = get_batch(data_source, i, evaluation=True, args=args)
-        output, hidden, rnn_outs, _ = model(data, hidden, return_h=True)
-        rnn_out = rnn_outs[-1].squeeze()
-        output_flat = output.view(-1, ntokens)
-        ###
-        # Fill pointer history
-        start_idx = len(next_word_history) if next_word_history is not None else 0
-        next_word_history = torch.cat([one_hot(t.data[0], ntokens) for t in targets]) if next_word_history is None else torch.cat([next_word_history, torch.cat([one_hot(t.data[0], ntokens) for t in targets])])
-        #print(next_word_history)
-        pointer_history = Variable(rnn_out.data) if pointer_history is None else torch.cat([pointer_history, Variable(rnn_out.data)], dim=0)
-        #print(pointer_history)
-        ###
-        # Built-in cross entropy
-        # total_loss += len(data) * criterion(output_flat, targets).data[0]
-        ###
-        # Manual cross entropy
-        # softmax_output_flat = torch.nn.functional.softmax(output_flat)
-        # soft = torch.gather(softmax_output_flat, dim=1, index=targets.view(-1, 1))
-        # entropy = -torch.log(soft)
-        # total_loss += len(data) * entropy.mean().data[0]
-        ###
-        # Pointer manual cross entropy
-        loss = 0
-        softmax_output_flat = torch.nn.functional.softmax(output_flat)
-        for idx, vocab_loss in enumerate(softmax_output_flat):
-            p = vocab_loss
-            if start_idx + idx > window:
-                valid_next_word = next_word_history[start_idx + idx - window:start_idx + idx]
-                valid_pointer_history = pointer_history[start_idx + idx - window:start_idx + idx]
-                logits = torch.mv(valid_pointer_history, rnn_out[idx])
-                theta = args.theta
-                ptr_attn = torch.nn.functional.softmax(theta * logits).view(-1, 1)
-                ptr_dist = (ptr_attn.expand_as(valid_next_word) * valid_next_word).sum(0).squeeze()
-                lambdah = args.lambdasm
-                p = lambdah * ptr_dist + (1 - lambdah) * vocab_loss
-            ###
-            target_loss = p[targets[idx].data]
-            loss += (-torch.log(target_loss)).data[0]
-        total_loss += loss / batch_size
-        ###
-        hidden = repackage_hidden(hidden)
-        next_word_history = next_word_history[-window:]
-        pointer_history = pointer_history[-window:]
+    histids, histouts = None, None
+    nbseen = 0  # Number of positions seen so far
+    with torch.no_grad():
+        for data, targets in data_source.iterate(data_source.schedule(args.bptt)):
+            if nbseen > 0: print(nbseen, len(data_source), math.exp(total_loss / nbseen))
+            output, hidden, rnn_outs, _ = model(data, hidden, return_h=True)
+            rnn_out = rnn_outs[-1]  # seq_len x batch_size x nhid
+            seq_len = len(data)
+            targets = targets.view(seq_len, batch_size)
+            vocab_p = criterion.target_logprob(model.decoder.weight, model.decoder.bias, output, targets.view(-1)).exp().view(seq_len, batch_size)
+            if histids is None:
+                histids = targets.new_zeros(window, batch_size)
+                histouts = rnn_out.new_zeros(window, batch_size, rnn_out.size(2))
+
+            # History (oldest first; the ring slot of position n is n % window), followed by the chunk
+            order = (torch.arange(window, device=targets.device) + nbseen) % window
+            allids = torch.cat([histids[order], targets])
+            allouts = torch.cat([histouts[order], rnn_out])
+            logits = torch.bmm(rnn_out.transpose(0, 1), allouts.permute(1, 2, 0))  # batch_size x seq_len x (window + seq_len)
+            steps = torch.arange(seq_len, device=targets.device).view(-1, 1)
+            cols = torch.arange(window + seq_len, device=targets.device).view(1, -1)
+            outside = (cols < steps) | (cols >= steps + window)
+            ptr_attn = F.softmax(args.theta * logits.masked_fill(outside, float('-inf')), dim=2)
+            # Pointer mass of each target: the attention on the positions of the window that were followed by the target
+            ptr_p = (ptr_attn * (allids.t().unsqueeze(1) == targets.t().unsqueeze(2)).type_as(ptr_attn)).sum(2).t()
+            # The pointer is only used once a full window of history is available
+            usepointer = steps + nbseen > window
+            p = torch.where(usepointer, args.lambdasm * ptr_p + (1 - args.lambdasm) * vocab_p, vocab_p)
+            total_loss += float(-torch.log(p).sum()) / batch_size
+
+            # Updating the ring buffer with the last (at most 'window') positions of the chunk
+            nbnew = min(seq_len, window)
+            slots = torch.arange(nbseen + seq_len - nbnew, nbseen + seq_len, device=targets.device) % window
+            histids[slots] = targets[seq_len - nbnew:]
+            histouts[slots] = rnn_out[seq_len - nbnew:]
+            nbseen += seq_len
+            hidden = repackage_hidden(hidden)
     return total_loss / len(data_source)
 
-# Load the best saved model.
+# Load the best saved model (saved by main.py, with its criterion and optimizer).
 with open(args.save, 'rb') as f:
     if not args.cuda:
-        model = torch.load(f, map_location=lambda storage, loc: storage)
+        model, criterion, _ = torch.load(f, map_location=lambda storage, loc: storage)
     else:
-        model = torch.load(f)
+        model, criterion, _ = torch.load(f, map_location=torch.device('cuda', args.numgpu))
 print(model)
 
 # Run on val data.
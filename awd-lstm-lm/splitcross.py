@@ -69,6 +69,30 @@ class SplitCrossEntropyLoss(nn.Module):
             return torch.cat(results, dim=1)
         return results[0]
 
+    def target_logprob(self, weight, bias, hiddens, targets):
+        # Log-probability of each target (one per row of hiddens), computing the tail softmaxes only for the rows whose target is in that tail
+        if len(hiddens.size()) > 2: hiddens = hiddens.view(-1, hiddens.size(2))
+        head_weight, head_bias = weight[self.splits[0]:self.splits[1]], bias[self.splits[0]:self.splits[1]]
+        if self.nsplits > 1:
+            head_weight = torch.cat([head_weight, self.tail_vectors])
+            head_bias = torch.cat([head_bias, self.tail_bias])
+        softmaxed_head_res = torch.nn.functional.log_softmax(torch.nn.functional.linear(hiddens, head_weight, bias=head_bias), dim=-1)
+
+        # Split of each target (as in split_on_targets)
+        mask = torch.zeros_like(targets)
+        for idx in range(1, self.nsplits):
+            mask += (targets >= self.splits[idx]).long()
+        result = torch.gather(softmaxed_head_res, dim=1, index=torch.clamp(targets, max=self.splits[1] - 1).view(-1, 1)).squeeze(1)
+        for idx in range(1, self.nsplits):
+            rows = (mask == idx).nonzero().view(-1)
+            if len(rows) == 0: continue
+            start, end = self.splits[idx], self.splits[idx + 1]
+            tail_res = torch.nn.functional.linear(hiddens[rows], weight[start:end], bias=bias[start:end])
+            tail_entropy = torch.gather(torch.nn.functional.log_softmax(tail_res, dim=-1), dim=1, index=(targets[rows] - start).view(-1, 1)).squeeze(1)
+            # p(tombstone) * p(word within tombstone), with the same tombstone indexing as forward()
+            result[rows] = softmaxed_head_res[rows, -idx] + tail_entropy
+        return result
+
     def split_on_targets(self, hiddens, targets):
         # Split the targets into those in the head and in the tail
         split_targets = []
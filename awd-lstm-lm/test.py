@@ -13,7 +13,7 @@ import pdb
 import data
 import model
 
-from utils import batchify, get_batch, repackage_hidden
+from utils import BPTTStream, repackage_hidden
 
 torch.nn.Module.dump_patches=True
 
@@ -22,6 +22,10 @@ parser.add_argument('--file', type=str, default='',
                     help='name of the file containing the saved model to be tested')
 parser.add_argument('--data', type=str, default='data/penn/',
                     help='location of the data corpus')
+parser.add_argument('--mincount', type=int, default=0,
+                    help='replace the words seen less than this many times in the training set by <unk>')
+parser.add_argument('--maxvocab', type=int, default=0,
+                    help='if > 0, keep only this many words (the most frequent ones, including <unk>)')
 parser.add_argument('--model', type=str, default='LSTM',
                     help='type of recurrent net (LSTM, QRNN, GRU)')
 parser.add_argument('--alphatype', type=str, default='full',
@@ -114,21 +118,13 @@ import platform
 print("Torch version:", torch.__version__, "Numpy version:", np.version.version, "Python version:", platform.python_version())
 
 import os
-import hashlib
-fn = 'corpus.{}.data'.format(hashlib.md5(args.data.encode()).hexdigest())
-if os.path.exists(fn):
-    print('Loading cached dataset...')
-    corpus = torch.load(fn)
-else:
-    print('Producing dataset...')
-    corpus = data.Corpus(args.data)
-    torch.save(corpus, fn)
+corpus = data.load_corpus(args.data, mincount=args.mincount, maxvocab=args.maxvocab)
 
 eval_batch_size = 10
 test_batch_size = 1
-train_data = batchify(corpus.train, args.batch_size, args)
-val_data = batchify(corpus.valid, eval_batch_size, args)
-test_data = batchify(corpus.test, test_batch_size, args)
+train_data = BPTTStream(corpus.train, args.batch_size, args)
+val_data = BPTTStream(corpus.valid, eval_batch_size, args)
+test_data = BPTTStream(corpus.test, test_batch_size, args)
 
 
 #train_data = train_data[:5000,:]   # For debugging
@@ -189,8 +185,7 @@ def evaluate(data_source, batch_size=10):
         total_loss = 0
         ntokens = len(corpus.dictionary)
         hidden = model.init_hidden(batch_size)
-        for i in range(0, data_source.size(0) - 1, args.bptt):
-            data, targets = get_batch(data_source, i, args, evaluation=True)
+        for data, targets in data_source.iterate(data_source.schedule(args.bptt)):
             output, hidden = model(data, hidden)
             total_loss += len(data) * criterion(model.decoder.weight, model.decoder.bias, output, targets).data
             hidden = repackage_hidden(hidden)
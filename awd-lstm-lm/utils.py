@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 #from torch.autograd import Variable
 
@@ -10,13 +11,19 @@ def repackage_hidden(h):
     else:
         return tuple(repackage_hidden(v) for v in h)
 
-def batchify(data, bsz, args):
+def columns(data, bsz):
+    if isinstance(data, np.ndarray):
+        # Token stream of a data.Corpus (uint16 or int32, possibly memory-mapped)
+        data = torch.from_numpy(data.astype(np.int64))
     # Work out how cleanly we can divide the dataset into bsz parts.
     nbatch = data.size(0) // bsz
     # Trim off any extra elements that wouldn't cleanly fit (remainders).
     data = data.narrow(0, 0, nbatch * bsz)
     # Evenly divide the data across the bsz batches.
-    data = data.view(bsz, -1).t().contiguous()
+    return data.view(bsz, -1).t().contiguous()
+
+def batchify(data, bsz, args):
+    data = columns(data, bsz)
     if args.cuda:
         data = data.cuda(device=args.numgpu)
     return data
@@ -26,3 +33,62 @@ def get_batch(source, i, args, seq_len=None, evaluation=False):
     data = source[i:i+seq_len]
     target = source[i+1:i+1+seq_len].view(-1)
     return data, target
+
+
+class BPTTStream(object):
+    """A batchified token stream (nbatch x bsz) and its BPTT windows.
+
+    The stream is kept in a single contiguous host buffer (pinned when
+    training on a GPU). iterate() yields, for each window, the data and the
+    targets as views of a single (seq_len + 1) x bsz slice of the stream,
+    without copies; on a GPU, the slice of the next window is copied to the
+    device on a side stream while the current one is processed. The lengths
+    of all the windows of an epoch are drawn up front by schedule()."""
+
+    def __init__(self, data, bsz, args):
+        self.source = columns(data, bsz)
+        self.bsz = bsz
+        self.device = torch.device('cuda', args.numgpu) if args.cuda else None
+        if self.device is not None:
+            self.source = self.source.pin_memory()
+
+    def __len__(self):
+        return self.source.size(0)
+
+    def schedule(self, bptt, variable=False):
+        # The (start, seq_len) of the successive windows of an epoch: all of length bptt (except the last one), or
+        # with variable=True, of random lengths around bptt (drawn from np.random, as in the training loop of Merity et al.)
+        last = len(self) - 1
+        if not variable:
+            return [(i, min(bptt, last - i)) for i in range(0, last, bptt)]
+        windows, i = [], 0
+        while i < last - 1:
+            meanlen = bptt if np.random.random() < 0.95 else bptt / 2.
+            # Prevent excessively small or negative sequence lengths
+            seq_len = max(5, int(np.random.normal(meanlen, 5)))
+            # There's a very small chance that it could select a very long sequence length resulting in OOM
+            # NOTE: this was commented out in smerity's code!
+            seq_len = min(seq_len, bptt + 10)
+            windows.append((i, min(seq_len, last - i)))
+            i += seq_len
+        return windows
+
+    def iterate(self, schedule):
+        # Yields (data, targets) for each window of schedule: data is seq_len x bsz, targets has seq_len * bsz elements
+        if self.device is None:
+            for start, seq_len in schedule:
+                window = self.source[start:start + seq_len + 1]
+                yield window[:-1], window[1:].view(-1)
+            return
+        copystream = torch.cuda.Stream(device=self.device)
+        def fetch(start, seq_len):
+            with torch.cuda.stream(copystream):
+                return self.source[start:start + seq_len + 1].to(self.device, non_blocking=True)
+        nextwindow = fetch(*schedule[0]) if schedule else None
+        for k in range(len(schedule)):
+            torch.cuda.current_stream(self.device).wait_stream(copystream)
+            window = nextwindow
+            window.record_stream(torch.cuda.current_stream(self.device))  # Allocated on copystream, used on the current stream
+            if k + 1 < len(schedule):
+                nextwindow = fetch(*schedule[k + 1])
+            yield window[:-1], window[1:].view(-1)
@@ -39,15 +39,14 @@ np.set_printoptions(precision=3)
 
 
 import images as pics
+import cifarstore
 from images import Network
 
 fig = plt.figure()
 plt.axis('off')
 
 # Note that this is a different file from the ones used in training
-with open('./data_batch_5', 'rb') as fo:
-    imagedict = pickle.load(fo, encoding='bytes')
-imagedata = imagedict[b'data']
+pics.imagedata = cifarstore.load('test')
 
 #suffix = 'eta_prestime_20_probadegrade_0.5_interpresdelay_2_learningrate_0.0001_prestimetest_3_rngseed_0_nbiter_50000_nbprescycles_3_inputboost_1.0_eta_0.01_nbpatterns_3_patternsize_1024' # This one used for first draft of the paper, rngseed 4
 #suffix = 'eta_inputboost_1.0_learningrate_0.0001_nbprescycles_3_interpresdelay_2_eta_0.01_rngseed_0_probadegrade_0.5_nbiter_150000_nbpatterns_3_prestimetest_3_patternsize_1024_prestime_20'
@@ -65,7 +64,10 @@ with open(fn, 'rb') as fo:
     myall_losses = pickle.load(fo)
     myparams = pickle.load(fo)
 
-net = Network(myparams)
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+net = Network(myparams, device=device)
+net.inplace = True  # We only run the network: no gradients, and the Hebbian trace is updated in place
+torch.set_grad_enabled(False)
 
 
 #np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
@@ -76,12 +78,10 @@ np.random.seed(rngseed); random.seed(rngseed); torch.manual_seed(rngseed)
 
 #print myall_losses
 
-ttype = torch.cuda.FloatTensor # Must match the one in pics_eta.py
-#ttype = torch.FloatTensor # Must match the one in pics_eta.py
 
-net.w.data = torch.from_numpy(myw).type(ttype)
-net.alpha.data = torch.from_numpy(myalpha).type(ttype)
-net.eta.data = torch.from_numpy(myeta).type(ttype)
+net.w.data = torch.from_numpy(myw).to(device)
+net.alpha.data = torch.from_numpy(myalpha).to(device)
+net.eta.data = torch.from_numpy(myeta).to(device)
 print(net.w.data[:10,:10])
 print(net.eta.data)
 
@@ -109,7 +109,8 @@ if SIMPLIFIED:
         z = np.random.rand()
         z = np.random.rand()
 
-        inputsTensor, targetPattern = pics.generateInputsAndTarget(myparams, contiguousperturbation=True)
+        inputsTensor, targetPattern = pics.generateInputsAndTarget(myparams, contiguousperturbation=True, device=device)
+        clamps = pics.clampMask(inputsTensor)
 
         y = net.initialZeroState()
         hebb = net.initialZeroHebb()
@@ -119,7 +120,7 @@ if SIMPLIFIED:
 
         print("Running the episode...")
         for numstep in range(myparams['nbsteps']):
-            y, hebb = net(Variable(inputsTensor[numstep], requires_grad=False), y, hebb)
+            y, hebb = net(inputsTensor[numstep], y, hebb, clamps[numstep])
             output = y.data.cpu().numpy()[0][:-1].reshape((imagesize, imagesize))
             #output = scipy.misc.imresize(output, 4.0)
             #plt.subplot(NBPICS, FILLINGSTEPS, nn)
@@ -201,7 +202,8 @@ else:
         z = np.random.rand()
         z = np.random.rand()
 
-        inputsTensor, targetPattern = pics.generateInputsAndTarget(myparams, contiguousperturbation=True)
+        inputsTensor, targetPattern = pics.generateInputsAndTarget(myparams, contiguousperturbation=True, device=device)
+        clamps = pics.clampMask(inputsTensor)
 
         y = net.initialZeroState()
         hebb = net.initialZeroHebb()
@@ -211,7 +213,7 @@ else:
 
         print("Running the episode...")
         for numstep in range(myparams['nbsteps']):
-            y, hebb = net(Variable(inputsTensor[numstep], requires_grad=False), y, hebb)
+            y, hebb = net(inputsTensor[numstep], y, hebb, clamps[numstep])
             output = y.data.cpu().numpy()[0][:-1].reshape((imagesize, imagesize))
             #output = scipy.misc.imresize(output, 4.0)
             #plt.subplot(NBPICS, FILLINGSTEPS, nn)
@@ -0,0 +1,104 @@
+# Differentiable plasticity: natural image memorization and reconstruction.
+#
+# Copyright (c) 2018 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Preprocessed store of the CIFAR 10 patterns used by the image completion task.
+#
+# Each pattern is a CIFAR image converted to grayscale (sum of the 3 colour
+# channels), mean-centred and normalised to a maximum absolute value of 1.
+# Rather than doing this for every pattern of every episode (and unpickling
+# the CIFAR batches at the start of every run), all the patterns are computed
+# once and stored as a single nbimages x 1024 float32 (or float16) array,
+# which is opened with np.memmap. Drawing the patterns of an episode is then
+# a single fancy-index.
+#
+# There are two stores: 'train' (data_batch_1 to data_batch_4, used by
+# images.py) and 'test' (data_batch_5, used by testpics.py, anim.py and
+# showcompletion_eta.py). They are built automatically the first time they
+# are loaded, or explicitly with:
+# python3 cifarstore.py [--dtype float16]
+
+import argparse
+import os
+import pickle
+
+import numpy as np
+
+
+STORES = {
+    'train': ('cifartrain.dat', ['data_batch_' + str(numfile + 1) for numfile in range(4)]),
+    'test': ('cifartest.dat', ['data_batch_5']),
+}
+
+
+def normalise(p):
+    # Mean-centres each pattern (row) of p and divides it by its maximum absolute value
+    p = p - np.mean(p, axis=-1, keepdims=True)
+    return p / (1e-8 + np.max(np.abs(p), axis=-1, keepdims=True))
+
+
+def grayscale(rows):
+    # Converts CIFAR rows (N x 3072, uint8) into normalised N x 1024 float64 grayscale patterns
+    return normalise(rows.reshape((-1, 3, 1024)).sum(1).astype(float))
+
+
+def build(which='train', datadir='.', dtype='float32'):
+    # Reads the CIFAR batch files of store 'which' from datadir, and writes the store (and its index) in datadir
+    storename, batchfiles = STORES[which]
+    storefile = os.path.join(datadir, storename)
+    rows = []
+    for batchfile in batchfiles:
+        with open(os.path.join(datadir, batchfile), 'rb') as fo:
+            #imagedict = pickle.load(fo)  # Python 2
+            imagedict = pickle.load(fo, encoding='bytes')  # Python 3
+        rows.append(np.asarray(imagedict[b'data']))
+    patterns = grayscale(np.concatenate(rows, axis=0))
+    # Both files are written under temporary names in datadir, then renamed (the index last): a process that
+    # loads the store while another one builds it never sees a partial store
+    tmpsuffix = '.tmp' + str(os.getpid())
+    data = np.memmap(storefile + tmpsuffix, dtype=dtype, mode='w+', shape=patterns.shape)
+    data[:] = patterns
+    data.flush()
+    del data
+    index = {'shape': patterns.shape, 'dtype': np.dtype(dtype).name, 'files': batchfiles}
+    with open(storefile + '.idx' + tmpsuffix, 'wb') as fo:
+        pickle.dump(index, fo)
+    os.replace(storefile + tmpsuffix, storefile)
+    os.replace(storefile + '.idx' + tmpsuffix, storefile + '.idx')
+    return index
+
+
+def load(which='train', datadir='.'):
+    # Returns the (read-only, memory-mapped) nbimages x 1024 array of the patterns of store 'which', building it if needed
+    storefile = os.path.join(datadir, STORES[which][0])
+    if not os.path.exists(storefile + '.idx'):
+        build(which, datadir)
+    with open(storefile + '.idx', 'rb') as fo:
+        index = pickle.load(fo)
+    if index['files'] != STORES[which][1]:
+        raise ValueError(storefile + " was built from " + str(index['files']) + ", expected " + str(STORES[which][1]))
+    return np.memmap(storefile, dtype=index['dtype'], mode='r', shape=tuple(index['shape']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datadir", help="directory of the CIFAR 10 batch files (the stores are written there too)", default='.')
+    parser.add_argument("--dtype", help="float32 or float16", default='float32')
+    parser.add_argument("stores", nargs='*', help="stores to build", default=sorted(STORES))
+    args = parser.parse_args()
+    for which in args.stores:
+        index = build(which, args.datadir, args.dtype)
+        print("Stored", index['shape'][0], "patterns (" + index['dtype'] + ") from", ", ".join(index['files']), "in", os.path.join(args.datadir, STORES[which][0]))
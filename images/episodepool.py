@@ -0,0 +1,102 @@
+# Differentiable plasticity: background episode generation.
+#
+# Copyright (c) 2018 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Background episode generation for the Omniglot and image completion tasks.
+#
+# Episode generation is pure NumPy work that doesn't depend on the network,
+# so it can run in worker processes while the training loop runs the network.
+# EpisodePool starts nbworkers processes, each calling generate(*args)
+# repeatedly and putting the results (as contiguous float32 tensors, in shared
+# memory) into its own bounded queue. Iterating over the pool returns the
+# episodes, moved to the requested device. If a worker fails, its traceback
+# is sent through its queue and re-raised by the pool.
+#
+# Runs stay reproducible: worker k seeds its random generators (numpy, random
+# and torch) from (rngseed, k), and the pool takes episodes from the workers in
+# a fixed round-robin order, whatever their relative speeds. (The sequence of
+# episodes is different from the one produced by synchronous generation with
+# the same rngseed.)
+
+import queue
+import random
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+def worker(rank, generate, args, rngseed, episodequeue):
+    torch.set_num_threads(1)
+    seed = (rngseed * 1000 + rank + 1) % 2**32
+    np.random.seed(seed); random.seed(seed); torch.manual_seed(seed)
+    try:
+        while True:
+            episode = generate(*args)
+            episodequeue.put(tuple(torch.from_numpy(np.ascontiguousarray(x, dtype='float32')) for x in episode))
+    except Exception:
+        # Sent instead of an episode, and raised again by EpisodePool.__next__
+        episodequeue.put(traceback.format_exc())
+
+
+class EpisodePool:
+
+    def __init__(self, generate, args, nbworkers, rngseed, device=None, dtype=torch.float32, queuesize=4):
+        # generate: a module-level function returning a tuple of NumPy arrays (e.g. inputs, labels, targets)
+        # queuesize: maximum number of episodes waiting in the queue of each worker
+        if nbworkers < 1:
+            raise ValueError("Need at least one worker process")
+        # Forking avoids copying large datasets to each worker; the workers never use CUDA
+        ctx = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        self.device, self.dtype = device, dtype
+        self.pin = (device is not None and torch.device(device).type == 'cuda')
+        self.queues = [ctx.Queue(maxsize=queuesize) for rank in range(nbworkers)]
+        self.processes = [ctx.Process(target=worker, args=(rank, generate, args, rngseed, self.queues[rank]), daemon=True) for rank in range(nbworkers)]
+        for p in self.processes:
+            p.start()
+        self.nextworker = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                episode = self.queues[self.nextworker].get(timeout=10)
+                break
+            except queue.Empty:
+                p = self.processes[self.nextworker]
+                if not p.is_alive():
+                    raise RuntimeError("Episode worker " + str(self.nextworker) + " has died (exit code " + str(p.exitcode) + ")")
+        if isinstance(episode, str):
+            raise RuntimeError("Episode worker " + str(self.nextworker) + " failed:\n" + episode)
+        self.nextworker = (self.nextworker + 1) % len(self.queues)
+        if self.pin:
+            episode = tuple(x.pin_memory() for x in episode)
+        return tuple(x.to(device=self.device, dtype=self.dtype, non_blocking=self.pin) for x in episode)
+
+    def close(self):
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            p.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
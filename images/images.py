@@ -39,18 +39,18 @@ import pdb
 import time
 import os
 import platform
+
+import cifarstore  # Preprocessed CIFAR patterns
+import episodepool  # Background episode generation (optional, see --workers)
 # Uber-only:
 #import OpusHdfsCopy
 #from OpusHdfsCopy import transferFileToHdfsDir, checkHdfs
 
 
 # Loading the image data. This requires downloading the CIFAR 10 dataset (Python version) - https://www.cs.toronto.edu/~kriz/cifar.html
-imagedata=np.zeros((0, 1024*3))
-for numfile in range(4):
-    with open('./data_batch_'+str(numfile+1), 'rb') as fo:
-        #imagedict = pickle.load(fo)  # Python 2
-        imagedict = pickle.load(fo, encoding='bytes')  # Python 3
-    imagedata = np.concatenate((imagedata, imagedict[b'data']), axis=0)
+# imagedata holds the grayscale, normalised patterns of data_batch_1 to data_batch_4 (see cifarstore.py)
+# The test scripts replace it with the patterns of data_batch_5.
+imagedata = cifarstore.load('train')
 
 np.set_printoptions(precision=4)
 
@@ -67,29 +67,24 @@ defaultParams = {
     'lr': 1e-4,   # Adam learning rate
     'print_every': 10,      # how often to print statistics and save files
     'homogenous': 0,        # whether alpha should be shared across connections 
+    'bs': 1,                # number of independent episodes in each batch
+    'workers': 0,           # number of background processes generating episodes (0: generate them in the training loop)
     'rngseed':0             # random seed
 }
 
 
-#ttype = torch.FloatTensor;         # For CPU
-ttype = torch.cuda.FloatTensor;     # For GPU
 
 
-# Generate the full list of inputs for an episode
-def generateInputsAndTarget(params, contiguousperturbation=True):
+# Generate the full list of inputs for an episode, and the target pattern (as numpy arrays)
+def generateEpisode(params, contiguousperturbation=True):
     #print(("Input Boost:", params['inputboost']))
     inputT = np.zeros((params['nbsteps'], 1, params['nbneur'])) #inputTensor, initially in numpy format...
     # Create the random patterns to be memorized in an episode
     # Floating-point, graded patterns, zero-mean
-    patterns=[]
-    for nump in range(params['nbpatterns']):
-        numpic = np.random.randint(imagedata.shape[0])
-        p = imagedata[numpic].reshape((3, 1024)).sum(0).astype(float)
-        p = p[:params['patternsize']]
-        p = p - np.mean(p)
-        p = p / (1e-8+np.max(np.abs(p)))
-        #p = (np.random.randint(2, size=params['patternsize']) - .5) *2   # Binary patterns
-        patterns.append(p)
+    patterns = imagedata[np.random.randint(imagedata.shape[0], size=params['nbpatterns']), :params['patternsize']]
+    if params['patternsize'] != imagedata.shape[1]:
+        patterns = cifarstore.normalise(patterns)  # Cropped patterns need to be normalised again
+    #patterns = (np.random.randint(2, size=(params['nbpatterns'], params['patternsize'])) - .5) *2   # Binary patterns
     #print "patterns generated!"
     # Now 'patterns' contains the NBPATTERNS patterns to be memorized in this episode - in numpy format
     # Creating the test pattern, partially zero'ed out, that the network will have to complete
@@ -119,44 +114,71 @@ def generateInputsAndTarget(params, contiguousperturbation=True):
         inputT[nn][0][-1] = 1.0  # Bias neuron is forced to 1
         #inputT[nn] *= params['inputboost']       # Strengthen inputs
 
-    inputT = torch.from_numpy(inputT).type(ttype)  # Convert from numpy to Tensor
-    target = torch.from_numpy(testpattern).type(ttype)
+    return inputT, testpattern
+
+# Generate params['bs'] independent episodes, stacked along the batch dimension: inputs are nbsteps x bs x nbneur, targets bs x patternsize (as numpy arrays)
+def generateBatch(params, contiguousperturbation=True):
+    episodes = [generateEpisode(params, contiguousperturbation) for nb in range(params.get('bs', 1))]
+    return np.concatenate([e[0] for e in episodes], axis=1), np.stack([e[1] for e in episodes])
+
+# Same as generateBatch, as Tensors
+def generateInputsAndTarget(params, contiguousperturbation=True, device=None, dtype=torch.float32):
+    inputT, testpattern = generateBatch(params, contiguousperturbation)
+    inputT = torch.from_numpy(inputT).to(device=device, dtype=dtype)  # Convert from numpy to Tensor
+    target = torch.from_numpy(testpattern).to(device=device, dtype=dtype)
 
     return inputT, target
 
 
+# The clamp mask: cells that receive a nonzero input have their output clamped to this input.
+# It is computed once for all the steps of an episode (nbsteps x bs x nbneur), on the device of the inputs.
+def clampMask(inputs):
+    return inputs != 0
+
+
 
 class Network(nn.Module):
-    def __init__(self, params):
+    def __init__(self, params, device=None, dtype=torch.float32):
         super(Network, self).__init__()
         # Notice that the vectors are row vectors, and the matrices are transposed wrt the comp neuro order, following deep learning / pytorch conventions
         # Each *column* of w targets a single output neuron
-        self.w = Variable(.01 * torch.randn(params['nbneur'], params['nbneur']).type(ttype), requires_grad=True)        # fixed (baseline) weights
+        self.w = Variable(.01 * torch.randn(params['nbneur'], params['nbneur']).to(device=device, dtype=dtype), requires_grad=True)        # fixed (baseline) weights
         if params['homogenous'] == 1:
-            self.alpha = Variable(.01 * torch.ones(1).type(ttype), requires_grad=True)                                  # plasticity coefficients: homogenous/shared across connections
+            self.alpha = Variable(.01 * torch.ones(1).to(device=device, dtype=dtype), requires_grad=True)                                  # plasticity coefficients: homogenous/shared across connections
         else:
-            self.alpha = Variable(.01 * torch.randn(params['nbneur'], params['nbneur']).type(ttype),requires_grad=True) # plasticity coefficients: independent
-        self.eta = Variable(.01 * torch.ones(1).type(ttype), requires_grad=True)                            # "learning rate" of plasticity, shared across all connections
+            self.alpha = Variable(.01 * torch.randn(params['nbneur'], params['nbneur']).to(device=device, dtype=dtype),requires_grad=True) # plasticity coefficients: independent
+        self.eta = Variable(.01 * torch.ones(1).to(device=device, dtype=dtype), requires_grad=True)                            # "learning rate" of plasticity, shared across all connections
         self.params = params
+        self.device, self.dtype = device, dtype
+        self.inplace = False  # If True (evaluation only, without gradients), the Hebbian trace is updated in place
 
-    def forward(self, input, yin, hebb):
+    def forward(self, input, yin, hebb, clamps=None):
         # Inputs are fed by clamping the output of cells that receive input at the input value, like in standard Hopfield networks
-        # clamps = torch.zeros(1, self.params['nbneur'])
-        clamps = np.zeros(self.params['nbneur'])
-        zz = torch.nonzero(input.data[0].cpu()).numpy().squeeze()
-        #print(zz, zz.shape)
-        clamps[zz] = 1
-        #print(clamps)
-        clamps = Variable(torch.from_numpy(clamps).type(ttype), requires_grad=False).float()
-        yout = F.tanh( yin.mm(self.w + torch.mul(self.alpha, hebb))) * (1 - clamps) + input * clamps
-        hebb = (1 - self.eta) * hebb + self.eta * torch.bmm(yin.unsqueeze(2), yout.unsqueeze(1))[0] # bmm used to implement outer product
+        # clamps is the (boolean) clamp mask for this step, as computed by clampMask for the whole episode; if not given, it is computed here
+        # With a batch of episodes, yin is bs x nbneur and each episode has its own Hebbian trace (bs x nbneur x nbneur)
+        if clamps is None:
+            clamps = clampMask(input)
+        if hebb.dim() == 3:
+            yout = torch.where(clamps, input, F.tanh( torch.bmm(yin.unsqueeze(1), self.w + torch.mul(self.alpha, hebb)).squeeze(1)))
+            if self.inplace:
+                hebb = hebb.mul_(1 - self.eta).baddbmm_((self.eta * yin).unsqueeze(2), yout.unsqueeze(1))
+            else:
+                hebb = (1 - self.eta) * hebb + self.eta * torch.bmm(yin.unsqueeze(2), yout.unsqueeze(1)) # bmm used to implement the batched outer product
+        else:
+            yout = torch.where(clamps, input, F.tanh( yin.mm(self.w + torch.mul(self.alpha, hebb))))
+            if self.inplace:
+                hebb = hebb.mul_(1 - self.eta).addr_(self.eta * yin[0], yout[0])
+            else:
+                hebb = (1 - self.eta) * hebb + self.eta * torch.bmm(yin.unsqueeze(2), yout.unsqueeze(1))[0] # bmm used to implement outer product
         return yout, hebb
 
     def initialZeroState(self):
-        return Variable(torch.zeros(1, self.params['nbneur']).type(ttype))
+        return Variable(torch.zeros(self.params.get('bs', 1), self.params['nbneur'], device=self.device, dtype=self.dtype))
 
     def initialZeroHebb(self):
-        return Variable(torch.zeros(self.params['nbneur'], self.params['nbneur']).type(ttype))
+        if self.params.get('bs', 1) > 1:
+            return torch.zeros(self.params['bs'], self.params['nbneur'], self.params['nbneur'], device=self.device, dtype=self.dtype)
+        return Variable(torch.zeros(self.params['nbneur'], self.params['nbneur'], device=self.device, dtype=self.dtype))
 
 
 def train(paramdict=None):
@@ -171,19 +193,27 @@ def train(paramdict=None):
     sys.stdout.flush()
     params['nbsteps'] = params['nbprescycles'] * ((params['prestime'] + params['interpresdelay']) * params['nbpatterns']) + params['prestimetest']  # Total number of steps per episode
     params['nbneur'] = params['patternsize'] + 1
-    suffix = "images_"+"".join([str(x)+"_" if pair[0] is not 'nbneur' and pair[0] is not 'nbsteps' and pair[0] is not 'print_every' and pair[0] is not 'rngseed' else '' for pair in zip(params.keys(), params.values()) for x in pair])[:-1] + '_rngseed_'+str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames; rngseed always appears last
+    suffix = "images_"+"".join([str(x)+"_" if pair[0] not in ('nbneur', 'nbsteps', 'print_every', 'rngseed', 'workers') else '' for pair in zip(params.keys(), params.values()) for x in pair])[:-1] + '_rngseed_'+str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames; rngseed always appears last
 
     # Initialize random seeds (first two redundant?)
     print("Setting random seeds")
     np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
     #print(click.get_current_context().params)
     
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
     print("Initializing network")
-    net = Network(params)
+    net = Network(params, device=device)
     total_loss = 0.0
     
     print("Initializing optimizer")
     optimizer = torch.optim.Adam([net.w, net.alpha, net.eta], lr=params['lr'])
+
+    # Optionally, generate the episodes in background worker processes (see episodepool.py)
+    pool = None
+    if params['workers'] > 0:
+        pool = episodepool.EpisodePool(generateBatch, (params,), params['workers'], params['rngseed'], device=device)
+
     all_losses = []
     #print_every = 20
     nowtime = time.time()
@@ -197,15 +227,19 @@ def train(paramdict=None):
         hebb = net.initialZeroHebb()
         optimizer.zero_grad()
 
-        inputs, target = generateInputsAndTarget(params)
+        if pool is not None:
+            inputs, target = next(pool)
+        else:
+            inputs, target = generateInputsAndTarget(params, device=device)
 
         # Running the episode
+        clamps = clampMask(inputs)
         for numstep in range(params['nbsteps']):
-            y, hebb = net(Variable(inputs[numstep], requires_grad=False), y, hebb)
+            y, hebb = net(Variable(inputs[numstep], requires_grad=False), y, hebb, clamps[numstep])
 
 
-        # Computing gradients, applying optimizer
-        loss = (y[0][:params['patternsize']] - Variable(target, requires_grad=False)).pow(2).sum()
+        # Computing gradients, applying optimizer (the loss is averaged over the episodes in the batch)
+        loss = (y[:, :params['patternsize']] - target).pow(2).sum(1).mean()
         loss.backward()
         optimizer.step()
 
@@ -217,7 +251,7 @@ def train(paramdict=None):
         if (numiter+1) % params['print_every'] == 0:
 
             print(numiter, "====")
-            td = target.cpu().numpy()
+            td = target.cpu().numpy()[0]
             yd = y.data.cpu().numpy()[0][:-1]
             print("y: ", yd[:10])
             print("target: ", td[:10])
@@ -255,6 +289,9 @@ def train(paramdict=None):
 
             total_loss = 0
 
+    if pool is not None:
+        pool.close()
+
 
 @click.command()
 @click.option('--nbpatterns', default=defaultParams['nbpatterns'])
@@ -269,7 +306,9 @@ def train(paramdict=None):
 @click.option('--lr', default=defaultParams['lr'])
 @click.option('--print_every', default=defaultParams['print_every'])
 @click.option('--rngseed', default=defaultParams['rngseed'])
-def main(nbpatterns, nbprescycles, homogenous, prestime, prestimetest, interpresdelay, patternsize, nbiter, probadegrade, lr, print_every, rngseed):
+@click.option('--workers', default=defaultParams['workers'])
+@click.option('--bs', default=defaultParams['bs'])
+def main(nbpatterns, nbprescycles, homogenous, prestime, prestimetest, interpresdelay, patternsize, nbiter, probadegrade, lr, print_every, rngseed, workers, bs):
     train(paramdict=dict(click.get_current_context().params))
     #print(dict(click.get_current_context().params))
 
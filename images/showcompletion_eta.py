@@ -38,14 +38,13 @@ plt.ion()
 
 
 import images as pics
+import cifarstore
 from images import Network
 
 #plt.figure()
 
 # Note that this is a different file from the ones used in training
-with open('../data_batch_5', 'rb') as fo:
-    imagedict = pickle.load(fo, encoding='bytes')
-imagedata = imagedict[b'data']
+pics.imagedata = cifarstore.load('test', datadir='..')
 
 #suffix = 'eta_prestime_20_probadegrade_0.5_interpresdelay_2_learningrate_0.0001_prestimetest_3_rngseed_0_nbiter_50000_nbprescycles_3_inputboost_1.0_eta_0.01_nbpatterns_3_patternsize_1024' # This one used for first draft of the paper, rngseed 4
 #suffix = 'eta_inputboost_1.0_learningrate_0.0001_nbprescycles_3_interpresdelay_2_eta_0.01_rngseed_0_probadegrade_0.5_nbiter_150000_nbpatterns_3_prestimetest_3_patternsize_1024_prestime_20'
@@ -63,7 +62,10 @@ with open(fn, 'rb') as fo:
     myall_losses = pickle.load(fo)
     myparams = pickle.load(fo)
 
-net = Network(myparams)
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+net = Network(myparams, device=device)
+net.inplace = True  # We only run the network: no gradients, and the Hebbian trace is updated in place
+torch.set_grad_enabled(False)
 
 #np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
 #rngseed=4
@@ -72,12 +74,10 @@ np.random.seed(rngseed); random.seed(rngseed); torch.manual_seed(rngseed)
 
 #print myall_losses
 
-ttype = torch.cuda.FloatTensor # Must match the one in pics_eta.py
-#ttype = torch.FloatTensor # Must match the one in pics_eta.py
 
-net.w.data = torch.from_numpy(myw).type(ttype)
-net.alpha.data = torch.from_numpy(myalpha).type(ttype)
-net.eta.data = torch.from_numpy(myeta).type(ttype)
+net.w.data = torch.from_numpy(myw).to(device)
+net.alpha.data = torch.from_numpy(myalpha).to(device)
+net.eta.data = torch.from_numpy(myeta).to(device)
 print(net.w.data[:10,:10])
 print(net.eta.data)
 
@@ -96,14 +96,15 @@ for numpic in range(NBPICS):
     z = np.random.rand()
     z = np.random.rand()
 
-    inputsTensor, targetPattern = pics.generateInputsAndTarget(myparams, contiguousperturbation=True)
+    inputsTensor, targetPattern = pics.generateInputsAndTarget(myparams, contiguousperturbation=True, device=device)
+    clamps = pics.clampMask(inputsTensor)
 
     y = net.initialZeroState()
     hebb = net.initialZeroHebb()
     net.zeroDiagAlpha()
 
     for numstep in range(myparams['nbsteps']):
-        y, hebb = net(Variable(inputsTensor[numstep], requires_grad=False), y, hebb)
+        y, hebb = net(inputsTensor[numstep], y, hebb, clamps[numstep])
         if numstep >= myparams['nbsteps'] - FILLINGSTEPS:
             output = y.data.cpu().numpy()[0][:-1].reshape((imagesize, imagesize))
             #output = scipy.misc.imresize(output, 4.0)
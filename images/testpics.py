@@ -36,14 +36,13 @@ plt.ion()
 
 
 import images as pics
+import cifarstore
 from images import Network
 
 plt.figure()
 
 # Note that this is a different file from the ones used in training
-with open('./data_batch_5', 'rb') as fo:
-    imagedict = pickle.load(fo, encoding='bytes')
-imagedata = imagedict[b'data']
+pics.imagedata = cifarstore.load('test')
 
 suffix='images_patternsize_1024_interpresdelay_2_nbpatterns_3_lr_0.0001_nbprescycles_3_homogenous_20_nbiter_100000_prestime_20_probadegrade_0.5_prestimetest_3_rngseed_0'
 #fn = './tmp/results_'+suffix+'.dat'
@@ -55,7 +54,10 @@ with open(fn, 'rb') as fo:
     myall_losses = pickle.load(fo)
     myparams = pickle.load(fo)
 
-net = Network(myparams)
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+net = Network(myparams, device=device)
+net.inplace = True  # We only run the network: no gradients, and the Hebbian trace is updated in place
+torch.set_grad_enabled(False)
 
 #np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
 #rngseed=4
@@ -64,12 +66,10 @@ np.random.seed(rngseed); random.seed(rngseed); torch.manual_seed(rngseed)
 
 #print myall_losses
 
-ttype = torch.cuda.FloatTensor # Must match the one in pics_eta.py
-#ttype = torch.FloatTensor # Must match the one in pics_eta.py
 
-net.w.data = torch.from_numpy(myw).type(ttype)
-net.alpha.data = torch.from_numpy(myalpha).type(ttype)
-net.eta.data = torch.from_numpy(myeta).type(ttype)
+net.w.data = torch.from_numpy(myw).to(device)
+net.alpha.data = torch.from_numpy(myalpha).to(device)
+net.eta.data = torch.from_numpy(myeta).to(device)
 print(net.w.data[:10,:10])
 print(net.eta.data)
 
@@ -79,14 +79,15 @@ for numpic in range(NBPICS):
 
     print("Pattern", numpic)
 
-    inputsTensor, targetPattern = pics.generateInputsAndTarget(myparams, contiguousperturbation=True)
+    inputsTensor, targetPattern = pics.generateInputsAndTarget(myparams, contiguousperturbation=True, device=device)
+    clamps = pics.clampMask(inputsTensor)
 
     y = net.initialZeroState()
     hebb = net.initialZeroHebb()
     #net.zeroDiagAlpha()
 
     for numstep in range(myparams['nbsteps']):
-        y, hebb = net(Variable(inputsTensor[numstep], requires_grad=False), y, hebb)
+        y, hebb = net(inputsTensor[numstep], y, hebb, clamps[numstep])
 
    
     
@@ -122,7 +123,7 @@ for numpic in range(NBPICS):
     plt.axis('off')
     nn += 5
 
-    td = targetPattern.cpu().numpy()
+    td = targetPattern.cpu().numpy()[0]
     yd = y.data.cpu().numpy()[0][:-1]
     absdiff = np.abs(td-yd)
     print("Mean / median / max abs diff:", np.mean(absdiff), np.median(absdiff), np.max(absdiff))
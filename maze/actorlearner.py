@@ -0,0 +1,135 @@
+# Backpropamine: differentiable neuromdulated plasticity.
+#
+# Copyright (c) 2018-2019 Uber Technologies, Inc.
+#
+# Licensed under the Uber Non-Commercial License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at the root directory of this project.
+#
+# See the License file in this repository for the specific language governing
+# permissions and limitations under the License.
+
+
+# Asynchronous actor/learner split for the A2C meta-training of batch.py.
+#
+# A pool of actor processes runs episodes (each for a whole batch of agents,
+# with its own MazeEnv) under a snapshot of the policy that lives in shared
+# memory, without gradients. Completed trajectories (inputs, actions,
+# behaviour log-probabilities, rewards, and the version of the snapshot that
+# produced them) are sent to the learner, which re-runs the network over the
+# recorded inputs with gradients, and publishes its new parameters to the
+# snapshot after each optimizer step.
+#
+# Since the snapshot may be a few updates behind the learner, the policy
+# gradient is corrected with V-trace (Espeholt et al. 2018, "IMPALA"), with
+# truncated importance weights. Trajectories produced by a snapshot more than
+# 'maxstale' updates old are discarded.
+
+import copy
+import queue
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+
+import mazeenv
+
+
+def vtrace(blogprobs, tlogprobs, rewards, values, gamma, rhobar=1.0, cbar=1.0):
+    # All arguments are eplen x BS tensors: log-probabilities of the chosen
+    # actions under the behaviour (actor) and target (learner) policies,
+    # rewards, and value predictions of the learner. The episode ends after
+    # the last step, so the value after it is 0.
+    # Returns the V-trace value targets vs and the policy gradient advantages (both without gradients).
+    with torch.no_grad():
+        ratios = torch.exp(tlogprobs - blogprobs)
+        rhos = torch.clamp(ratios, max=rhobar)
+        cs = torch.clamp(ratios, max=cbar)
+        values = values.detach()
+        nextvalues = torch.cat((values[1:], torch.zeros_like(values[:1])))
+        deltas = rhos * (rewards + gamma * nextvalues - values)
+        vs = torch.zeros_like(values)
+        acc = torch.zeros_like(values[0])
+        for numstep in reversed(range(values.size(0))):
+            acc = deltas[numstep] + gamma * cs[numstep] * acc
+            vs[numstep] = values[numstep] + acc
+        nextvs = torch.cat((vs[1:], torch.zeros_like(vs[:1])))
+        advantages = rhos * (rewards + gamma * nextvs - values)
+    return vs, advantages
+
+
+def actor(rank, sharednet, version, lock, trajqueue, params, lab, rfsize, addinput, nbactions):
+    # Runs episodes forever with the latest snapshot of the policy, and sends the trajectories to the learner
+    torch.set_num_threads(1)
+    seed = params['rngseed'] * 1000 + 1 + rank
+    np.random.seed(seed); torch.manual_seed(seed)
+    net = copy.deepcopy(sharednet)  # Local (non-shared) copy, so the learner can update the snapshot while we run
+    env = mazeenv.MazeEnv(lab, params['bs'], params['eplen'], params['rew'], params['wp'], rfsize, addinput, nbactions)
+    torch.set_grad_enabled(False)
+    pool = net.initialStatePool()  # The network state is preallocated once, and zeroed in place for each episode (see statepool.py)
+    while True:
+        with lock:
+            net.load_state_dict(sharednet.state_dict())
+            myversion = version.value
+        pool.reset()
+        inputs = env.reset()
+        allinputs, actions, logprobs, rewards = [], [], [], []
+        for numstep in range(params['eplen']):
+            inputsC = torch.from_numpy(inputs)
+            y, v = net.forward_pool(inputsC, pool)
+            distrib = torch.distributions.Categorical(F.softmax(y, dim=1))
+            actionschosen = distrib.sample()
+            reward, inputs = env.step(actionschosen.numpy())
+            allinputs.append(inputsC); actions.append(actionschosen)
+            logprobs.append(distrib.log_prob(actionschosen)); rewards.append(torch.from_numpy(reward))
+        trajqueue.put((myversion, torch.stack(allinputs), torch.stack(actions), torch.stack(logprobs), torch.stack(rewards)))
+
+
+class ActorPool:
+
+    def __init__(self, sharednet, params, lab, rfsize, addinput, nbactions):
+        # sharednet: a CPU copy of the network, which holds the policy snapshot used by the actors
+        # params['actors'] actor processes are started; params['maxstale'] is the largest accepted lag (in optimizer steps) of a trajectory
+        if params['actors'] < 1:
+            raise ValueError("Need at least one actor process")
+        ctx = mp.get_context('spawn')  # Also safe with CUDA in the learner
+        self.sharednet = sharednet.share_memory()
+        self.version = ctx.Value('l', 0, lock=False)
+        self.lock = ctx.Lock()
+        # The bounded queue also limits staleness: actors block when the learner falls behind
+        self.trajqueue = ctx.Queue(maxsize=params['actors'])
+        self.maxstale = params['maxstale']
+        self.nbdropped = 0
+        self.processes = [ctx.Process(target=actor, args=(rank, self.sharednet, self.version, self.lock, self.trajqueue, params, lab, rfsize, addinput, nbactions), daemon=True)
+                          for rank in range(params['actors'])]
+        for p in self.processes:
+            p.start()
+
+    def publish(self, net):
+        # Copies the learner's parameters into the snapshot, and increments its version
+        with self.lock:
+            with torch.no_grad():
+                for pshared, p in zip(self.sharednet.parameters(), net.parameters()):
+                    pshared.copy_(p)
+            self.version.value += 1
+
+    def get(self, device=None):
+        # Returns the next trajectory that is recent enough: (lag, inputs, actions, behaviour log-probs, rewards), all eplen x BS (x inputsize)
+        while True:
+            try:
+                trajversion, inputs, actions, logprobs, rewards = self.trajqueue.get(timeout=600)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self.processes):
+                    raise RuntimeError("An actor process has died")
+                continue
+            lag = self.version.value - trajversion
+            if lag <= self.maxstale:
+                return lag, inputs.to(device), actions.to(device), logprobs.to(device), rewards.to(device)
+            self.nbdropped += 1
+
+    def close(self):
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            p.join()
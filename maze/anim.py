@@ -19,6 +19,8 @@ import os
 import OpusHdfsCopy
 from OpusHdfsCopy import transferFileToHdfsDir, checkHdfs
 import platform
+import mazeenv
+import evalruntime  # Inference-only runtime (no gradients, in-place trace updates)
 
 import gridlab
 from gridlab import Network
@@ -60,7 +62,7 @@ def train(paramdict):
 
 
     # This needs to be the same as in the file generated by gridlab, and thus the command line parameters must be identical
-    suffix = "grid_"+"".join([str(x)+"_" if pair[0] is not 'nbsteps' and pair[0] is not 'rngseed' and pair[0] is not 'save_every' and pair[0] is not 'test_every' else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
+    suffix = "grid_"+"".join([str(x)+"_" if pair[0] not in ('nbsteps', 'rngseed', 'save_every', 'test_every') else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
 
 
     params['rngseed'] = 3
@@ -69,8 +71,10 @@ def train(paramdict):
     np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
     #print(click.get_current_context().params)
     
-    net = Network(params)
-    net.load_state_dict(torch.load('./tmpWorked/torchmodel_'+suffix + '.txt'))
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    net = Network(params).to(device)
+    evalruntime.load(net, './tmpWorked/torchmodel_'+suffix + '.txt', device)
+    torch.set_grad_enabled(False)  # We only run the network
 
 
     print ("Shape of all optimized parameters:", [x.size() for x in net.parameters()])
@@ -106,6 +110,7 @@ def train(paramdict):
             if row % 2 == 0 and col % 2 == 0:
                 lab[row, col] = 1
     lab[CTR,CTR] = 0 # Not strictly necessary, but perhaps helps loclization by introducing a detectable irregularity in the center
+    obstable, _ = mazeenv.observationtable(lab, RFSIZE)  # Precomputed receptive-field observations for every cell (see mazeenv.py)
 
 
 
@@ -198,9 +203,9 @@ def train(paramdict):
             
             
             inputsN = np.zeros((1, TOTALNBINPUTS), dtype='float32')
-            inputsN[0, 0:RFSIZE * RFSIZE] = lab[posr - RFSIZE//2:posr + RFSIZE//2 +1, posc - RFSIZE //2:posc + RFSIZE//2 +1].flatten()
+            inputsN[0, 0:RFSIZE * RFSIZE] = obstable[posr * LABSIZE + posc]
             
-            inputs = torch.from_numpy(inputsN).cuda()
+            inputs = torch.from_numpy(inputsN).to(device)
             # Previous chosen action
             #inputs[0][numactionchosen] = 1
             inputs[0][-1] = 1 # Bias neuron
@@ -212,7 +217,7 @@ def train(paramdict):
             #    inputs[0][-4] = 0
             
             # Running the network
-            y, v, hidden, hebb = net(Variable(inputs, requires_grad=False), hidden, hebb)  # y  should output probabilities
+            y, v, hidden, hebb = net(inputs, hidden, hebb)  # y  should output probabilities
         
             distrib = torch.distributions.Categorical(y)
             actionchosen = distrib.sample()  # sample() returns a Pytorch tensor of size 1; this is needed for the backprop below
@@ -28,6 +28,8 @@ import os
 import OpusHdfsCopy
 from OpusHdfsCopy import transferFileToHdfsDir, checkHdfs
 import platform
+import mazeenv
+import evalruntime  # Inference-only runtime (no gradients, in-place trace updates)
 
 import batch
 from batch import Network
@@ -82,10 +84,14 @@ def train(paramdict):
     np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
     #print(click.get_current_context().params)
     
-    net = Network(params)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    net = Network(params, device=device)
     # YOU MAY NEED TO CHANGE THE DIRECTORY HERE:
     if paramdict['initialize'] == 0:
-        net.load_state_dict(torch.load('./tmp/torchmodel_'+suffix + '.dat'))
+        evalruntime.load(net, './tmp/torchmodel_'+suffix + '.dat', device)
+    else:
+        evalruntime.inference(net)
+    torch.set_grad_enabled(False)  # We only run the network
 
 
     print ("Shape of all optimized parameters:", [x.size() for x in net.parameters()])
@@ -120,6 +126,7 @@ def train(paramdict):
     # (including 13 and 9, but not 11) by introducing a detectable irregularity
     # in the center:
     lab[CTR,CTR] = 0 
+    obstable, _ = mazeenv.observationtable(lab, RFSIZE)  # Precomputed receptive-field observations for every cell (see mazeenv.py)
 
 
 
@@ -201,10 +208,8 @@ def train(paramdict):
 
             inputs = np.zeros((BATCHSIZE, TOTALNBINPUTS), dtype='float32') 
         
-            labg = lab.copy()
-            #labg[rposr, rposc] = -1  # The agent can see the reward if it falls within its RF
             for nb in range(BATCHSIZE):
-                inputs[nb, 0:RFSIZE * RFSIZE] = labg[posr[nb] - RFSIZE//2:posr[nb] + RFSIZE//2 +1, posc[nb] - RFSIZE //2:posc[nb] + RFSIZE//2 +1].flatten() * 1.0
+                inputs[nb, 0:RFSIZE * RFSIZE] = obstable[posr[nb] * LABSIZE + posc[nb]]
                 
                 # Previous chosen action
                 inputs[nb, RFSIZE * RFSIZE +1] = 1.0 # Bias neuron
@@ -214,7 +219,7 @@ def train(paramdict):
                 inputs[nb, RFSIZE * RFSIZE + ADDINPUT + numactionschosen[nb]] = 1
                 #inputs = 100.0 * inputs  # input boosting : Very bad with clamp=0
             
-            inputsC = torch.from_numpy(inputs).cuda()
+            inputsC = torch.from_numpy(inputs).to(device)
             # Might be better:
             #if rposr == posr and rposc = posc:
             #    inputs[0][-4] = 100.0
@@ -224,7 +229,7 @@ def train(paramdict):
             # Running the network
 
             ## Running the network
-            y, v, hidden, hebb, et, pw = net(Variable(inputsC, requires_grad=False), hidden, hebb, et, pw)  # y  should output raw scores, not probas
+            y, v, hidden, hebb, et, pw = net(inputsC, hidden, hebb, et, pw)  # y  should output raw scores, not probas
 
             # For now:
             #numactionchosen = np.argmax(y.data[0])
@@ -324,10 +329,10 @@ def train(paramdict):
 
         # Episode is done, now let's do the actual computations
 
-        R = Variable(torch.zeros(BATCHSIZE).cuda(), requires_grad=False)
+        R = torch.zeros(BATCHSIZE, device=device)
         gammaR = params['gr']
         for numstepb in reversed(range(params['eplen'])) :
-            R = gammaR * R + Variable(torch.from_numpy(rewards[numstepb]).cuda(), requires_grad=False)
+            R = gammaR * R + torch.from_numpy(rewards[numstepb]).to(device)
             ctrR = R - vs[numstepb][0]
             lossv += ctrR.pow(2).sum() / BATCHSIZE
             loss -= (logprobs[numstepb] * ctrR.detach()).sum() / BATCHSIZE  # Need to check if detach() is OK
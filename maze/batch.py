@@ -32,6 +32,14 @@ import os
 import platform
 ##import makemaze
 
+import hebbtrace  # Fused Hebbian trace updates
+import bpttckpt  # Checkpointed BPTT (optional, see --ckpt)
+import plasticcell  # TorchScript version of the network (optional, see --jit)
+import mazeenv  # Vectorised maze environment
+import discount  # Discounted returns and advantages
+import actorlearner  # Asynchronous actors with V-trace (optional, see --actors)
+import statepool  # Preallocated state for rollouts without gradients
+
 import numpy as np
 #import matplotlib.pyplot as plt
 import glob
@@ -61,8 +69,19 @@ TOTALNBINPUTS =  RFSIZE * RFSIZE + ADDINPUT + NBACTIONS
 #ttype = torch.cuda.FloatTensor;
 
 
+def _recurrent(net, hidden, plastic):
+    # (w + alpha * plastic) hidden, batched (BS x HS x 1), where the rows of w and plastic are the input weights to a single neuron.
+    # In place mode (evaluation, see evalruntime.py), the effective weights are written into a scratch buffer reused at each step.
+    BATCHSIZE, HS = net.params['bs'], net.params['hs']
+    if not net.inplace:
+        return torch.matmul((net.w + torch.mul(net.alpha, plastic)), hidden.view(BATCHSIZE, HS, 1))
+    if net.weff is None or net.weff.shape != plastic.shape or net.weff.device != plastic.device:
+        net.weff = torch.empty_like(plastic)
+    return torch.bmm(torch.addcmul(net.w, net.alpha, plastic, out=net.weff), hidden.view(BATCHSIZE, HS, 1))
+
+
 class Network(nn.Module):
-    def __init__(self, params):
+    def __init__(self, params, device=None, dtype=torch.float32):
         super(Network, self).__init__()
         #self.rule = params['rule']
         self.type = params['type']
@@ -70,29 +89,32 @@ class Network(nn.Module):
         #if params['activ'] == 'tanh':
         self.activ = F.tanh
         if params['type'] == 'rnn':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
         elif params['type'] == 'modplast':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).cuda(), requires_grad=True) 
-            self.alpha =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).cuda(), requires_grad=True)
-            self.h2DA = torch.nn.Linear(params['hs'], NBDA).cuda()
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).to(device=device, dtype=dtype), requires_grad=True) 
+            self.alpha =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).to(device=device, dtype=dtype), requires_grad=True)
+            self.h2DA = torch.nn.Linear(params['hs'], NBDA).to(device=device, dtype=dtype)
         elif params['type'] == 'plastic' :
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
         elif params['type'] == 'modul' or params['type'] == 'modul2':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.etaet = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same etaet
-            self.h2DA = torch.nn.Linear(params['hs'], NBDA).cuda()
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.etaet = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same etaet
+            self.h2DA = torch.nn.Linear(params['hs'], NBDA).to(device=device, dtype=dtype)
         else:
             raise ValueError("Which network type?")
-        self.h2o = torch.nn.Linear(params['hs'], NBACTIONS).cuda()
-        self.h2v = torch.nn.Linear(params['hs'], 1).cuda()
+        self.h2o = torch.nn.Linear(params['hs'], NBACTIONS).to(device=device, dtype=dtype)
+        self.h2v = torch.nn.Linear(params['hs'], 1).to(device=device, dtype=dtype)
         self.params = params
+        self.device, self.dtype = device, dtype
+        self.inplace = False  # If True (evaluation only, see evalruntime.py), the traces are updated in place
+        self.weff = None  # Scratch buffer for the effective weights, in place mode only (see _recurrent)
 
         # Notice that the vectors are row vectors, and the matrices are transposed wrt the usual order, following apparent pytorch conventions
         # Each *column* of w targets a single output neuron
@@ -113,27 +135,17 @@ class Network(nn.Module):
         elif self.type == 'plastic':
             # Each row of w and hebb contains the input weights to a single neuron
             # hidden = x, hactiv = y
-            hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + torch.matmul((self.w + torch.mul(self.alpha, hebb)),
-                            hidden.view(BATCHSIZE, HS, 1))).view(BATCHSIZE, HS)
+            hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + _recurrent(self, hidden, hebb)).view(BATCHSIZE, HS)
             activout = self.h2o(hactiv)  # Pure linear, raw scores - will be softmaxed later
             valueout = self.h2v(hactiv)
             
-            deltahebb =  torch.bmm(hactiv.view(BATCHSIZE, HS, 1), hidden.view(BATCHSIZE, 1, HS)) # batched outer product...should it be other way round?
-            
-            if self.params['addpw'] == 3:
-                # Note that there is no decay, even in the Hebb-rule case : additive only!
-                # Hard clamp
-                hebb = torch.clamp( hebb +  self.eta * deltahebb, min=-1.0, max=1.0)
-            elif self.params['addpw'] == 2:
-                # Note that there is no decay, even in the Hebb-rule case : additive only!
-                # Soft clamp
-                hebb = torch.clamp( hebb +  torch.clamp(self.eta * deltahebb, min=0.0) * (1 - hebb) +  torch.clamp(self.eta * deltahebb, max=0.0) * (hebb + 1) , min=-1.0, max=1.0)
-            elif self.params['addpw'] == 1: # Purely additive, tends to make the meta-learning diverge. No decay/clamp.
-                hebb = hebb + self.eta * deltahebb
-            elif self.params['addpw'] == 0:    
-                # We do it the normal way. Note that here, Hebb-rule is decaying.
-                # There is probably a way to make it more efficient. 
-                hebb = (1 - self.eta) * hebb + self.eta * deltahebb
+            # deltahebb is the batched outer product of hactiv (rows) and hidden (columns)
+            # addpw = 3: hard clamp ; 2: soft clamp ; 1: purely additive, tends to make the meta-learning diverge ; 0: decaying Hebb rule
+            # Note that there is no decay, except with addpw = 0 : additive only!
+            # See hebbtrace.py for the full expressions.
+            if self.params['addpw'] not in hebbtrace.ADDPWMODES:
+                raise ValueError("Which additive form for plastic weights?")
+            hebb = hebbtrace.hebbupdate(hebb, hactiv, hidden, self.eta, hebbtrace.ADDPWMODES[self.params['addpw']], clipval=1.0, out=hebb if self.inplace else None)
 
             hidden = hactiv
         
@@ -144,8 +156,7 @@ class Network(nn.Module):
 
             # The rows of w and hebb are the inputs weights to a single neuron
             # hidden = x, hactiv = y
-            hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + torch.matmul((self.w + torch.mul(self.alpha, hebb)),
-                            hidden.view(BATCHSIZE, HS, 1))).view(BATCHSIZE, HS)
+            hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + _recurrent(self, hidden, hebb)).view(BATCHSIZE, HS)
             activout = self.h2o(hactiv)  # Pure linear, raw scores - will be softmaxed later
             valueout = self.h2v(hactiv)
 
@@ -161,31 +172,13 @@ class Network(nn.Module):
             else:
                 raise ValueError("Which transformation for DAout ?")
             
-            # deltahebb has shape BS x HS x HS
+            # deltahebb (never explicitly computed) is the batched outer product of hactiv and hidden, shape BS x HS x HS
             # Each row of hebb contain the input weights to a neuron
-            deltahebb =  torch.bmm(hactiv.view(BATCHSIZE, HS, 1), hidden.view(BATCHSIZE, 1, HS)) # batched outer product...should it be other way round?
-
-
-            if self.params['addpw'] == 3: # Hard clamp, purely additive
-                # Note that we do the same for Hebb and Oja's rule
-                hebb1 = torch.clamp(hebb + DAout.view(BATCHSIZE, 1, 1) * deltahebb, min=-1.0, max=1.0)
-            elif self.params['addpw'] == 2:
-                # Note that there is no decay, even in the Hebb-rule case : additive only!
-                hebb1 = torch.clamp( hebb +  torch.clamp(DAout.view(BATCHSIZE, 1, 1) * deltahebb, min=0.0) * (1 - hebb) +  
-                        torch.clamp(DAout.view(BATCHSIZE, 1, 1)  * deltahebb, max=0.0) * (hebb + 1) , min=-1.0, max=1.0)
-            elif self.params['addpw'] == 1: # Purely additive. This will almost certainly diverge, don't use it! 
-                hebb1 = hebb + DAout.view(BATCHSIZE, 1, 1) * deltahebb
-
-            elif self.params['addpw'] == 0:    
-                # We do it the old way. Note that here, Hebb-rule is decaying.
-                # There is probably a way to make it more efficient 
-                # NOTE: THIS WILL GO AWRY if DAout is allowed to go outside [0,1]!
-                # Note 2: For Oja's rule, there is no difference between addpw 0 and addpw1
-                    hebb1 = (1 - DAout.view(BATCHSIZE,1,1)) * hebb + DAout.view(BATCHSIZE, 1, 1) * deltahebb
-            else:
+            # addpw = 3: hard clamp, purely additive ; 2: soft clamp ; 1: purely additive, this will almost certainly diverge, don't use it!
+            # addpw = 0: the old way, with a decay. NOTE: THIS WILL GO AWRY if DAout is allowed to go outside [0,1]!
+            if self.params['addpw'] not in hebbtrace.ADDPWMODES:
                 raise ValueError("Which additive form for plastic weights?")
-            
-            hebb = hebb1
+            hebb = hebbtrace.hebbupdate(hebb, hactiv, hidden, DAout.view(BATCHSIZE, 1, 1), hebbtrace.ADDPWMODES[self.params['addpw']], clipval=1.0, out=hebb if self.inplace else None)
             hidden = hactiv
 
         
@@ -193,8 +186,7 @@ class Network(nn.Module):
             
             # The rows of w and hebb are the inputs weights to a single neuron
             # hidden = x, hactiv = y
-            hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + torch.matmul((self.w + torch.mul(self.alpha, pw)),
-                            hidden.view(BATCHSIZE, HS, 1))).view(BATCHSIZE, HS)
+            hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + _recurrent(self, hidden, pw)).view(BATCHSIZE, HS)
             activout = self.h2o(hactiv)  # Pure linear, raw scores - will be softmaxed later
             valueout = self.h2v(hactiv)
 
@@ -227,16 +219,23 @@ class Network(nn.Module):
             if self.params['addpw'] == 3:
                 # Hard clamp
                 # From modplast/addpw=3: hebb1 = torch.clamp(hebb + DAout.view(BATCHSIZE, 1, 1) * deltahebb, min=-1.0, max=1.0)
-                deltapw = DAout.view(BATCHSIZE,1,1) * et
-                pw1 = torch.clamp(pw + deltapw, min=-1.0, max=1.0)
+                pw1 = hebbtrace.clipadd(pw, DAout.view(BATCHSIZE,1,1), et, 1.0, out=pw if self.inplace else None)
             elif self.params['addpw'] == 2:
-                deltapw = DAout.view(BATCHSIZE,1,1) * et
                 # This constrains the pw to stay within [-1, 1] (we could also do that by putting a tanh on top of it, but instead we want pw itself to remain within that range, to avoid large gradients and facilitate movement back to 0)
                 # The outer clamp is there for safety. In theory the expression within that clamp is "softly" constrained to stay within [-1, 1], but finite-size effects might throw it off.
-                pw1 = torch.clamp( pw +  torch.clamp(deltapw, min=0.0) * (1 - pw) +  torch.clamp(deltapw, max=0.0) * (pw + 1) , min=-.99999, max=.99999)
+                if self.inplace:
+                    # Same update, written as pw * (1 - |deltapw|) + deltapw, with the (now unused) effective-weight buffer as scratch
+                    onemabsdelta = torch.mul(et, DAout.view(BATCHSIZE,1,1), out=self.weff).abs_().neg_().add_(1.0)
+                    pw1 = pw.mul_(onemabsdelta).addcmul_(et, DAout.view(BATCHSIZE,1,1)).clamp_(min=-.99999, max=.99999)
+                else:
+                    deltapw = DAout.view(BATCHSIZE,1,1) * et
+                    pw1 = torch.clamp( pw +  torch.clamp(deltapw, min=0.0) * (1 - pw) +  torch.clamp(deltapw, max=0.0) * (pw + 1) , min=-.99999, max=.99999)
             elif self.params['addpw'] == 1: # Purely additive, tends to make the meta-learning diverge
-                deltapw = DAout.view(BATCHSIZE,1,1) * et
-                pw1 = pw + deltapw
+                if self.inplace:
+                    pw1 = pw.addcmul_(et, DAout.view(BATCHSIZE,1,1))
+                else:
+                    deltapw = DAout.view(BATCHSIZE,1,1) * et
+                    pw1 = pw + deltapw
             elif self.params['addpw'] == 0:    
                 # We do it the old way, with a decay term. 
                 # This will FAIL if DAout is allowed to go outside [0,1]
@@ -246,8 +245,8 @@ class Network(nn.Module):
             pw = pw1
 
             # Updating the eligibility trace - always a simple decay term. 
-            deltaet =  torch.bmm(hactiv.view(BATCHSIZE, HS, 1), hidden.view(BATCHSIZE, 1, HS)) # batched outer product...should it be other way round?
-            et = (1 - self.etaet) * et + self.etaet *  deltaet
+            # deltaet is the batched outer product of hactiv and hidden: et = (1 - self.etaet) * et + self.etaet *  deltaet
+            et = hebbtrace.hebbupdate(et, hactiv, hidden, self.etaet, 'decay', out=et if self.inplace else None)
             
             hidden = hactiv
 
@@ -261,14 +260,184 @@ class Network(nn.Module):
 
 
     def initialZeroHebb(self):
-        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).cuda()
+        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
     def initialZeroPlasticWeights(self):
-        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).cuda()
+        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
 
     def initialZeroState(self):
         BATCHSIZE = self.params['bs']
-        return Variable(torch.zeros(BATCHSIZE, self.params['hs']), requires_grad=False ).cuda()
+        return Variable(torch.zeros(BATCHSIZE, self.params['hs']), requires_grad=False ).to(device=self.device, dtype=self.dtype)
+
+    def initialStatePool(self):
+        # Preallocated, double-buffered state for forward_pool() (see statepool.py)
+        BATCHSIZE, HS = self.params['bs'], self.params['hs']
+        shapes = {'hidden': (BATCHSIZE, HS)}
+        if self.type in ('plastic', 'modplast'):
+            shapes['hebb'] = (BATCHSIZE, HS, HS)
+        elif self.type == 'modul':
+            shapes['et'] = (BATCHSIZE, HS, HS)
+            shapes['pw'] = (BATCHSIZE, HS, HS)
+        return statepool.StatePool(shapes, {'weff': (BATCHSIZE, HS, HS), 'recurrent': (BATCHSIZE, HS)}, device=self.device, dtype=self.dtype)
+
+    def forward_pool(self, inputs, pool):
+        # Same as forward(), for rollouts without gradients (e.g. the actors of actorlearner.py): the state is
+        # read from pool, and the new state is written into its other set of buffers, without allocating any
+        # BS x HS x HS tensor. Returns the raw action scores and the value prediction.
+        if torch.is_grad_enabled():
+            raise RuntimeError("forward_pool() is only for rollouts without gradients (use torch.no_grad())")
+        BATCHSIZE, HS = self.params['bs'], self.params['hs']
+        old, new, tmp = pool.state(), pool.nextstate(), pool.scratch
+        hidden, hactiv, recurrent = old['hidden'], new['hidden'], tmp['recurrent']
+
+        # The rows of w and hebb (or pw) are the input weights to a single neuron
+        if self.type == 'rnn':
+            torch.mm(hidden, self.w.t(), out=recurrent)
+        else:
+            plastic = old['pw'] if self.type == 'modul' else old['hebb']
+            weff = torch.mul(self.alpha, plastic, out=tmp['weff']).add_(self.w)
+            torch.bmm(weff, hidden.view(BATCHSIZE, HS, 1), out=recurrent.view(BATCHSIZE, HS, 1))
+        torch.addmm(self.i2h.bias, inputs, self.i2h.weight.t(), out=hactiv).add_(recurrent).tanh_()
+        activout = self.h2o(hactiv)  # Pure linear, raw scores - will be softmaxed later
+        valueout = self.h2v(hactiv)
+
+        if self.type in ('modplast', 'modul'):
+            if self.params['da'] == 'tanh':
+                DAout = F.tanh(self.h2DA(hactiv))
+            elif self.params['da'] == 'sig':
+                DAout = F.sigmoid(self.h2DA(hactiv))
+            elif self.params['da'] == 'lin':
+                DAout =  self.h2DA(hactiv)
+            else:
+                raise ValueError("Which transformation for DAout ?")
+        if self.params['addpw'] not in hebbtrace.ADDPWMODES:
+            raise ValueError("Which additive form for plastic weights?")
+        mode = hebbtrace.ADDPWMODES[self.params['addpw']]
+
+        if self.type == 'plastic':
+            hebbtrace.hebbupdate(old['hebb'], hactiv, hidden, self.eta, mode, clipval=1.0, out=new['hebb'])
+        elif self.type == 'modplast':
+            hebbtrace.hebbupdate(old['hebb'], hactiv, hidden, DAout.view(BATCHSIZE, 1, 1), mode, clipval=1.0, out=new['hebb'])
+        elif self.type == 'modul':
+            # Neuromodulated incorporation of the eligibility trace into the plastic weights (as in forward())
+            DA, pw, et = DAout.view(BATCHSIZE, 1, 1), old['pw'], old['et']
+            if self.params['addpw'] == 3:
+                hebbtrace.clipadd(pw, DA, et, 1.0, out=new['pw'])
+            elif self.params['addpw'] == 2:
+                deltapw = torch.mul(et, DA, out=tmp['weff'])  # The effective weights are no longer needed
+                torch.add(pw, deltapw, out=new['pw']).addcmul_(pw, deltapw.abs_(), value=-1).clamp_(min=-.99999, max=.99999)
+            elif self.params['addpw'] == 1:
+                torch.addcmul(pw, DA, et, out=new['pw'])
+            else:
+                raise ValueError("addpw=0 is not supported for 'modul' networks")
+            hebbtrace.hebbupdate(et, hactiv, hidden, self.etaet, 'decay', out=new['et'])
+
+        pool.swap()
+        return activout, valueout
+
+
+
+def savefiles(suffix, net, params, all_grad_norms, all_total_rewards, all_losses_objective):
+    print("Saving files...")
+    losslast100 = np.mean(all_losses_objective[-100:])
+    print("Average loss over the last 100 episodes:", losslast100)
+    print("Saving local files...")
+    with open('grad_'+suffix+'.txt', 'w') as thefile:
+        for item in all_grad_norms[::10]:
+                thefile.write("%s\n" % item)
+    with open('loss_'+suffix+'.txt', 'w') as thefile:
+        for item in all_total_rewards[::10]:
+                thefile.write("%s\n" % item)
+    torch.save(net.state_dict(), 'torchmodel_'+suffix+'.dat')
+    with open('params_'+suffix+'.dat', 'wb') as fo:
+        pickle.dump(params, fo)
+    print("Done!")
+    # Uber-only stuff:
+    if os.path.isdir('/mnt/share/tmiconi'):
+        print("Transferring to NFS storage...")
+        for fn in ['params_'+suffix+'.dat', 'loss_'+suffix+'.txt', 'torchmodel_'+suffix+'.dat']:
+            result = os.system(
+                'cp {} {}'.format(fn, '/mnt/share/tmiconi/modulmaze/'+fn))
+        print("Done!")
+
+
+def trainasync(params, net, optimizer, lab, suffix, device):
+    # Asynchronous actor/learner training (see actorlearner.py): the episodes are run by actor processes with a
+    # (possibly stale) snapshot of the network, and the learner re-runs each recorded episode with gradients.
+    # The policy gradient and value targets are computed with V-trace.
+    BATCHSIZE = params['bs']
+    sharednet = Network(params, device=torch.device('cpu'))
+    sharednet.load_state_dict(net.state_dict())
+    pool = actorlearner.ActorPool(sharednet, params, lab, RFSIZE, ADDINPUT, NBACTIONS)
+    print("Started", params['actors'], "actor processes")
+
+    all_grad_norms = []
+    all_losses_objective = []
+    all_total_rewards = []
+    all_lags = []
+    lossbetweensaves = 0
+    nowtime = time.time()
+
+    print("Starting episodes!")
+
+    for numiter in range(params['nbiter']):
+
+        lag, inputs, actions, blogprobs, rewards = pool.get(device)
+
+        optimizer.zero_grad()
+        hidden = net.initialZeroState()
+        hebb = net.initialZeroHebb()
+        et = net.initialZeroHebb() # Eligibility Trace is identical to Hebbian Trace in shape
+        pw = net.initialZeroPlasticWeights()
+        ys = []
+        values = []
+        for numstep in range(params['eplen']):
+            y, v, hidden, hebb, et, pw = net(inputs[numstep], hidden, hebb, et, pw)
+            ys.append(y)
+            values.append(v)
+        ys = F.softmax(torch.stack(ys), dim=2)
+        values = torch.stack(values)[:, :, 0]
+        logprobs = torch.distributions.Categorical(ys).log_prob(actions)
+
+        # Unlike the synchronous loop, each agent in the batch uses its own value prediction as baseline
+        vs, advantages = actorlearner.vtrace(blogprobs, logprobs, rewards, values, params['gr'], params['rhobar'], params['cbar'])
+        lossv = (vs - values).pow(2).sum() / BATCHSIZE
+        loss = (params['bent'] * ys.pow(2).sum() - (logprobs * advantages).sum()) / BATCHSIZE
+        loss += params['blossv'] * lossv
+        loss /= params['eplen']
+
+        loss.backward()
+        all_grad_norms.append(torch.nn.utils.clip_grad_norm(net.parameters(), params['gc']))
+        if numiter > 100:  # Burn-in period for meanrewards
+            optimizer.step()
+            pool.publish(net)
+
+        lossnum = float(loss)
+        lossbetweensaves += lossnum
+        all_losses_objective.append(lossnum)
+        all_total_rewards.append(rewards.sum(0).cpu().numpy().mean())
+        all_lags.append(lag)
+
+        if (numiter+1) % params['pe'] == 0:
+
+            print(numiter, "====")
+            print("Mean loss: ", lossbetweensaves / params['pe'])
+            lossbetweensaves = 0
+            print("Mean reward (across batch and last", params['pe'], "eps.): ", np.sum(all_total_rewards[-params['pe']:])/ params['pe'])
+            print("Mean policy lag: ", np.mean(all_lags[-params['pe']:]), " - trajectories dropped so far (too stale): ", pool.nbdropped)
+            previoustime = nowtime
+            nowtime = time.time()
+            print("Time spent on last", params['pe'], "iters: ", nowtime - previoustime)
+            if params['type'] == 'plastic' or params['type'] == 'lstmplastic':
+                print("ETA: ", net.eta.data.cpu().numpy(), "alpha[0,1]: ", net.alpha.data.cpu().numpy()[0,1], "w[0,1]: ", net.w.data.cpu().numpy()[0,1] )
+            elif params['type'] == 'modul':
+                print("etaet: ", float(net.etaet), " mean-abs pw: ", torch.mean(torch.abs(pw.data)))
+            elif params['type'] == 'rnn':
+                print("w[0,1]: ", net.w.data.cpu().numpy()[0,1] )
 
+        if (numiter+1) % params['save_every'] == 0:
+            savefiles(suffix, net, params, all_grad_norms, all_total_rewards, all_losses_objective)
+
+    pool.close()
 
 
 def train(paramdict):
@@ -282,15 +451,23 @@ def train(paramdict):
     print("Passed params: ", params)
     print(platform.uname())
     #params['nbsteps'] = params['nbshots'] * ((params['prestime'] + params['interpresdelay']) * params['nbclasses']) + params['prestimetest']  # Total number of steps per episode
-    suffix = "btchFixmod_"+"".join([str(x)+"_" if pair[0] is not 'nbsteps' and pair[0] is not 'rngseed' and pair[0] is not 'save_every' and pair[0] is not 'test_every' and pair[0] is not 'pe' else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
+    suffix = "btchFixmod_"+"".join([str(x)+"_" if pair[0] not in ('nbsteps', 'rngseed', 'save_every', 'test_every', 'pe', 'ckpt', 'ckptmem', 'jit', 'actors', 'maxstale', 'rhobar', 'cbar', 'lam') else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1]   # Turning the parameters into a nice suffix for filenames
+    if params['actors'] > 0:
+        # Asynchronous V-trace runs get their own files; synchronous runs keep the same suffix as before
+        suffix += "".join(["_"+k+"_"+str(params[k]) for k in ('actors', 'cbar', 'maxstale', 'rhobar')])
+    if params['lam'] != 1.0:
+        suffix += "_lam_" + str(params['lam'])   # GAE runs get their own files; lambda = 1.0 keeps the old suffix
+    suffix += "_rngseed_" + str(params['rngseed'])
 
     # Initialize random seeds (first two redundant?)
     print("Setting random seeds")
     np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
     #print(click.get_current_context().params)
 
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
     print("Initializing network")
-    net = Network(params)
+    net = Network(params, device=device)
     print ("Shape of all optimized parameters:", [x.size() for x in net.parameters()])
     allsizes = [torch.numel(x.data.cpu()) for x in net.parameters()]
     print ("Size (numel) of all optimized elements:", allsizes)
@@ -302,22 +479,32 @@ def train(paramdict):
 
     BATCHSIZE = params['bs']
 
+    # Checkpointed BPTT: only store the recurrent state every SEGLEN steps, and recompute the segments during the backward pass.
+    # The segment length is chosen from the memory budget, counting 3 BS x HS x HS tensors (hebb, et, pw) per saved state,
+    # and about 6 such tensors for the graph of each time step.
+    CKPT = params.get('ckpt', 0)
+    if CKPT:
+        HSQ = 4 * BATCHSIZE * params['hs'] * params['hs']
+        SEGLEN = bpttckpt.chooseseglen(params['eplen'], 3 * HSQ, 6 * HSQ, params['ckptmem'] * 2**30)
+        print("Checkpointed BPTT, with segments of", SEGLEN, "steps")
+
+    # Optionally, run the network through a TorchScript cell that shares its parameters (see plasticcell.py)
+    JIT = params.get('jit', 0)
+    if JIT:
+        cell = torch.jit.script(plasticcell.PlasticCell(net, params['type'], params['da'], params['addpw']))
+
     LABSIZE = params['msize'] 
-    lab = np.ones((LABSIZE, LABSIZE))
     CTR = LABSIZE // 2 
 
+    # Grid maze, and the batch of environments that simulates all the agents at once (see mazeenv.py)
+    lab = mazeenv.gridmaze(LABSIZE)
+    env = mazeenv.MazeEnv(lab, BATCHSIZE, params['eplen'], params['rew'], params['wp'], RFSIZE, ADDINPUT, NBACTIONS)
 
-    # Grid maze
-    lab[1:LABSIZE-1, 1:LABSIZE-1].fill(0)
-    for row in range(1, LABSIZE - 1):
-        for col in range(1, LABSIZE - 1):
-            if row % 2 == 0 and col % 2 == 0:
-                lab[row, col] = 1
-    # Not strictly necessary, but cleaner since we start the agent at the
-    # center for each episode; may help loclization in some maze sizes
-    # (including 13 and 9, but not 11) by introducing a detectable irregularity
-    # in the center:
-    lab[CTR,CTR] = 0 
+    # Optionally, run the episodes asynchronously in separate actor processes (see actorlearner.py)
+    if params.get('actors', 0):
+        if CKPT or JIT:
+            raise ValueError("Asynchronous actors (--actors) can't be combined with --ckpt or --jit")
+        return trainasync(params, net, optimizer, lab, suffix, device)
 
 
 
@@ -351,20 +538,8 @@ def train(paramdict):
 
         # Select the reward location for this episode - not on a wall!
         # And not on the center either! (though not sure how useful that restriction is...)
-        # We always start the episode from the center (when hitting reward, we may teleport either to center or to a random location depending on params['rsp'])
-        posr = {}; posc = {}
-        rposr = {}; rposc = {}
-        for nb in range(BATCHSIZE):
-            # Note: it doesn't matter if the reward is on the center (see below). All we need is not to put it on a wall or pillar (lab=1)
-            myrposr = 0; myrposc = 0
-            while lab[myrposr, myrposc] == 1 or (myrposr == CTR and myrposc == CTR):
-                myrposr = np.random.randint(1, LABSIZE - 1)
-                myrposc = np.random.randint(1, LABSIZE - 1)
-            rposr[nb] = myrposr; rposc[nb] = myrposc
-            #print("Reward pos:", rposr, rposc)
-            # Agent always starts an episode from the center
-            posc[nb] = CTR
-            posr[nb] = CTR
+        # We always start the episode from the center (when hitting reward, we teleport to a random location)
+        inputs = env.reset()
 
         optimizer.zero_grad()
         loss = 0
@@ -384,71 +559,39 @@ def train(paramdict):
         dist = 0
         numactionschosen = np.zeros(BATCHSIZE, dtype='int32')
 
+        # In checkpointed mode, the episode itself runs without gradients; we
+        # store what we need to re-run it segment by segment afterwards.
+        ckptstates = []; ckptinputs = []; ckptactions = []
+        torch.set_grad_enabled(not CKPT)
+
         for numstep in range(params['eplen']):
 
 
 
 
-            inputs = np.zeros((BATCHSIZE, TOTALNBINPUTS), dtype='float32') 
-        
-            labg = lab.copy()
-            for nb in range(BATCHSIZE):
-                inputs[nb, 0:RFSIZE * RFSIZE] = labg[posr[nb] - RFSIZE//2:posr[nb] + RFSIZE//2 +1, posc[nb] - RFSIZE //2:posc[nb] + RFSIZE//2 +1].flatten() * 1.0
-                
-                # Previous chosen action
-                inputs[nb, RFSIZE * RFSIZE +1] = 1.0 # Bias neuron
-                inputs[nb, RFSIZE * RFSIZE +2] = numstep / params['eplen']
-                inputs[nb, RFSIZE * RFSIZE +3] = 1.0 * reward[nb]
-                inputs[nb, RFSIZE * RFSIZE + ADDINPUT + numactionschosen[nb]] = 1
-            
-            inputsC = torch.from_numpy(inputs).cuda()
+            inputsC = torch.from_numpy(inputs).to(device)
+            if CKPT:
+                if numstep % SEGLEN == 0:
+                    ckptstates.append((hidden, hebb, et, pw))
+                ckptinputs.append(inputsC)
             
             ##### Running the network
-            y, v, hidden, hebb, et, pw = net(Variable(inputsC, requires_grad=False), hidden, hebb, et, pw)  # y  should output raw scores, not probas
+            if JIT:
+                y, v, DAout, (hidden, hebb, et, pw) = cell(inputsC, [hidden, hebb, et, pw])
+            else:
+                y, v, hidden, hebb, et, pw = net(Variable(inputsC, requires_grad=False), hidden, hebb, et, pw)  # y  should output raw scores, not probas
 
 
             y = F.softmax(y, dim=1)     # Now y is conveted to "proba-like" quantities
             distrib = torch.distributions.Categorical(y)
             actionschosen = distrib.sample()  
             logprobs.append(distrib.log_prob(actionschosen))
+            if CKPT:
+                ckptactions.append(actionschosen)
             numactionschosen = actionschosen.data.cpu().numpy()    # Turn to scalar
-            reward = np.zeros(BATCHSIZE, dtype='float32')
-
-
-            for nb in range(BATCHSIZE):
-                myreward = 0
-                numactionchosen = numactionschosen[nb]
-
-                tgtposc = posc[nb]
-                tgtposr = posr[nb]
-                if numactionchosen == 0:  # Up
-                    tgtposr -= 1
-                elif numactionchosen == 1:  # Down
-                    tgtposr += 1
-                elif numactionchosen == 2:  # Left
-                    tgtposc -= 1
-                elif numactionchosen == 3:  # Right
-                    tgtposc += 1
-                else:
-                    raise ValueError("Wrong Action")
-                
-                reward[nb] = 0.0  # The reward for this step
-                if lab[tgtposr][tgtposc] == 1:
-                    reward[nb] -= params['wp']
-                else:
-                    #dist += 1
-                    posc[nb] = tgtposc
-                    posr[nb] = tgtposr
-
-                # Did we hit the reward location ? Increase reward and teleport!
-                # Note that it doesn't matter if we teleport onto the reward, since reward hitting is only evaluated after the (obligatory) move
-                if rposr[nb] == posr[nb] and rposc[nb] == posc[nb]:
-                    reward[nb] += params['rew']
-                    posr[nb]= np.random.randint(1, LABSIZE - 1)
-                    posc[nb] = np.random.randint(1, LABSIZE - 1)
-                    while lab[posr[nb], posc[nb]] == 1 or (rposr[nb] == posr[nb] and rposc[nb] == posc[nb]):
-                        posr[nb] = np.random.randint(1, LABSIZE - 1)
-                        posc[nb] = np.random.randint(1, LABSIZE - 1)
+
+            # Move all the agents; wall penalties, rewards and teleports are computed in the environment (see mazeenv.py)
+            reward, nextinputs = env.step(numactionschosen)
 
             rewards.append(reward)
             vs.append(v)
@@ -467,19 +610,22 @@ def train(paramdict):
                 print("Step ", numstep, " Inputs (to 1st in batch): ", inputs[0, :TOTALNBINPUTS], " - Outputs(1st in batch): ", y[0].data.cpu().numpy(), " - action chosen(1st in batch): ", numactionschosen[0],
                         " - mean abs pw: ", np.mean(np.abs(pw.data.cpu().numpy())), " -Reward (this step, 1st in batch): ", reward[0])
 
+            inputs = nextinputs
+
 
 
         # Episode is done, now let's do the actual computations
 
 
-        R = Variable(torch.zeros(BATCHSIZE).cuda(), requires_grad=False)
+        # (In checkpointed mode, this computes the value of the loss, but not its gradient)
+        # Returns and advantages for the whole episode at once (see discount.py), with a single host-to-device copy of the rewards
         gammaR = params['gr']
-        for numstepb in reversed(range(params['eplen'])) :
-            R = gammaR * R + Variable(torch.from_numpy(rewards[numstepb]).cuda(), requires_grad=False)
-            ctrR = R - vs[numstepb][0]
-            lossv += ctrR.pow(2).sum() / BATCHSIZE
-            loss -= (logprobs[numstepb] * ctrR.detach()).sum() / BATCHSIZE  # Need to check if detach() is OK
-            #pdb.set_trace()
+        rewardsT = torch.from_numpy(np.stack(rewards)).to(device)
+        Rs = discount.returns(rewardsT, gammaR)
+        values = torch.stack(vs)[:, 0, :]  # The value prediction of the first element in the batch is used as baseline for all of them
+        advs = discount.advantages(rewardsT, values, gammaR, params['lam'])
+        lossv = (Rs - values).pow(2).sum() / BATCHSIZE
+        loss -= (torch.stack(logprobs) * advs).sum() / BATCHSIZE
 
 
 
@@ -536,7 +682,34 @@ def train(paramdict):
 
         #for p in net.parameters():
         #    p.grad.data.clamp_(-params['clp'], params['clp'])
-        loss.backward()
+        if CKPT:
+            torch.set_grad_enabled(True)
+
+            # Re-runs steps start to end-1 with gradients, and returns their contribution to the loss (computed as above)
+            def runsegment(start, end, state):
+                if JIT:
+                    # The whole segment runs in a single scripted loop, and the loss is computed for all its steps at once
+                    ys, values, DAouts, state = cell.scan(torch.stack(ckptinputs[start:end]), list(state))
+                    ys = F.softmax(ys, dim=2)
+                    logprob = torch.distributions.Categorical(ys).log_prob(torch.stack(ckptactions[start:end]))
+                    ctrR = Rs[start:end] - values[:, 0, :]
+                    segloss = (params['bent'] * ys.pow(2).sum() - (logprob * advs[start:end]).sum() + params['blossv'] * ctrR.pow(2).sum()) / BATCHSIZE
+                    return tuple(state), segloss / params['eplen']
+                hidden, hebb, et, pw = state
+                segloss = 0
+                for numstep in range(start, end):
+                    y, v, hidden, hebb, et, pw = net(ckptinputs[numstep], hidden, hebb, et, pw)
+                    y = F.softmax(y, dim=1)
+                    logprob = torch.distributions.Categorical(y).log_prob(ckptactions[numstep])
+                    ctrR = Rs[numstep] - v[0]
+                    segloss += params['bent'] * y.pow(2).sum() / BATCHSIZE
+                    segloss -= (logprob * advs[numstep]).sum() / BATCHSIZE
+                    segloss += params['blossv'] * ctrR.pow(2).sum() / BATCHSIZE
+                return (hidden, hebb, et, pw), segloss / params['eplen']
+
+            bpttckpt.backwardsegments(runsegment, ckptstates, params['eplen'], SEGLEN)
+        else:
+            loss.backward()
         all_grad_norms.append(torch.nn.utils.clip_grad_norm(net.parameters(), params['gc']))
         if numiter > 100:  # Burn-in period for meanrewards
             optimizer.step()
@@ -566,27 +739,7 @@ def train(paramdict):
                 print("w[0,1]: ", net.w.data.cpu().numpy()[0,1] )
 
         if (numiter+1) % params['save_every'] == 0:
-            print("Saving files...")
-            losslast100 = np.mean(all_losses_objective[-100:])
-            print("Average loss over the last 100 episodes:", losslast100)
-            print("Saving local files...")
-            with open('grad_'+suffix+'.txt', 'w') as thefile:
-                for item in all_grad_norms[::10]:
-                        thefile.write("%s\n" % item)
-            with open('loss_'+suffix+'.txt', 'w') as thefile:
-                for item in all_total_rewards[::10]:
-                        thefile.write("%s\n" % item)
-            torch.save(net.state_dict(), 'torchmodel_'+suffix+'.dat')
-            with open('params_'+suffix+'.dat', 'wb') as fo:
-                pickle.dump(params, fo)
-            print("Done!")
-            # Uber-only stuff:
-            if os.path.isdir('/mnt/share/tmiconi'):
-                print("Transferring to NFS storage...")
-                for fn in ['params_'+suffix+'.dat', 'loss_'+suffix+'.txt', 'torchmodel_'+suffix+'.dat']:
-                    result = os.system(
-                        'cp {} {}'.format(fn, '/mnt/share/tmiconi/modulmaze/'+fn))
-                print("Done!")
+            savefiles(suffix, net, params, all_grad_norms, all_total_rewards, all_losses_objective)
 
 
 
@@ -636,6 +789,14 @@ if __name__ == "__main__":
     parser.add_argument("--nbiter", type=int, help="number of learning cycles", default=1000000)
     parser.add_argument("--save_every", type=int, help="number of cycles between successive save points", default=1000)
     parser.add_argument("--pe", type=int, help="number of cycles between successive printing of information", default=100)
+    parser.add_argument("--ckpt", type=int, help="checkpointed BPTT: store the recurrent state only every few steps and recompute during the backward pass (1) or not (0) ?", default=0)
+    parser.add_argument("--ckptmem", type=float, help="memory budget (in GB) for checkpointed BPTT, used to choose the length of the recomputed segments", default=16.0)
+    parser.add_argument("--jit", type=int, help="run the network through a TorchScript cell, with a scripted loop over segments in checkpointed mode (1) or not (0) ?", default=0)
+    parser.add_argument("--lam", type=float, help="lambda of generalized advantage estimation (1.0: plain discounted returns minus value, as in standard A2C)", default=1.0)
+    parser.add_argument("--actors", type=int, help="number of asynchronous actor processes running the episodes, with V-trace correction in the learner (0: synchronous A2C)", default=0)
+    parser.add_argument("--maxstale", type=int, help="with --actors: maximum lag (in optimizer steps) of the policy snapshot that produced a trajectory; older trajectories are discarded", default=4)
+    parser.add_argument("--rhobar", type=float, help="with --actors: truncation of the V-trace importance weights for the policy gradient and value targets", default=1.0)
+    parser.add_argument("--cbar", type=float, help="with --actors: truncation of the V-trace trace-cutting coefficients", default=1.0)
     #parser.add_argument("--", type=int, help="", default=1e-4)
     args = parser.parse_args(); argvars = vars(args); argdict =  { k : argvars[k] for k in argvars if argvars[k] != None }
     #train()
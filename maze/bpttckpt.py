@@ -0,0 +1,78 @@
+# Backpropamine: differentiable neuromdulated plasticity.
+#
+# Copyright (c) 2018-2019 Uber Technologies, Inc.
+#
+# Licensed under the Uber Non-Commercial License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at the root directory of this project.
+#
+# See the License file in this repository for the specific language governing
+# permissions and limitations under the License.
+
+
+# Checkpointed backpropagation through time for whole-episode unrolls.
+#
+# Normally, every time step of an episode keeps its Hebbian traces, eligibility
+# traces and plastic weights (BS x HS x HS each) alive until loss.backward()
+# is called at the end of the episode, so that memory grows as eplen x BS x HS^2.
+#
+# In checkpointed mode, the episode is first run without building any graph,
+# keeping only the recurrent state (hidden state and traces) at the start of
+# each segment of 'seglen' steps, together with the network inputs and the
+# actions taken. Gradients are then computed segment by segment, from the last
+# to the first: each segment is re-run with gradients from its saved initial
+# state, and backpropagated using the gradient of the loss with respect to its
+# final state (computed when processing the following segment). Only one
+# segment's graph is in memory at any time.
+
+import math
+
+import torch
+
+
+def chooseseglen(eplen, statebytes, stepbytes, budget):
+    # Returns the length of the segments, given the size (in bytes) of one
+    # saved recurrent state, the memory used by the graph of one time step,
+    # and the total memory budget (in bytes).
+    # We pick the longest segments that fit the budget (fewer saved states,
+    # fewer and larger recomputations); if none fits, we use the length that
+    # minimizes memory usage (about sqrt(eplen)) and print a warning.
+    for seglen in range(eplen, 0, -1):
+        if math.ceil(eplen / seglen) * statebytes + seglen * stepbytes <= budget:
+            return seglen
+    seglen = min(range(1, eplen + 1), key=lambda k: math.ceil(eplen / k) * statebytes + k * stepbytes)
+    print("Warning: checkpointed BPTT cannot fit the memory budget of", budget / 2**30, "GB, using segments of", seglen, "steps anyway")
+    return seglen
+
+
+def backwardsegments(runsegment, states, eplen, seglen):
+    # Backpropagates through the whole episode, one segment at a time.
+    #
+    # runsegment(start, end, state) must re-run the network from time step
+    # 'start' (included) to 'end' (excluded), starting from recurrent state
+    # 'state' (a tuple of tensors), with the same inputs and actions as during
+    # the episode; it returns the recurrent state after step end-1 (a tuple
+    # with the same structure) and the contribution of these steps to the
+    # loss (a scalar tensor).
+    # states[n] is the recurrent state at the start of step n * seglen, as
+    # saved during the episode (without gradients).
+    #
+    # Gradients are accumulated into the parameters, as with loss.backward().
+    if len(states) != math.ceil(eplen / seglen):
+        raise ValueError("Need exactly one saved state per segment")
+    gradstate = None
+    for numseg in reversed(range(len(states))):
+        start = numseg * seglen
+        end = min(eplen, start + seglen)
+        # The initial state of the episode never needs gradients
+        statein = tuple(x.detach().requires_grad_(numseg > 0) for x in states[numseg])
+        with torch.enable_grad():
+            stateout, segloss = runsegment(start, end, statein)
+        tensors, grads = [segloss], [torch.ones_like(segloss)]
+        if gradstate is not None:
+            for x, g in zip(stateout, gradstate):
+                if g is not None and x.requires_grad:
+                    tensors.append(x); grads.append(g)
+        torch.autograd.backward(tensors, grads)
+        gradstate = tuple(x.grad for x in statein)
+        del stateout, segloss, tensors, grads
@@ -0,0 +1,45 @@
+# Backpropamine: differentiable neuromdulated plasticity.
+#
+# Copyright (c) 2018-2019 Uber Technologies, Inc.
+#
+# Licensed under the Uber Non-Commercial License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at the root directory of this project.
+#
+# See the License file in this repository for the specific language governing
+# permissions and limitations under the License.
+
+
+# Discounted returns and advantages for the A2C losses, over a whole episode at once.
+#
+# Rewards and values are eplen x BS tensors (time first). The reverse
+# discounted sum R[t] = r[t] + gamma * R[t+1] is computed as a single product
+# with an upper-triangular eplen x eplen matrix of powers of gamma, rather than
+# with a reversed Python loop over time steps (the matrix product also avoids
+# the loss of precision of cumsum-based tricks for long episodes). The episode
+# ends after the last step, so the value after it is 0.
+
+import torch
+
+
+def discountmatrix(n, gamma, device=None, dtype=torch.float32):
+    # D[t, k] = gamma^(k-t) for k >= t, 0 otherwise; so that D @ x is the reverse discounted sum of x
+    steps = torch.arange(n, device=device, dtype=dtype)
+    expo = steps.view(1, n) - steps.view(n, 1)
+    return torch.where(expo >= 0, torch.pow(gamma, torch.clamp(expo, min=0)), torch.zeros_like(expo))
+
+
+def returns(rewards, gamma):
+    # Discounted returns R[t] = sum_k gamma^k r[t+k], for eplen x BS rewards
+    return torch.matmul(discountmatrix(rewards.size(0), gamma, rewards.device, rewards.dtype), rewards)
+
+
+def advantages(rewards, values, gamma, lam=1.0):
+    # Generalized advantage estimation (Schulman et al. 2016), without gradients through the values.
+    # values must broadcast against the eplen x BS rewards. With lam = 1, this is simply returns(rewards, gamma) - values.
+    values = values.detach().expand_as(rewards)
+    if lam == 1.0:
+        return returns(rewards, gamma) - values
+    nextvalues = torch.cat((values[1:], torch.zeros_like(values[:1])))
+    deltas = rewards + gamma * nextvalues - values
+    return returns(deltas, gamma * lam)
@@ -0,0 +1,64 @@
+# Backpropamine: differentiable neuromdulated plasticity.
+#
+# Copyright (c) 2018-2019 Uber Technologies, Inc.
+#
+# Licensed under the Uber Non-Commercial License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at the root directory of this project.
+#
+# See the License file in this repository for the specific language governing
+# permissions and limitations under the License.
+
+
+# Inference-only runtime for the test and animation scripts.
+#
+# The scripts that replay trained networks don't need gradients. load() (or
+# inference(), for a network that is already loaded) freezes the parameters
+# and switches every plastic module of the network to its in-place update
+# path: the Hebbian traces, eligibility traces and plastic weights returned by
+# initialZeroHebb() / initialZeroPlasticWeights() are then updated in place at
+# each step (see hebbtrace.py), instead of being reallocated. Run the episodes
+# under torch.no_grad() (or after torch.set_grad_enabled(False)).
+#
+# Since the traces are updated in place, keeping a reference to them does not
+# keep their value at a given step: internals that must be kept (modulator
+# output, traces...) should be copied into a Recorder, which preallocates one
+# buffer of shape nbsteps x (shape of the value) for each of them.
+
+import torch
+
+
+def inference(net):
+    # Prepares a loaded network for evaluation (see above), and returns it
+    net.eval()
+    for p in net.parameters():
+        p.requires_grad_(False)
+    for module in net.modules():
+        if hasattr(module, 'inplace'):
+            module.inplace = True
+    return net
+
+
+def load(net, filename, device=None):
+    # Loads a checkpoint saved by the training scripts (a state dict) into net, and prepares it for evaluation
+    net.load_state_dict(torch.load(filename, map_location=device))
+    return inference(net)
+
+
+class Recorder:
+
+    def __init__(self, nbsteps, shapes, device=None, dtype=torch.float32):
+        # shapes: dictionary of the names and shapes (at each step) of the recorded values, e.g. {'DA': (BS, 1)}
+        self.buffers = {name: torch.zeros((nbsteps,) + tuple(shape), device=device, dtype=dtype) for name, shape in shapes.items()}
+
+    def record(self, numstep, **values):
+        # e.g. recorder.record(numstep, DA=DAout, hebb=hebb)
+        for name, value in values.items():
+            self.buffers[name][numstep].copy_(value)
+
+    def __getitem__(self, name):
+        return self.buffers[name]
+
+    def numpy(self):
+        # All the recorded values, as a dictionary of numpy arrays (a single device-to-host copy per buffer)
+        return {name: buf.cpu().numpy() for name, buf in self.buffers.items()}
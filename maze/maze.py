@@ -39,6 +39,7 @@ import pickle
 import time
 import os
 import platform
+import mazeenv
 
 # Uber-only:
 import OpusHdfsCopy
@@ -63,12 +64,10 @@ RFSIZE = 3 # Receptive field size
 TOTALNBINPUTS =  RFSIZE * RFSIZE + ADDINPUT + NBACTIONS
  
 
-##ttype = torch.FloatTensor;    # For CPU
-ttype = torch.cuda.FloatTensor; # Gor GPU
 
 
 class Network(nn.Module):
-    def __init__(self, params):
+    def __init__(self, params, device=None, dtype=torch.float32):
         super(Network, self).__init__()
         self.rule = params['rule']
         self.type = params['type']
@@ -80,46 +79,46 @@ class Network(nn.Module):
         else:
             raise ValueError('Must choose an activ function')
         if params['type'] == 'lstm':
-            self.lstm = torch.nn.LSTM(TOTALNBINPUTS, params['hiddensize']).cuda()
+            self.lstm = torch.nn.LSTM(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
         elif params['type'] == 'rnn':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).cuda(), requires_grad=True)
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).to(device=device, dtype=dtype), requires_grad=True)
         elif params['type'] == 'homo':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).cuda(), requires_grad=True)
-            self.alpha = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True) # Homogenous plasticity: everyone has the same alpha
-            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)   # Everyone has the same eta
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True) # Homogenous plasticity: everyone has the same alpha
+            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)   # Everyone has the same eta
         elif params['type'] == 'plastic':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).cuda(), requires_grad=True)
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).cuda(), requires_grad=True)
-            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
 
 
         elif params['type'] == 'lstmplastic':   # LSTM with plastic connections. HIGHLY EXPERIMENTAL, NOT DEBUGGED - see awd-lstm-lm directory at https://github.com/uber-research/backpropamine instead.
-            self.h2f = torch.nn.Linear(params['hiddensize'], params['hiddensize']).cuda()
-            self.h2i = torch.nn.Linear(params['hiddensize'], params['hiddensize']).cuda()
-            self.h2opt = torch.nn.Linear(params['hiddensize'], params['hiddensize']).cuda()
+            self.h2f = torch.nn.Linear(params['hiddensize'], params['hiddensize']).to(device=device, dtype=dtype)
+            self.h2i = torch.nn.Linear(params['hiddensize'], params['hiddensize']).to(device=device, dtype=dtype)
+            self.h2opt = torch.nn.Linear(params['hiddensize'], params['hiddensize']).to(device=device, dtype=dtype)
             
             # Plasticity only in the recurrent connections, h to c.
-            #self.h2c = torch.nn.Linear(params['hiddensize'], params['hiddensize']).cuda()  # This is replaced by the plastic connection matrices below
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).cuda(), requires_grad=True)
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).cuda(), requires_grad=True)
-            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
-
-            self.x2f = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).cuda()
-            self.x2opt = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).cuda()
-            self.x2i = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).cuda()
-            self.x2c = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).cuda()
+            #self.h2c = torch.nn.Linear(params['hiddensize'], params['hiddensize']).to(device=device, dtype=dtype)  # This is replaced by the plastic connection matrices below
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hiddensize'], params['hiddensize'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
+
+            self.x2f = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
+            self.x2opt = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
+            self.x2i = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
+            self.x2c = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
         elif params['type'] == 'lstmmanual':   # An LSTM implemented "by hand", to ensure maximum simlarity with the plastic LSTM
-            self.h2f = torch.nn.Linear(params['hiddensize'], params['hiddensize']).cuda()
-            self.h2i = torch.nn.Linear(params['hiddensize'], params['hiddensize']).cuda()
-            self.h2opt = torch.nn.Linear(params['hiddensize'], params['hiddensize']).cuda()
-            self.h2c = torch.nn.Linear(params['hiddensize'], params['hiddensize']).cuda()
-            self.x2f = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).cuda()
-            self.x2opt = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).cuda()
-            self.x2i = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).cuda()
-            self.x2c = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).cuda()
+            self.h2f = torch.nn.Linear(params['hiddensize'], params['hiddensize']).to(device=device, dtype=dtype)
+            self.h2i = torch.nn.Linear(params['hiddensize'], params['hiddensize']).to(device=device, dtype=dtype)
+            self.h2opt = torch.nn.Linear(params['hiddensize'], params['hiddensize']).to(device=device, dtype=dtype)
+            self.h2c = torch.nn.Linear(params['hiddensize'], params['hiddensize']).to(device=device, dtype=dtype)
+            self.x2f = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
+            self.x2opt = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
+            self.x2i = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
+            self.x2c = torch.nn.Linear(TOTALNBINPUTS, params['hiddensize']).to(device=device, dtype=dtype)
             ##fgt = F.sigmoid(self.x2f(input) + self.h2f(hidden[0]))
             ##ipt = F.sigmoid(self.x2i(input) + self.h2i(hidden[0]))
             ##opt = F.sigmoid(self.x2o(input) + self.h2o(hidden[0]))
@@ -128,9 +127,10 @@ class Network(nn.Module):
             ##hidden = (h, cell)
         else:
             raise ValueError("Which network type?")
-        self.h2o = torch.nn.Linear(params['hiddensize'], NBACTIONS).cuda()  # From hidden to action output
-        self.h2v = torch.nn.Linear(params['hiddensize'], 1).cuda()          # From hidden to value prediction (for A3C)
+        self.h2o = torch.nn.Linear(params['hiddensize'], NBACTIONS).to(device=device, dtype=dtype)  # From hidden to action output
+        self.h2v = torch.nn.Linear(params['hiddensize'], 1).to(device=device, dtype=dtype)          # From hidden to value prediction (for A3C)
         self.params = params
+        self.device, self.dtype = device, dtype
         
         # Notice that the vectors are row vectors, and the matrices are transposed wrt the usual order, following apparent pytorch conventions
         # Each *column* of w targets a single output neuron
@@ -213,15 +213,15 @@ class Network(nn.Module):
         return activout, valueout, hidden, hebb
 
     def initialZeroHebb(self):
-        return Variable(torch.zeros(self.params['hiddensize'], self.params['hiddensize']) , requires_grad=False).cuda()
+        return Variable(torch.zeros(self.params['hiddensize'], self.params['hiddensize']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
 
     def initialZeroState(self):
         if self.params['type'] == 'lstm':
-            return (Variable(torch.zeros(1, 1, self.params['hiddensize']), requires_grad=False).cuda() , Variable(torch.zeros(1, 1, self.params['hiddensize']), requires_grad=False ).cuda() )
+            return (Variable(torch.zeros(1, 1, self.params['hiddensize']), requires_grad=False).to(device=self.device, dtype=self.dtype) , Variable(torch.zeros(1, 1, self.params['hiddensize']), requires_grad=False ).to(device=self.device, dtype=self.dtype) )
         elif self.params['type'] == 'lstmmanual' or self.params['type'] == 'lstmplastic':
-            return (Variable(torch.zeros(1, self.params['hiddensize']), requires_grad=False).cuda() , Variable(torch.zeros(1, self.params['hiddensize']), requires_grad=False ).cuda() )
+            return (Variable(torch.zeros(1, self.params['hiddensize']), requires_grad=False).to(device=self.device, dtype=self.dtype) , Variable(torch.zeros(1, self.params['hiddensize']), requires_grad=False ).to(device=self.device, dtype=self.dtype) )
         elif self.params['type'] == 'rnn' or self.params['type'] == 'plastic' or self.params['type'] == 'homo':
-            return Variable(torch.zeros(1, self.params['hiddensize']), requires_grad=False ).cuda() 
+            return Variable(torch.zeros(1, self.params['hiddensize']), requires_grad=False ).to(device=self.device, dtype=self.dtype) 
         else:
             raise ValueError("Which type?")
 
@@ -236,14 +236,16 @@ def train(paramdict):
     print("Passed params: ", params)
     print(platform.uname())
     #params['nbsteps'] = params['nbshots'] * ((params['prestime'] + params['interpresdelay']) * params['nbclasses']) + params['prestimetest']  # Total number of steps per episode
-    suffix = "maze_"+"".join([str(x)+"_" if pair[0] is not 'nbsteps' and pair[0] is not 'rngseed' and pair[0] is not 'save_every' and pair[0] is not 'test_every' else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
+    suffix = "maze_"+"".join([str(x)+"_" if pair[0] not in ('nbsteps', 'rngseed', 'save_every', 'test_every') else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
 
     # Initialize random seeds (first two redundant?)
     print("Setting random seeds")
     np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
 
     print("Initializing network")
-    net = Network(params)
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+    net = Network(params, device=device)
     print ("Shape of all optimized parameters:", [x.size() for x in net.parameters()])
     allsizes = [torch.numel(x.data.cpu()) for x in net.parameters()]
     print ("Size (numel) of all optimized elements:", allsizes)
@@ -274,6 +276,7 @@ def train(paramdict):
             if row % 2 == 0 and col % 2 == 0:
                 lab[row, col] = 1
     lab[CTR,CTR] = 0 # Not really necessary, but nicer to not start on a wall, and perhaps helps localization by introducing a detectable irregularity in the center?
+    obstable, _ = mazeenv.observationtable(lab, RFSIZE)  # Precomputed receptive-field observations for every cell (see mazeenv.py)
 
 
 
@@ -335,9 +338,9 @@ def train(paramdict):
             
             
             inputsN = np.zeros((1, TOTALNBINPUTS), dtype='float32')
-            inputsN[0, 0:RFSIZE * RFSIZE] = lab[posr - RFSIZE//2:posr + RFSIZE//2 +1, posc - RFSIZE //2:posc + RFSIZE//2 +1].flatten()
+            inputsN[0, 0:RFSIZE * RFSIZE] = obstable[posr * LABSIZE + posc]
             
-            inputs = torch.from_numpy(inputsN).cuda()
+            inputs = torch.from_numpy(inputsN).to(device)
             # Previous chosen action
             #inputs[0][numactionchosen] = 1
             inputs[0][-1] = 1 # Bias neuron
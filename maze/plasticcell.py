@@ -0,0 +1,153 @@
+# Backpropamine: differentiable neuromdulated plasticity.
+#
+# Copyright (c) 2018-2019 Uber Technologies, Inc.
+#
+# Licensed under the Uber Non-Commercial License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at the root directory of this project.
+#
+# See the License file in this repository for the specific language governing
+# permissions and limitations under the License.
+
+
+# TorchScript-able plastic recurrent cell, for the maze and stimulus-response networks.
+#
+# The Network classes in maze/batch.py and sr/modul.py look up their
+# configuration (network type, DA transformation, addpw, fm, rule) in
+# self.params at every time step. PlasticCell resolves this configuration once,
+# at construction, into TorchScript constants (so that torch.jit.script only
+# compiles the branches that are actually used), and shares all its
+# parameters with the original network. It also provides scan(), which runs
+# the cell over a whole sequence of inputs in a single scripted loop.
+#
+# For small networks, most of the time is spent in per-step Python dispatch,
+# which this removes. Note that the Hebbian updates are written with plain
+# tensor operations here (the fused update of hebbtrace.py cannot be scripted);
+# for large networks, the normal (eager) networks are preferable.
+#
+# The state is a list of tensors whose length depends on the network type:
+# [hidden] for 'rnn', [hidden, hebb] for 'plastic' and 'modplast',
+# [hidden, hebb, et, pw] for 'modul'. Additional elements are passed through
+# unchanged.
+
+from typing import List, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+NETTYPES = {'rnn': 0, 'plastic': 1, 'modplast': 2, 'modul': 3}
+DATYPES = {'tanh': 0, 'sig': 1, 'lin': 2}
+RULES = {'hebb': 0, 'oja': 1}
+
+
+class PlasticCell(nn.Module):
+
+    __constants__ = ['nettype', 'da', 'addpw', 'fm', 'rule']
+
+    def __init__(self, net, nettype, da='tanh', addpw=3, fm=1, rule='hebb'):
+        # net: the network whose parameters are used (i2h, w, h2o, h2v and, depending on the type, alpha, eta, etaet, h2DA)
+        # nettype: 'rnn', 'plastic', 'modplast' or 'modul'
+        # addpw: how plastic weights are updated (3: hard clamp, 2: soft clamp, 1: purely additive, 0: decay)
+        # fm: for 'modplast' and 'modul', is the whole network modulated (1) or only half of it (0)?
+        # rule: 'hebb' or 'oja' (only used by 'modul')
+        super(PlasticCell, self).__init__()
+        for name, table, value in (('network type', NETTYPES, nettype), ('DA transformation', DATYPES, da), ('learning rule', RULES, rule)):
+            if value not in table:
+                raise ValueError("Unknown " + name + ": " + str(value))
+        if addpw not in (0, 1, 2, 3):
+            raise ValueError("Which additive form for plastic weights?")
+        if fm not in (0, 1):
+            raise ValueError("Must select whether fully modulated or not")
+        if nettype == 'modul' and addpw == 0:
+            raise ValueError("addpw=0 is not supported for 'modul' networks")
+        self.nettype, self.da, self.addpw, self.fm, self.rule = NETTYPES[nettype], DATYPES[da], addpw, fm, RULES[rule]
+
+        self.i2h, self.h2o, self.h2v = net.i2h, net.h2o, net.h2v
+        self.w = net.w
+        # Parameters that this type of network doesn't have are replaced by (unused) placeholders
+        placeholder = torch.zeros(1, device=net.w.device, dtype=net.w.dtype)
+        self.alpha = net.alpha if hasattr(net, 'alpha') else placeholder
+        self.eta = net.eta if hasattr(net, 'eta') else placeholder
+        self.etaet = net.etaet if hasattr(net, 'etaet') else placeholder
+        self.h2daw = net.h2DA.weight if hasattr(net, 'h2DA') else placeholder
+        self.h2dab = net.h2DA.bias if hasattr(net, 'h2DA') else placeholder
+
+    def update(self, trace, eta, delta, softbound: float):
+        # Adds eta * delta to the trace, according to addpw
+        if self.addpw == 3:
+            return torch.clamp(trace + eta * delta, min=-1.0, max=1.0)
+        elif self.addpw == 2:
+            return torch.clamp(trace + torch.clamp(eta * delta, min=0.0) * (1 - trace) + torch.clamp(eta * delta, max=0.0) * (trace + 1), min=-softbound, max=softbound)
+        elif self.addpw == 1:
+            return trace + eta * delta
+        else:
+            return (1 - eta) * trace + eta * delta
+
+    def forward(self, inputs, state: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, List[torch.Tensor]]:
+        # Returns the raw action scores, the value prediction, the DA output (zero for non-modulated networks) and the new state
+        hidden = state[0]
+        BS, HS = hidden.size(0), hidden.size(1)
+
+        # The *rows* of w and plastic weights are the input weights to a single neuron
+        if self.nettype == 0:
+            recurrent = torch.matmul(hidden, self.w.t())
+        else:
+            plastic = state[3] if self.nettype == 3 else state[1]
+            recurrent = torch.bmm(self.w + torch.mul(self.alpha, plastic), hidden.view(BS, HS, 1)).view(BS, HS)
+        hactiv = torch.tanh(self.i2h(inputs) + recurrent)
+        activout = self.h2o(hactiv)
+        valueout = self.h2v(hactiv)
+
+        DAout = torch.zeros_like(valueout)
+        if self.nettype >= 2:
+            DAout = F.linear(hactiv, self.h2daw, self.h2dab)
+            if self.da == 0:
+                DAout = torch.tanh(DAout)
+            elif self.da == 1:
+                DAout = torch.sigmoid(DAout)
+
+        newstate = state.copy()
+        newstate[0] = hactiv
+        if self.nettype >= 1:
+            if self.rule == 1:
+                deltahebb = torch.mul(hactiv.view(BS, HS, 1), (hidden.view(BS, 1, HS) - torch.mul(self.w.view(1, HS, HS), hactiv.view(BS, HS, 1))))
+            else:
+                deltahebb = torch.bmm(hactiv.view(BS, HS, 1), hidden.view(BS, 1, HS))
+
+            if self.nettype == 1:
+                newstate[1] = self.update(state[1], self.eta, deltahebb, 1.0)
+            elif self.nettype == 2:
+                if self.fm == 1:
+                    newstate[1] = self.update(state[1], DAout.view(BS, 1, 1), deltahebb, 1.0)
+                else:
+                    # The first half of the rows is modulated, the second half uses the non-modulated eta
+                    eta = torch.cat((DAout.view(BS, 1, 1).expand(BS, HS // 2, 1), self.eta.view(1, 1, 1).expand(BS, HS - HS // 2, 1)), dim=1)
+                    newstate[1] = self.update(state[1], eta, deltahebb, 1.0)
+            else:
+                # Retroactive modulation: the DA output incorporates the eligibility trace into the plastic weights
+                et = state[2]
+                pw = self.update(state[3], DAout.view(BS, 1, 1), et, .99999)
+                if self.fm == 0:
+                    hebb = torch.clamp(state[1] + self.eta * deltahebb, min=-1.0, max=1.0)
+                    newstate[1] = hebb
+                    pw = torch.cat((hebb[:, :HS // 2, :], pw[:, HS // 2:, :]), dim=1)
+                newstate[3] = pw
+                newstate[2] = (1 - self.etaet) * et + self.etaet * deltahebb
+
+        return activout, valueout, DAout, newstate
+
+    @torch.jit.export
+    def scan(self, inputs, state: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, List[torch.Tensor]]:
+        # Runs the cell over a whole sequence of inputs (nbsteps x BS x inputsize)
+        # Returns the raw action scores, value predictions and DA outputs for all steps (stacked along the first dimension), and the final state
+        activouts: List[torch.Tensor] = []
+        valueouts: List[torch.Tensor] = []
+        DAouts: List[torch.Tensor] = []
+        for numstep in range(inputs.size(0)):
+            activout, valueout, DAout, state = self.forward(inputs[numstep], state)
+            activouts.append(activout)
+            valueouts.append(valueout)
+            DAouts.append(DAout)
+        return torch.stack(activouts), torch.stack(valueouts), torch.stack(DAouts), state
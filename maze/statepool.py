@@ -0,0 +1,59 @@
+# Backpropamine: differentiable neuromdulated plasticity.
+#
+# Copyright (c) 2018-2019 Uber Technologies, Inc.
+#
+# Licensed under the Uber Non-Commercial License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at the root directory of this project.
+#
+# See the License file in this repository for the specific language governing
+# permissions and limitations under the License.
+
+
+# Preallocated state of a plastic network, for rollouts without gradients.
+#
+# Allocating fresh BS x HS x HS traces at the start of every episode, and new
+# ones at every step through the functional updates, makes the memory of
+# long-running data-collection processes go up and down by large amounts.
+# A StatePool owns all the state tensors of a network (hidden state, Hebbian
+# trace, eligibility trace, plastic weights...) twice: at each step, the
+# network's forward_pool() reads the current state from one set of buffers,
+# writes the new state into the other with out= operations (so that the old
+# state stays available until the end of the step) and swaps them. A few
+# single-buffered scratch tensors hold the temporaries of a step (e.g. the
+# effective weights w + alpha * hebb). reset() zero-fills the current state in
+# place, for the next episode.
+#
+# Pools are created by the networks (initialStatePool()).
+
+import torch
+
+
+class StatePool:
+
+    def __init__(self, shapes, scratch=None, device=None, dtype=torch.float32):
+        # shapes: names and shapes of the state tensors, e.g. {'hidden': (BS, HS), 'hebb': (BS, HS, HS)}
+        # scratch: names and shapes of the temporary buffers used within a step
+        self.buffers = tuple({name: torch.zeros(shape, device=device, dtype=dtype) for name, shape in shapes.items()} for nb in range(2))
+        self.scratch = {name: torch.zeros(shape, device=device, dtype=dtype) for name, shape in (scratch or {}).items()}
+        self.current = 0
+
+    def reset(self):
+        # Zeroes the current state in place (the other set of buffers is entirely overwritten by the next step)
+        for buf in self.buffers[self.current].values():
+            buf.zero_()
+        return self
+
+    def state(self):
+        # The current state, as a dictionary of tensors (only valid until the next step: copy what must be kept)
+        return self.buffers[self.current]
+
+    def nextstate(self):
+        # The buffers that receive the state computed by the current step
+        return self.buffers[1 - self.current]
+
+    def swap(self):
+        self.current = 1 - self.current
+
+    def __getitem__(self, name):
+        return self.buffers[self.current][name]
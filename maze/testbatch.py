@@ -14,6 +14,7 @@ import pickle
 import time
 import os
 import platform
+import mazeenv
 #import makemaze
 
 import numpy as np
@@ -48,7 +49,7 @@ TOTALNBINPUTS =  RFSIZE * RFSIZE + ADDINPUT + NBACTIONS
 
 
 class Network(nn.Module):
-    def __init__(self, params):
+    def __init__(self, params, device=None, dtype=torch.float32):
         super(Network, self).__init__()
         self.rule = params['rule']
         self.type = params['type']
@@ -60,54 +61,55 @@ class Network(nn.Module):
         #else:
         #    raise ValueError('Must choose an activ function')
         if params['type'] == 'lstm':
-            self.lstm = torch.nn.LSTM(TOTALNBINPUTS, params['hs']).cuda()
+            self.lstm = torch.nn.LSTM(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
         elif params['type'] == 'rnn':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             #self.inputnegmask[0, :TOTALNBINPUTS] = 0   # no modulation for 2nd half
         elif params['type'] == 'modplast' or params['type'] == 'modplast2':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            #self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).cuda(), requires_grad=True)
-            #self.alpha =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).cuda(), requires_grad=True)
-            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
-            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            #self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).to(device=device, dtype=dtype), requires_grad=True)
+            #self.alpha =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).to(device=device, dtype=dtype), requires_grad=True)
+            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
+            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             #self.inputnegmask[0, :TOTALNBINPUTS] = 0   # no modulation for 2nd half
-            self.h2DA = torch.nn.Linear(params['hs'], NBDA).cuda()
+            self.h2DA = torch.nn.Linear(params['hs'], NBDA).to(device=device, dtype=dtype)
         elif params['type'] == 'plastic' :
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
-            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
+            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             #self.inputnegmask[0, :TOTALNBINPUTS] = 0   # no modulation for 2nd half
         elif params['type'] == 'modul' or params['type'] == 'modul2':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
             # Note that initial eta is higher (faster) thanbefore
-            self.eta = torch.nn.Parameter((.1 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
-            self.etaet = torch.nn.Parameter((.1 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same etapw
-            self.etapw = torch.nn.Parameter((.1 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same etapw
-            self.h2DA = torch.nn.Linear(params['hs'], NBDA).cuda()
+            self.eta = torch.nn.Parameter((.1 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
+            self.etaet = torch.nn.Parameter((.1 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same etapw
+            self.etapw = torch.nn.Parameter((.1 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same etapw
+            self.h2DA = torch.nn.Linear(params['hs'], NBDA).to(device=device, dtype=dtype)
             # The daweights vectors are weight vectors from the DA output neurons to the network hidden (recurrent) neurons
-            #self.daweights0 = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            #self.daweights0 = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             #self.daweights0[0, (params['hs'] // 2):] = 0   # no modulation for 2nd half
-            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             #self.inputnegmask[0, :TOTALNBINPUTS] = 0   # no modulation for 2nd half
 
             #else:
             #    raise ValueError("Must specify which half of the network receives modulation")
-            self.daweights1 = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            self.daweights1 = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             self.daweights1[0, :(params['hs'] // 4)] = 0
             self.daweights1[0, -(params['hs'] // 4):] = 0
         else:
             raise ValueError("Which network type?")
-        self.h2o = torch.nn.Linear(params['hs'], NBACTIONS).cuda()
-        self.h2v = torch.nn.Linear(params['hs'], 1).cuda()
+        self.h2o = torch.nn.Linear(params['hs'], NBACTIONS).to(device=device, dtype=dtype)
+        self.h2v = torch.nn.Linear(params['hs'], 1).to(device=device, dtype=dtype)
         self.params = params
+        self.device, self.dtype = device, dtype
 
         # Notice that the vectors are row vectors, and the matrices are transposed wrt the usual order, following apparent pytorch conventions
         # Each *column* of w targets a single output neuron
@@ -496,14 +498,14 @@ class Network(nn.Module):
 
 
     def initialZeroHebb(self):
-        #return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).cuda()
-        return Variable(torch.zeros(self.params['hs'], self.params['hs']) , requires_grad=False).cuda()
+        #return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
+        return Variable(torch.zeros(self.params['hs'], self.params['hs']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
     def initialZeroPlasticWeights(self):
-        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).cuda()
+        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
 
     def initialZeroState(self):
         BATCHSIZE = self.params['bs']
-        return Variable(torch.zeros(BATCHSIZE, self.params['hs']), requires_grad=False ).cuda()
+        return Variable(torch.zeros(BATCHSIZE, self.params['hs']), requires_grad=False ).to(device=self.device, dtype=self.dtype)
 
 
 
@@ -518,7 +520,7 @@ def train(paramdict):
     print("Passed params: ", params)
     print(platform.uname())
     #params['nbsteps'] = params['nbshots'] * ((params['prestime'] + params['interpresdelay']) * params['nbclasses']) + params['prestimetest']  # Total number of steps per episode
-    suffix = "btch_"+"".join([str(x)+"_" if pair[0] is not 'nbsteps' and pair[0] is not 'rngseed' and pair[0] is not 'save_every' and pair[0] is not 'test_every' and pair[0] is not 'pe' else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
+    suffix = "btch_"+"".join([str(x)+"_" if pair[0] not in ('nbsteps', 'rngseed', 'save_every', 'test_every', 'pe') else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
 
     # Initialize random seeds (first two redundant?)
     print("Setting random seeds")
@@ -526,7 +528,9 @@ def train(paramdict):
     #print(click.get_current_context().params)
 
     print("Initializing network")
-    net = Network(params)
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+    net = Network(params, device=device)
     print ("Shape of all optimized parameters:", [x.size() for x in net.parameters()])
     allsizes = [torch.numel(x.data.cpu()) for x in net.parameters()]
     print ("Size (numel) of all optimized elements:", allsizes)
@@ -587,6 +591,7 @@ def train(paramdict):
     # (including 13 and 9, but not 11) by introducing a detectable irregularity
     # in the center:
     lab[CTR,CTR] = 0
+    obstable, _ = mazeenv.observationtable(lab, RFSIZE)  # Precomputed receptive-field observations for every cell (see mazeenv.py)
 
 
 
@@ -674,10 +679,8 @@ def train(paramdict):
 
             inputs = np.zeros((BATCHSIZE, TOTALNBINPUTS), dtype='float32')
 
-            labg = lab.copy()
-            #labg[rposr, rposc] = -1  # The agent can see the reward if it falls within its RF
             for nb in range(BATCHSIZE):
-                inputs[nb, 0:RFSIZE * RFSIZE] = labg[posr[nb] - RFSIZE//2:posr[nb] + RFSIZE//2 +1, posc[nb] - RFSIZE //2:posc[nb] + RFSIZE//2 +1].flatten() * 1.0
+                inputs[nb, 0:RFSIZE * RFSIZE] = obstable[posr[nb] * LABSIZE + posc[nb]]
 
                 # Previous chosen action
                 inputs[nb, RFSIZE * RFSIZE +1] = 1.0 # Bias neuron
@@ -687,7 +690,7 @@ def train(paramdict):
                 inputs[nb, RFSIZE * RFSIZE + ADDINPUT + numactionschosen[nb]] = 1
                 #inputs = 100.0 * inputs  # input boosting : Very bad with clamp=0
 
-            inputsC = torch.from_numpy(inputs).cuda()
+            inputsC = torch.from_numpy(inputs).to(device)
             # Might be better:
             #if rposr == posr and rposc = posc:
             #    inputs[0][-4] = 100.0
@@ -14,6 +14,7 @@ import pickle
 import time
 import os
 import platform
+import mazeenv
 #import makemaze
 
 import numpy as np
@@ -48,7 +49,7 @@ TOTALNBINPUTS =  RFSIZE * RFSIZE + ADDINPUT + NBACTIONS
 
 
 class Network(nn.Module):
-    def __init__(self, params):
+    def __init__(self, params, device=None, dtype=torch.float32):
         super(Network, self).__init__()
         self.rule = params['rule']
         self.type = params['type']
@@ -60,72 +61,72 @@ class Network(nn.Module):
         #else:
         #    raise ValueError('Must choose an activ function')
         if params['type'] == 'lstm':
-            self.lstm = torch.nn.LSTM(TOTALNBINPUTS, params['hs']).cuda()
+            self.lstm = torch.nn.LSTM(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
         elif params['type'] == 'rnn':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             #self.inputnegmask[0, :TOTALNBINPUTS] = 0   # no modulation for 2nd half
         elif params['type'] == 'modplast' or params['type'] == 'modplast2':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
-            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
+            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             #self.inputnegmask[0, :TOTALNBINPUTS] = 0   # no modulation for 2nd half
-            self.h2DA = torch.nn.Linear(params['hs'], NBDA).cuda()
-            self.DAoutV = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            self.h2DA = torch.nn.Linear(params['hs'], NBDA).to(device=device, dtype=dtype)
+            self.DAoutV = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
         elif params['type'] == 'plastic' :
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
-            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
+            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             #self.inputnegmask[0, :TOTALNBINPUTS] = 0   # no modulation for 2nd half
         elif params['type'] == 'modul' or params['type'] == 'modul2':
-            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
+            self.i2h = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
             # Note that initial eta is higher (faster) thanbefore
-            self.eta = torch.nn.Parameter((.1 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
-            self.etaet = torch.nn.Parameter((.1 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same etapw
-            self.etapw = torch.nn.Parameter((.1 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same etapw
-            self.h2DA = torch.nn.Linear(params['hs'], NBDA).cuda()
+            self.eta = torch.nn.Parameter((.1 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
+            self.etaet = torch.nn.Parameter((.1 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same etapw
+            self.etapw = torch.nn.Parameter((.1 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same etapw
+            self.h2DA = torch.nn.Linear(params['hs'], NBDA).to(device=device, dtype=dtype)
             # The daweights vectors are weight vectors from the DA output neurons to the network hidden (recurrent) neurons
-            #self.daweights0 = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            #self.daweights0 = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             #self.daweights0[0, (params['hs'] // 2):] = 0   # no modulation for 2nd half
-            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            #self.inputnegmask = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             #self.inputnegmask[0, :TOTALNBINPUTS] = 0   # no modulation for 2nd half
 
             #else:
             #    raise ValueError("Must specify which half of the network receives modulation")
-            self.daweights1 = Variable(torch.ones(1, params['hs']), requires_grad=False).cuda()
+            self.daweights1 = Variable(torch.ones(1, params['hs']), requires_grad=False).to(device=device, dtype=dtype)
             self.daweights1[0, :(params['hs'] // 4)] = 0
             self.daweights1[0, -(params['hs'] // 4):] = 0
         elif params['type'] == 'lstmplastic':
-            self.h2f = torch.nn.Linear(params['hs'], params['hs']).cuda()
-            self.h2i = torch.nn.Linear(params['hs'], params['hs']).cuda()
-            self.h2opt = torch.nn.Linear(params['hs'], params['hs']).cuda()
+            self.h2f = torch.nn.Linear(params['hs'], params['hs']).to(device=device, dtype=dtype)
+            self.h2i = torch.nn.Linear(params['hs'], params['hs']).to(device=device, dtype=dtype)
+            self.h2opt = torch.nn.Linear(params['hs'], params['hs']).to(device=device, dtype=dtype)
 
             # Plasticity in the recurrent connections, h to c:
-            #self.h2c = torch.nn.Linear(params['hs'], params['hs']).cuda()
-            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).cuda(), requires_grad=True)
-            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
-
-            self.x2f = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.x2opt = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.x2i = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.x2c = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
+            #self.h2c = torch.nn.Linear(params['hs'], params['hs']).to(device=device, dtype=dtype)
+            self.w =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['hs'], params['hs'])).to(device=device, dtype=dtype), requires_grad=True)
+            self.eta = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
+
+            self.x2f = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.x2opt = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.x2i = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.x2c = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
         elif params['type'] == 'lstmmanual':
-            self.h2f = torch.nn.Linear(params['hs'], params['hs']).cuda()
-            self.h2i = torch.nn.Linear(params['hs'], params['hs']).cuda()
-            self.h2opt = torch.nn.Linear(params['hs'], params['hs']).cuda()
-            self.h2c = torch.nn.Linear(params['hs'], params['hs']).cuda()
-            self.x2f = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.x2opt = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.x2i = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
-            self.x2c = torch.nn.Linear(TOTALNBINPUTS, params['hs']).cuda()
+            self.h2f = torch.nn.Linear(params['hs'], params['hs']).to(device=device, dtype=dtype)
+            self.h2i = torch.nn.Linear(params['hs'], params['hs']).to(device=device, dtype=dtype)
+            self.h2opt = torch.nn.Linear(params['hs'], params['hs']).to(device=device, dtype=dtype)
+            self.h2c = torch.nn.Linear(params['hs'], params['hs']).to(device=device, dtype=dtype)
+            self.x2f = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.x2opt = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.x2i = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
+            self.x2c = torch.nn.Linear(TOTALNBINPUTS, params['hs']).to(device=device, dtype=dtype)
             ##fgt = F.sigmoid(self.x2f(inputs) + self.h2f(hidden[0]))
             ##ipt = F.sigmoid(self.x2i(inputs) + self.h2i(hidden[0]))
             ##opt = F.sigmoid(self.x2o(inputs) + self.h2o(hidden[0]))
@@ -134,9 +135,10 @@ class Network(nn.Module):
             ##hidden = (h, cell)
         else:
             raise ValueError("Which network type?")
-        self.h2o = torch.nn.Linear(params['hs'], NBACTIONS).cuda()
-        self.h2v = torch.nn.Linear(params['hs'], 1).cuda()
+        self.h2o = torch.nn.Linear(params['hs'], NBACTIONS).to(device=device, dtype=dtype)
+        self.h2v = torch.nn.Linear(params['hs'], 1).to(device=device, dtype=dtype)
         self.params = params
+        self.device, self.dtype = device, dtype
 
         # Notice that the vectors are row vectors, and the matrices are transposed wrt the usual order, following apparent pytorch conventions
         # Each *column* of w targets a single output neuron
@@ -571,17 +573,17 @@ class Network(nn.Module):
 
 
     def initialZeroHebb(self):
-        return Variable(torch.zeros(self.params['hs'], self.params['hs']) , requires_grad=False).cuda()
+        return Variable(torch.zeros(self.params['hs'], self.params['hs']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
     def initialZeroPlasticWeights(self):
-        return Variable(torch.zeros(self.params['hs'], self.params['hs']) , requires_grad=False).cuda()
+        return Variable(torch.zeros(self.params['hs'], self.params['hs']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
 
     def initialZeroState(self):
         if self.params['type'] == 'lstm':
-            return (Variable(torch.zeros(1, 1, self.params['hs']), requires_grad=False).cuda() , Variable(torch.zeros(1, 1, self.params['hs']), requires_grad=False ).cuda() )
+            return (Variable(torch.zeros(1, 1, self.params['hs']), requires_grad=False).to(device=self.device, dtype=self.dtype) , Variable(torch.zeros(1, 1, self.params['hs']), requires_grad=False ).to(device=self.device, dtype=self.dtype) )
         elif self.params['type'] == 'lstmmanual' or self.params['type'] == 'lstmplastic':
-            return (Variable(torch.zeros(1, self.params['hs']), requires_grad=False).cuda() , Variable(torch.zeros(1, self.params['hs']), requires_grad=False ).cuda() )
+            return (Variable(torch.zeros(1, self.params['hs']), requires_grad=False).to(device=self.device, dtype=self.dtype) , Variable(torch.zeros(1, self.params['hs']), requires_grad=False ).to(device=self.device, dtype=self.dtype) )
         elif self.params['type'] == 'rnn' or self.params['type'] == 'plastic'  or self.params['type'] == 'modul' or self.params['type'] == 'modul2' or self.params['type'] == 'modplast' or self.params['type'] == 'modplast2':
-            return Variable(torch.zeros(1, self.params['hs']), requires_grad=False ).cuda()
+            return Variable(torch.zeros(1, self.params['hs']), requires_grad=False ).to(device=self.device, dtype=self.dtype)
 
 
 
@@ -596,7 +598,7 @@ def train(paramdict):
     print("Passed params: ", params)
     print(platform.uname())
     #params['nbsteps'] = params['nbshots'] * ((params['prestime'] + params['interpresdelay']) * params['nbclasses']) + params['prestimetest']  # Total number of steps per episode
-    suffix = "maz_"+"".join([str(x)+"_" if pair[0] is not 'nbsteps' and pair[0] is not 'rngseed' and pair[0] is not 'save_every' and pair[0] is not 'test_every' and pair[0] is not 'print_every' else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
+    suffix = "maz_"+"".join([str(x)+"_" if pair[0] not in ('nbsteps', 'rngseed', 'save_every', 'test_every', 'print_every') else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
 
     # Initialize random seeds (first two redundant?)
     print("Setting random seeds")
@@ -604,7 +606,9 @@ def train(paramdict):
     #print(click.get_current_context().params)
 
     print("Initializing network")
-    net = Network(params)
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+    net = Network(params, device=device)
     print ("Shape of all optimized parameters:", [x.size() for x in net.parameters()])
     allsizes = [torch.numel(x.data.cpu()) for x in net.parameters()]
     print ("Size (numel) of all optimized elements:", allsizes)
@@ -664,6 +668,7 @@ def train(paramdict):
     # (including 13 and 9, but not 11) by introducing a detectable irregularity
     # in the center:
     lab[CTR,CTR] = 0
+    obstable, _ = mazeenv.observationtable(lab, RFSIZE)  # Precomputed receptive-field observations for every cell (see mazeenv.py)
 
 
 
@@ -746,9 +751,7 @@ def train(paramdict):
             else:
                 inputs = np.zeros((1, params['hs']), dtype='float32')
 
-            labg = lab.copy()
-            #labg[rposr, rposc] = -1  # The agent can see the reward if it falls within its RF
-            inputs[0, 0:RFSIZE * RFSIZE] = labg[posr - RFSIZE//2:posr + RFSIZE//2 +1, posc - RFSIZE //2:posc + RFSIZE//2 +1].flatten() * 1.0
+            inputs[0, 0:RFSIZE * RFSIZE] = obstable[posr * LABSIZE + posc]
 
             # Previous chosen action
             inputs[0, RFSIZE * RFSIZE +1] = 1.0 # Bias neuron
@@ -757,7 +760,7 @@ def train(paramdict):
             inputs[0, RFSIZE * RFSIZE +3] = 1.0 * rewardpercep
             inputs[0, RFSIZE * RFSIZE + ADDINPUT + numactionchosen] = 1
             #inputs = 100.0 * inputs  # input boosting : Very bad with clamp=0
-            inputsC = torch.from_numpy(inputs).cuda()
+            inputsC = torch.from_numpy(inputs).to(device)
             # Might be better:
             #if rposr == posr and rposc = posc:
             #    inputs[0][-4] = 100.0
@@ -0,0 +1,106 @@
+# Differentiable plasticity: Omniglot task.
+
+# Copyright (c) 2018 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Batched evaluation of several trained Omniglot networks.
+#
+# An Ensemble holds the (frozen) parameters of S networks trained by
+# omniglot.py with the same architecture (typically, with different seeds),
+# stacked along an extra leading "network" dimension. It runs a batch of E
+# test episodes through all the networks at once: the convolutional
+# embeddings of all the images of all the episodes are computed with grouped
+# convolutions (one group per network), and the plastic output layer keeps
+# an S x E x nbf x nbclasses Hebbian trace. All the networks see the same
+# episodes. This is for inference only (use it under torch.no_grad()).
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# Parameters that must be the same for all the networks of an ensemble
+ARCHPARAMS = ('activ', 'alpha', 'flare', 'imgsize', 'nbclasses', 'nbf', 'rule')
+CONVS = ('cv1', 'cv2', 'cv3', 'cv4')
+
+
+class Ensemble(nn.Module):
+
+    def __init__(self, nets):
+        # nets: a list of omniglot.Network, all on the same device
+        super(Ensemble, self).__init__()
+        if len(nets) == 0:
+            raise ValueError("Need at least one network")
+        self.params = nets[0].params
+        for net in nets[1:]:
+            for key in ARCHPARAMS:
+                if net.params.get(key) != self.params.get(key):
+                    raise ValueError("All networks must have the same '" + key + "': " + str(self.params.get(key)) + " != " + str(net.params.get(key)))
+        self.nbnets = len(nets)
+        self.rule = self.params['rule']
+        S = self.nbnets
+        # Convolution weights of all networks, concatenated along the output channels: (S * out) x in x k x k
+        self.strides = []
+        for name in CONVS:
+            self.register_buffer(name + 'w', torch.cat([getattr(net, name).weight.detach() for net in nets], 0))
+            self.register_buffer(name + 'b', torch.cat([getattr(net, name).bias.detach() for net in nets], 0))
+            self.strides.append(getattr(nets[0], name).stride)
+        self.register_buffer('w', torch.stack([net.w.detach() for net in nets]).unsqueeze(1))  # S x 1 x nbf x nbclasses
+        if self.params['alpha'] == 'free':
+            self.register_buffer('alpha', torch.stack([net.alpha.detach() for net in nets]).unsqueeze(1))  # S x 1 x nbf x nbclasses
+        else:
+            self.register_buffer('alpha', torch.stack([net.alpha.detach() for net in nets]).view(S, 1, 1, 1))
+        self.register_buffer('eta', torch.stack([net.eta.detach() for net in nets]).view(S, 1, 1, 1))
+
+    def embed(self, inputx):
+        # The embeddings (N x S x nbf) of a stack of N images (N x 1 x h x w) by each of the S networks
+        if self.params['activ'] == 'selu':
+            activf = F.selu
+        elif self.params['activ'] == 'relu':
+            activf = F.relu
+        elif self.params['activ'] == 'tanh':
+            activf = F.tanh
+        else:
+            raise ValueError("Parameter 'activ' is incorrect (must be tanh, relu or selu)")
+        activ = inputx
+        for nl, name in enumerate(CONVS):
+            # The first layer sees the same single-channel images for all networks; after that, each network only sees its own channels
+            activ = activf(F.conv2d(activ, getattr(self, name + 'w'), getattr(self, name + 'b'), stride=self.strides[nl], groups=1 if nl == 0 else self.nbnets))
+        return activ.view(inputx.size(0), self.nbnets, self.params['nbf'])
+
+    def readout(self, activin, inputlabel, hebb):
+        # One step of the plastic output layer of all networks: activin is S x E x nbf, inputlabel E x nbclasses, hebb S x E x nbf x nbclasses
+        activ = torch.matmul(activin.unsqueeze(2), self.w + self.alpha * hebb).squeeze(2) + 1000.0 * inputlabel
+        activout = F.softmax(activ, dim=2)
+        if self.rule == 'hebb':
+            hebb = (1 - self.eta) * hebb + self.eta * activin.unsqueeze(3) * activout.unsqueeze(2)  # Batched outer product, by broadcasting
+        elif self.rule == 'oja':
+            hebb = hebb + self.eta * (activin.unsqueeze(3) - hebb * activout.unsqueeze(2)) * activout.unsqueeze(2)
+        else:
+            raise ValueError("Must select one learning rule ('hebb' or 'oja')")
+        return activout, hebb
+
+    def initialZeroHebb(self, nbepisodes):
+        return torch.zeros(self.nbnets, nbepisodes, self.params['nbf'], self.params['nbclasses'], device=self.w.device, dtype=self.w.dtype)
+
+    def forward(self, inputs, labels):
+        # Runs E whole episodes (inputs: nbsteps x E x 1 x h x w, labels: nbsteps x E x nbclasses) through all the
+        # networks, and returns the outputs at the last step (S x E x nbclasses)
+        nbsteps, E = inputs.size(0), inputs.size(1)
+        activins = self.embed(inputs.reshape((nbsteps * E,) + tuple(inputs.shape[2:]))).view(nbsteps, E, self.nbnets, self.params['nbf']).transpose(1, 2)
+        hebb = self.initialZeroHebb(E)
+        for numstep in range(nbsteps):
+            y, hebb = self.readout(activins[numstep], labels[numstep], hebb)
+        return y
@@ -52,6 +52,9 @@ import platform
 import numpy as np
 import glob
 
+import omnistore  # Preprocessed, memory-mapped image store (optional, see --store)
+import episodepool  # Background episode generation (optional, see --workers)
+
 
 
 
@@ -76,19 +79,20 @@ defaultParams = {
     'lr': 3e-5, 
     'test_every': 500,
     'save_every': 10000,
-    'rngseed':0
+    'rngseed':0,
+    'bs': 1,    # Number of independent episodes in each batch
+    'workers': 0,   # Number of background processes generating episodes (0: generate them in the training loop)
+    'store': ''    # Preprocessed image store built by omnistore.py (if empty, the PNG files are read directly)
 }
 NBTESTCLASSES = 100
 
 
 
 
-#ttype = torch.FloatTensor;
-ttype = torch.cuda.FloatTensor;
 
 
-# Generate the full list of inputs, labels, and the target label for an episode
-def generateInputsLabelsAndTarget(params, imagedata, test=False):
+# Generate the full list of inputs, labels, and the target label for an episode (as numpy arrays)
+def generateEpisode(params, imagedata, test=False):
     #print(("Input Boost:", params['inputboost']))
     #params['nbsteps'] = params['nbshots'] * ((params['prestime'] + params['ipd']) * params['nbclasses']) + params['prestimetest'] 
     inputT = np.zeros((params['nbsteps'], 1, 1, params['imgsize'], params['imgsize']))    #inputTensor, initially in numpy format... Note dimensions: number of steps x batchsize (always 1) x NbChannels (also 1) x h x w 
@@ -116,33 +120,30 @@ def generateInputsLabelsAndTarget(params, imagedata, test=False):
     unpermcats = cats.copy()      
 
     # Inserting the character images and labels in the input tensor at the proper places
+    # imagedata holds all the drawings of each character in all four rotations, at the final size
+    # (see omnistore.rotationcache), so this only records which drawing is shown at each step.
+    stepcats = np.full(params['nbsteps'], -1)  # -1: nothing shown (inter-presentation delay)
+    stepdrawings = np.zeros(params['nbsteps'], dtype='int64')
     location = 0
     for nc in range(params['nbshots']):
         np.random.shuffle(cats)   # Presentations occur in random order
         for ii, catnum in enumerate(cats):
             #print(catnum)
-            p = random.choice(imagedata[catnum])
-            for nr in range(rots[catnum]):
-                p = np.rot90(p)
-            p = skimage.transform.resize(p, (31, 31))
+            nd = random.randrange(imagedata.shape[1])
             for nn in range(params['prestime']):
-                #numi =nc * (params['nbclasses'] * (params['prestime']+params['ipd'])) + ii * (params['prestime']+params['ipd']) + nn
-
-                inputT[location][0][0][:][:] = p[:][:]
+                stepcats[location] = catnum; stepdrawings[location] = nd
                 labelT[location][0][np.where(unpermcats == catnum)] = 1 # The (one-hot) label is the position of the category number in the original (unpermuted) list
-                #if nn == 0:
-                #    print(labelT[location][0])
                 location += 1
             location += params['ipd']
 
     # Inserting the test character
-    p = random.choice(imagedata[testcat])
-    for nr in range(rots[testcat]):
-        p = np.rot90(p)
-    p = skimage.transform.resize(p, (31, 31))
+    nd = random.randrange(imagedata.shape[1])
     for nn in range(params['prestimetest']):
-        inputT[location][0][0][:][:] = p[:][:]
+        stepcats[location] = testcat; stepdrawings[location] = nd
         location += 1
+
+    shown = stepcats > -1
+    inputT[shown, 0, 0] = imagedata[stepcats[shown], stepdrawings[shown], rots[stepcats[shown]]]
         
     # Generating the test label
     testlabel = np.zeros(params['nbclasses'])
@@ -154,28 +155,39 @@ def generateInputsLabelsAndTarget(params, imagedata, test=False):
     
     assert(location == params['nbsteps'])
 
-    inputT = torch.from_numpy(inputT).type(ttype)  # Convert from numpy to pytorch Tensor
-    labelT = torch.from_numpy(labelT).type(ttype)
-    targetL = torch.from_numpy(testlabel).type(ttype)
+    return inputT, labelT, testlabel
+
+# Generate params['bs'] independent episodes (each with its own classes, rotations and test character), stacked along the batch dimension:
+# inputs are nbsteps x bs x 1 x h x w, labels nbsteps x bs x nbclasses, and targets bs x nbclasses (as numpy arrays)
+def generateBatch(params, imagedata, test=False):
+    episodes = [generateEpisode(params, imagedata, test) for nb in range(params['bs'])]
+    return np.concatenate([e[0] for e in episodes], axis=1), np.concatenate([e[1] for e in episodes], axis=1), np.stack([e[2] for e in episodes])
+
+# Same as generateBatch, as pytorch Tensors
+def generateInputsLabelsAndTarget(params, imagedata, test=False, device=None, dtype=torch.float32):
+    inputT, labelT, targetL = generateBatch(params, imagedata, test)
+    inputT = torch.from_numpy(inputT).to(device=device, dtype=dtype)  # Convert from numpy to pytorch Tensor
+    labelT = torch.from_numpy(labelT).to(device=device, dtype=dtype)
+    targetL = torch.from_numpy(targetL).to(device=device, dtype=dtype)
 
     return inputT, labelT, targetL
 
 
 
 class Network(nn.Module):
-    def __init__(self, params):
+    def __init__(self, params, device=None, dtype=torch.float32):
         super(Network, self).__init__()
         self.rule = params['rule']
         if params['flare'] == 1:
-            self.cv1 = torch.nn.Conv2d(1, params['nbf'] //4 , 3, stride=2).cuda()
-            self.cv2 = torch.nn.Conv2d(params['nbf'] //4 , params['nbf'] //4 , 3, stride=2).cuda()
-            self.cv3 = torch.nn.Conv2d(params['nbf'] //4, params['nbf'] //2, 3, stride=2).cuda()
-            self.cv4 = torch.nn.Conv2d(params['nbf'] //2,  params['nbf'], 3, stride=2).cuda()
+            self.cv1 = torch.nn.Conv2d(1, params['nbf'] //4 , 3, stride=2).to(device=device, dtype=dtype)
+            self.cv2 = torch.nn.Conv2d(params['nbf'] //4 , params['nbf'] //4 , 3, stride=2).to(device=device, dtype=dtype)
+            self.cv3 = torch.nn.Conv2d(params['nbf'] //4, params['nbf'] //2, 3, stride=2).to(device=device, dtype=dtype)
+            self.cv4 = torch.nn.Conv2d(params['nbf'] //2,  params['nbf'], 3, stride=2).to(device=device, dtype=dtype)
         else:
-            self.cv1 = torch.nn.Conv2d(1, params['nbf'] , 3, stride=2).cuda()
-            self.cv2 = torch.nn.Conv2d(params['nbf'] , params['nbf'] , 3, stride=2).cuda()
-            self.cv3 = torch.nn.Conv2d(params['nbf'] , params['nbf'] , 3, stride=2).cuda()
-            self.cv4 = torch.nn.Conv2d(params['nbf'] ,  params['nbf'], 3, stride=2).cuda()
+            self.cv1 = torch.nn.Conv2d(1, params['nbf'] , 3, stride=2).to(device=device, dtype=dtype)
+            self.cv2 = torch.nn.Conv2d(params['nbf'] , params['nbf'] , 3, stride=2).to(device=device, dtype=dtype)
+            self.cv3 = torch.nn.Conv2d(params['nbf'] , params['nbf'] , 3, stride=2).to(device=device, dtype=dtype)
+            self.cv4 = torch.nn.Conv2d(params['nbf'] ,  params['nbf'], 3, stride=2).to(device=device, dtype=dtype)
         
         # Alternative architecture: have a separate layer of
         # plastic weights between the embedding and the output. We don't use
@@ -185,18 +197,24 @@ class Network(nn.Module):
         # Notice that the vectors are row vectors, and the matrices are transposed wrt the usual order, following apparent pytorch conventions
         # Each *column* of w targets a single output neuron
         
-        self.w =  torch.nn.Parameter((.01 * torch.randn(params['nbf'], params['nbclasses'])).cuda(), requires_grad=True)
-        #self.w =  torch.nn.Parameter((.01 * torch.rand(params['plastsize'], params['nbclasses'])).cuda(), requires_grad=True)
+        self.w =  torch.nn.Parameter((.01 * torch.randn(params['nbf'], params['nbclasses'])).to(device=device, dtype=dtype), requires_grad=True)
+        #self.w =  torch.nn.Parameter((.01 * torch.rand(params['plastsize'], params['nbclasses'])).to(device=device, dtype=dtype), requires_grad=True)
         if params['alpha'] == 'free':
-            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['nbf'], params['nbclasses'])).cuda(), requires_grad=True) # Note: rand rather than randn (all positive)
+            self.alpha =  torch.nn.Parameter((.01 * torch.rand(params['nbf'], params['nbclasses'])).to(device=device, dtype=dtype), requires_grad=True) # Note: rand rather than randn (all positive)
         elif params['alpha'] == 'yoked':
-            self.alpha =  torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)
+            self.alpha =  torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)
         else :
             raise ValueError("Must select a value for alpha ('free' or 'yoked')")
-        self.eta = torch.nn.Parameter((.01 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
+        self.eta = torch.nn.Parameter((.01 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
         self.params = params
+        self.device, self.dtype = device, dtype
 
     def forward(self, inputx, inputlabel, hebb):
+        return self.readout(self.embed(inputx), inputlabel, hebb)
+
+    def embed(self, inputx):
+        # The convolutional embedding (N x nbf) of a stack of N images (N x 1 x h x w). It doesn't
+        # depend on the plastic weights, so all the steps of an episode can go through it at once.
         if self.params['activ'] == 'selu':
             activ = F.selu(self.cv1(inputx))
             activ = F.selu(self.cv2(activ))
@@ -216,26 +234,38 @@ class Network(nn.Module):
             raise ValueError("Parameter 'activ' is incorrect (must be tanh, relu or selu)")
         #activ = F.tanh(self.conv2plast(activ.view(1, self.params['nbf'])))
         #activin = activ.view(-1, self.params['plastsize'])
-        activin = activ.view(-1, self.params['nbf'])
-        
+        return activ.view(-1, self.params['nbf'])
+
+    def readout(self, activin, inputlabel, hebb):
+        # The plastic output layer, for a batch of B embeddings (B x nbf) and labels (B x nbclasses)
+        # hebb is either B x nbf x nbclasses, or nbf x nbclasses for a single episode (B = 1)
+        batched = (hebb.dim() == 3)
+        if not batched:
+            hebb = hebb.unsqueeze(0)
+
         if self.params['alpha'] == 'free':
-            activ = activin.mm( self.w + torch.mul(self.alpha, hebb)) + 1000.0 * inputlabel # The expectation is that a nonzero inputlabel will overwhelm the inputs and clamp the outputs
+            activ = torch.bmm(activin.unsqueeze(1), self.w + torch.mul(self.alpha, hebb)).squeeze(1) + 1000.0 * inputlabel # The expectation is that a nonzero inputlabel will overwhelm the inputs and clamp the outputs
         elif self.params['alpha'] == 'yoked':
-            activ = activin.mm( self.w + self.alpha * hebb) + 1000.0 * inputlabel # The expectation is that a nonzero inputlabel will overwhelm the inputs and clamp the outputs
-        activout = F.softmax( activ )
+            activ = torch.bmm(activin.unsqueeze(1), self.w + self.alpha * hebb).squeeze(1) + 1000.0 * inputlabel # The expectation is that a nonzero inputlabel will overwhelm the inputs and clamp the outputs
+        activout = F.softmax(activ, dim=1)
         
         if self.rule == 'hebb':
-            hebb = (1 - self.eta) * hebb + self.eta * torch.bmm(activin.unsqueeze(2), activout.unsqueeze(1))[0] # bmm used to implement outer product; remember activs have a leading singleton dimension
+            hebb = (1 - self.eta) * hebb + self.eta * torch.bmm(activin.unsqueeze(2), activout.unsqueeze(1)) # bmm used to implement the batched outer product
         elif self.rule == 'oja':
-            hebb = hebb + self.eta * torch.mul((activin[0].unsqueeze(1) - torch.mul(hebb , activout[0].unsqueeze(0))) , activout[0].unsqueeze(0))  # Oja's rule. Remember that yin, yout are row vectors (dim (1,N)). Also, broadcasting!
+            hebb = hebb + self.eta * torch.mul((activin.unsqueeze(2) - torch.mul(hebb , activout.unsqueeze(1))) , activout.unsqueeze(1))  # Oja's rule. Remember that yin, yout are row vectors. Also, broadcasting!
         else:
             raise ValueError("Must select one learning rule ('hebb' or 'oja')")
 
+        if not batched:
+            hebb = hebb[0]
         return activout, hebb
 
     def initialZeroHebb(self):
         #return Variable(torch.zeros(self.params['plastsize'], self.params['nbclasses']).type(ttype))
-        return Variable(torch.zeros(self.params['nbf'], self.params['nbclasses']).type(ttype))
+        # With a batch of episodes (params['bs'] > 1), each episode has its own Hebbian trace
+        if self.params.get('bs', 1) > 1:
+            return torch.zeros(self.params['bs'], self.params['nbf'], self.params['nbclasses'], device=self.device, dtype=self.dtype)
+        return Variable(torch.zeros(self.params['nbf'], self.params['nbclasses'], device=self.device, dtype=self.dtype))
 
 
 
@@ -251,7 +281,7 @@ def train(paramdict=None):
     print(platform.uname())
     sys.stdout.flush()
     params['nbsteps'] = params['nbshots'] * ((params['prestime'] + params['ipd']) * params['nbclasses']) + params['prestimetest']  # Total number of steps per episode
-    suffix = "W"+"".join([str(x)+"_" if pair[0] is not 'nbsteps' and pair[0] is not 'rngseed' and pair[0] is not 'save_every' and pair[0] is not 'test_every' else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
+    suffix = "W"+"".join([str(x)+"_" if pair[0] not in ('nbsteps', 'rngseed', 'save_every', 'test_every', 'store', 'workers') else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
     print("Suffix: ", suffix, "length:", len(suffix))
     # Initialize random seeds (first two redundant?)
     print("Setting random seeds")
@@ -259,35 +289,48 @@ def train(paramdict=None):
     #print(click.get_current_context().params)
 
 
-    print("Loading Omniglot data...")
-    imagedata = []
-    imagefilenames=[]
-
-    for basedir in ('/content/gdrive/MyDrive/project_files/data/omniglot/omniglot-master/images_background',
-                    '/content/gdrive/MyDrive/project_files/data/omniglot/omniglot-master/images_evaluation'):
-        alphabetdirs = glob.glob(basedir+'*')
-        print(alphabetdirs[:4])
-        for alphabetdir in alphabetdirs:
-            chardirs = glob.glob(alphabetdir+"/*")
-            for chardir in chardirs:
-                chardata = []
-                charfiles = glob.glob(chardir+'/*')
-                for fn in charfiles:
-                    filedata = skimage.io.imread(fn) / 255.0 #plt.imread(fn)
-                    chardata.append(filedata)
-                imagedata.append(chardata)
-                imagefilenames.append(fn)
-    # imagedata is now a list of lists of numpy arrays 
-    # imagedata[CharactertNumber][FileNumber] -> numpy(105,105)
-    np.random.shuffle(imagedata)  # Randomize order of characters 
+    if params['store']:
+        # Preprocessed, memory-mapped store (see omnistore.py)
+        print("Loading Omniglot data from store", params['store'])
+        imagedata = omnistore.OmniglotStore(params['store'])
+        if imagedata.imgsize is not None and imagedata.imgsize != params['imgsize']:
+            raise ValueError("The store was built with imgsize " + str(imagedata.imgsize) + ", but imgsize is " + str(params['imgsize']))
+        imagedata.shuffle()  # Randomize order of characters
+    else:
+        print("Loading Omniglot data...")
+        imagedata = []
+        imagefilenames=[]
+
+        for basedir in ('/content/gdrive/MyDrive/project_files/data/omniglot/omniglot-master/images_background',
+                        '/content/gdrive/MyDrive/project_files/data/omniglot/omniglot-master/images_evaluation'):
+            alphabetdirs = glob.glob(basedir+'*')
+            print(alphabetdirs[:4])
+            for alphabetdir in alphabetdirs:
+                chardirs = glob.glob(alphabetdir+"/*")
+                for chardir in chardirs:
+                    chardata = []
+                    charfiles = glob.glob(chardir+'/*')
+                    for fn in charfiles:
+                        filedata = skimage.io.imread(fn) / 255.0 #plt.imread(fn)
+                        chardata.append(filedata)
+                    imagedata.append(chardata)
+                    imagefilenames.append(fn)
+        # imagedata is now a list of lists of numpy arrays 
+        # imagedata[CharactertNumber][FileNumber] -> numpy(105,105)
+        np.random.shuffle(imagedata)  # Randomize order of characters 
     print(len(imagedata))
     print(imagedata[1][2].shape)
     print("Data loaded!")
+    # All drawings in all four rotations, at the final size: episode generation only indexes this array (see omnistore.py)
+    print("Precomputing resized and rotated images...")
+    imagedata = omnistore.rotationcache(imagedata, params['imgsize'])
 
 
 
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
     print("Initializing network")
-    net = Network(params)
+    net = Network(params, device=device)
     #net.cuda()
     print ("Shape of all optimized parameters:", [x.size() for x in net.parameters()])
     allsizes = [torch.numel(x.data.cpu()) for x in net.parameters()]
@@ -303,6 +346,12 @@ def train(paramdict=None):
 
 
 
+    # Optionally, generate the training episodes in background worker processes (see episodepool.py)
+    # Test episodes are still generated here, since they are rare.
+    pool = None
+    if params['workers'] > 0:
+        pool = episodepool.EpisodePool(generateBatch, (params, imagedata, False), params['workers'], params['rngseed'], device=device)
+
     all_losses = []
     all_losses_objective = []
     lossbetweensaves = 0.0
@@ -319,15 +368,20 @@ def train(paramdict=None):
         optimizer.zero_grad()
 
         is_test_step = ((numiter+1) % params['test_every'] == 0)
-        inputs, labels, target = generateInputsLabelsAndTarget(params, imagedata, test=is_test_step)
-
+        if pool is not None and not is_test_step:
+            inputs, labels, target = next(pool)
+        else:
+            inputs, labels, target = generateInputsLabelsAndTarget(params, imagedata, test=is_test_step, device=device)
 
+        # The convolutional embeddings of all the steps of all the episodes in the batch are computed at once,
+        # as a single (nbsteps * bs) convolution; only the plastic output layer runs step by step
+        activins = net.embed(inputs.view(-1, 1, params['imgsize'], params['imgsize'])).view(params['nbsteps'], params['bs'], params['nbf'])
         for numstep in range(params['nbsteps']):
-            y, hebb = net(Variable(inputs[numstep], requires_grad=False), Variable(labels[numstep], requires_grad=False), hebb)
+            y, hebb = net.readout(activins[numstep], labels[numstep], hebb)
 
-        # Compute the loss
+        # Compute the loss (averaged over the batch)
         criterion = torch.nn.BCELoss()
-        loss = criterion(y[0], Variable(target, requires_grad=False))
+        loss = criterion(y, target)
 
         # Compute the gradients
         if is_test_step == False:
@@ -345,7 +399,7 @@ def train(paramdict=None):
         if is_test_step: # (numiter+1) % params['test_every'] == 0:
 
             print(numiter, "====")
-            td = target.cpu().numpy()
+            td = target.cpu().numpy()[0]
             yd = y.data.cpu().numpy()[0]
             print("y: ", yd[:10])
             print("target: ", td[:10])
@@ -407,6 +461,9 @@ def train(paramdict=None):
             sys.stdout.flush()
             sys.stderr.flush()
 
+    if pool is not None:
+        pool.close()
+
 
 
 @click.command()
@@ -428,7 +485,10 @@ def train(paramdict=None):
 @click.option('--test_every', default=defaultParams['test_every'])
 @click.option('--save_every', default=defaultParams['save_every'])
 @click.option('--rngseed', default=defaultParams['rngseed'])
-def main(nbclasses, alpha, rule, gamma, steplr, activ, flare, nbshots, nbf, prestime, prestimetest, ipd, nbiter, lr, test_every, save_every, rngseed):
+@click.option('--store', default=defaultParams['store'])
+@click.option('--bs', default=defaultParams['bs'])
+@click.option('--workers', default=defaultParams['workers'])
+def main(nbclasses, alpha, rule, gamma, steplr, activ, flare, nbshots, nbf, prestime, prestimetest, ipd, nbiter, lr, test_every, save_every, rngseed, store, bs, workers):
     train(paramdict=dict(click.get_current_context().params))
     #print(dict(click.get_current_context().params))
 
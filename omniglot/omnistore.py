@@ -0,0 +1,203 @@
+# Differentiable plasticity: Omniglot task.
+
+# Copyright (c) 2018 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Compact on-disk store for the Omniglot images.
+#
+# Decoding the ~32000 PNG files of Omniglot at the start of every run is
+# slow, and keeping them as lists of 105x105 float64 arrays costs several GB
+# per process. This converts them once into a single array of shape
+# (nbchars, 20, H, W), stored either bit-packed (the original binary images)
+# or as uint8 grey levels (images pre-resized to 'imgsize'), plus a small
+# index file (omnistore.dat -> omnistore.dat.idx). The array is opened with
+# np.memmap, so that all the training processes on a node share the same
+# pages of the OS file cache.
+#
+# To build the store (once):
+# python3 omnistore.py --out omnistore.dat   (original size, bit-packed)
+# python3 omnistore.py --out omnistore31.dat --imgsize 31   (pre-resized)
+#
+# Then pass --store omnistore.dat to omniglot.py.
+
+import argparse
+import glob
+import os
+import pickle
+
+import numpy as np
+
+
+BASEDIRS = ('./omniglot-master/python/images_background/',
+            './omniglot-master/python/images_evaluation/')
+NBDRAWINGS = 20  # Number of drawings of each character in Omniglot
+
+
+def readimage(fn):
+    # Returns the image in fn as a float64 array in [0, 1] (Omniglot PNGs are 1-bit; depending on the reader, they may come as bool or uint8)
+    import skimage.io
+    img = np.asarray(skimage.io.imread(fn))
+    if img.dtype == np.bool_:
+        return img.astype('float64')
+    if img.dtype == np.uint8:
+        return img / 255.0
+    return img.astype('float64')
+
+
+def build(storefile, basedirs=BASEDIRS, imgsize=None):
+    # Reads all the characters under basedirs (alphabet/character/drawing.png) and writes the store
+    # If imgsize is given, images are resized to imgsize x imgsize (as in the episode generation) and stored as uint8
+    import skimage.transform
+    chardirs = [chardir for basedir in basedirs for alphabetdir in sorted(glob.glob(basedir + '*')) for chardir in sorted(glob.glob(alphabetdir + '/*'))]
+    if len(chardirs) == 0:
+        raise ValueError("No Omniglot characters found in " + str(basedirs))
+    first = readimage(sorted(glob.glob(chardirs[0] + '/*'))[0])
+    H, W = (imgsize, imgsize) if imgsize else first.shape
+    packed = imgsize is None
+    shape = (len(chardirs), NBDRAWINGS, H, (W + 7) // 8 if packed else W)
+    data = np.memmap(storefile, dtype='uint8', mode='w+', shape=shape)
+    for nc, chardir in enumerate(chardirs):
+        charfiles = sorted(glob.glob(chardir + '/*'))
+        if len(charfiles) != NBDRAWINGS:
+            raise ValueError("Expected " + str(NBDRAWINGS) + " drawings in " + chardir + ", found " + str(len(charfiles)))
+        for nd, fn in enumerate(charfiles):
+            img = readimage(fn)
+            if packed:
+                data[nc, nd] = np.packbits(img > .5, axis=-1)
+            else:
+                img = skimage.transform.resize(img, (H, W))
+                data[nc, nd] = np.round(np.clip(img, 0.0, 1.0) * 255.0).astype('uint8')
+    data.flush()
+    index = {'shape': shape, 'H': H, 'W': W, 'packed': packed, 'imgsize': imgsize,
+             'chars': [os.path.relpath(chardir, os.path.dirname(os.path.dirname(chardir.rstrip('/')))) for chardir in chardirs]}
+    with open(storefile + '.idx', 'wb') as fo:
+        pickle.dump(index, fo)
+    return index
+
+
+class OmniglotStore:
+    # Read-only view of a store, which behaves like the list of characters used by the episode
+    # generators: len(store) is the number of characters, and store[c] is the 20 x H x W
+    # float64 array of the drawings of character c (decoded on access).
+
+    def __init__(self, storefile):
+        self.storefile = storefile
+        with open(storefile + '.idx', 'rb') as fo:
+            self.index = pickle.load(fo)
+        self.data = np.memmap(storefile, dtype='uint8', mode='r', shape=tuple(self.index['shape']))
+        self.packed = self.index['packed']
+        self.H, self.W = self.index['H'], self.index['W']
+        self.imgsize = self.index['imgsize']
+        self.order = np.arange(self.data.shape[0])  # Order of the characters (see shuffle())
+
+    def __len__(self):
+        return len(self.order)
+
+    def shuffle(self):
+        # Randomizes the order of the characters, like np.random.shuffle on the list of characters (same random draws)
+        np.random.shuffle(self.order)
+
+    def raw(self, c):
+        # The stored (undecoded) data of character c
+        return self.data[self.order[c]]
+
+    def decode(self, raw):
+        # Decodes stored data (of any leading shape) into float64 images in [0, 1]
+        if self.packed:
+            return np.unpackbits(raw, axis=-1)[..., :self.W].astype('float64')
+        return raw / 255.0
+
+    def __getitem__(self, c):
+        return self.decode(self.raw(c))
+
+
+class RotationCache:
+    # All the drawings of all the characters, resized and rotated by 0, 90, 180 and 270 degrees, stored as a
+    # nbchars x 20 x 4 x imgsize x imgsize array: float32 in [0, 1], or uint8 grey levels (0-255). Behaves like
+    # the equivalent float32 array, except that only the indexed images are converted: cache[c, d, r] (with c a
+    # character number, or an array of them) returns float32 images. 'order' maps character numbers to rows of data, so that
+    # the data can stay in the order of the store (and be shared by all the processes) while the characters
+    # are shuffled.
+
+    def __init__(self, data, order=None):
+        self.data = data
+        self.order = np.arange(data.shape[0]) if order is None else order
+
+    def __len__(self):
+        return len(self.order)
+
+    @property
+    def shape(self):
+        return (len(self.order),) + tuple(self.data.shape[1:])
+
+    def __getitem__(self, idx):
+        idx = (self.order[idx[0]],) + tuple(idx[1:]) if isinstance(idx, tuple) else self.order[idx]
+        if self.data.dtype == np.uint8:
+            return np.asarray(self.data[idx], dtype='float32') * np.float32(1.0 / 255.0)
+        return np.asarray(self.data[idx], dtype='float32')
+
+
+def rotationcache(imagedata, imgsize, cachefile=None):
+    # Returns the RotationCache of all the drawings of all the characters in imagedata (a list of lists of
+    # images, or an OmniglotStore), resized to imgsize and rotated by 0, 90, 180 and 270 degrees.
+    # Episode generation then only needs to index it. (Images are resized before rotation, which is
+    # equivalent for square images.)
+    # For an OmniglotStore, the array is written once into cachefile (by default, the store file name +
+    # '.rot' + imgsize) as uint8 grey levels, which all the processes then open with np.memmap (the images
+    # are thus quantized to 256 levels, like those of a pre-resized store); for a list of images, it is
+    # kept in memory as float32 (shared with forked worker processes, which only read it).
+    isstore = isinstance(imagedata, OmniglotStore)
+    shape = (len(imagedata), NBDRAWINGS, 4, imgsize, imgsize)
+    if isstore:
+        if cachefile is None:
+            cachefile = imagedata.storefile + '.rot' + str(imgsize)
+        if (os.path.exists(cachefile) and os.path.getsize(cachefile) == int(np.prod(shape))
+                and os.path.getmtime(cachefile) >= os.path.getmtime(imagedata.storefile)):
+            return RotationCache(np.memmap(cachefile, dtype='uint8', mode='r', shape=shape), imagedata.order)
+        # Built into a temporary file, then renamed: concurrent runs never see a partial cache
+        tmpfile = cachefile + '.tmp' + str(os.getpid())
+        cache = np.memmap(tmpfile, dtype='uint8', mode='w+', shape=shape)
+    else:
+        cache = np.zeros(shape, dtype='float32')
+    import skimage.transform
+    for nc in range(len(imagedata)):
+        # The cache of a store follows the order of the store, not the (shuffled) order of the characters
+        drawings = imagedata.decode(imagedata.data[nc]) if isstore else imagedata[nc]
+        if len(drawings) != NBDRAWINGS:
+            raise ValueError("Expected " + str(NBDRAWINGS) + " drawings for character " + str(nc) + ", found " + str(len(drawings)))
+        for nd in range(NBDRAWINGS):
+            p = drawings[nd]
+            if p.shape != (imgsize, imgsize):
+                p = skimage.transform.resize(p, (imgsize, imgsize))
+            if isstore:
+                p = np.round(np.clip(p, 0.0, 1.0) * 255.0).astype('uint8')
+            for nr in range(4):
+                cache[nc, nd, nr] = np.rot90(p, nr)
+    if not isstore:
+        return RotationCache(cache)
+    cache.flush()
+    del cache
+    os.replace(tmpfile, cachefile)
+    return RotationCache(np.memmap(cachefile, dtype='uint8', mode='r', shape=shape), imagedata.order)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", help="file name of the store (the index is written to the same name + '.idx')", default='omnistore.dat')
+    parser.add_argument("--imgsize", type=int, help="resize images to imgsize x imgsize and store them as uint8 grey levels (0: keep the original binary images, bit-packed)", default=0)
+    parser.add_argument("dirs", nargs='*', help="Omniglot image directories", default=list(BASEDIRS))
+    args = parser.parse_args()
+    index = build(args.out, args.dirs, args.imgsize if args.imgsize > 0 else None)
+    print("Stored", index['shape'][0], "characters of", NBDRAWINGS, "drawings of size", index['H'], "x", index['W'], "in", args.out)
@@ -45,6 +45,9 @@ import matplotlib.pyplot as plt
 import glob
 
 import omniglot
+import omnistore
+import episodepool
+import ensemble
 
 from omniglot import Network
 
@@ -65,92 +68,41 @@ defaultParams = {
     'nbiter': 10000000,
     'learningrate': 1e-5,
     'print_every': 10,
-    'rngseed':0
+    'rngseed':0,
+    'nbseeds': 10,  # The networks trained with seeds 0 to nbseeds-1 are tested
+    'nbepisodes': 10000,  # Number of test episodes (the same for all networks)
+    'bs': 200,  # Number of test episodes evaluated at once
+    'workers': 0,  # Number of background processes generating episodes (0: generate them in the test loop)
+    'store': ''    # Preprocessed image store built by omnistore.py (if empty, the PNG files are read directly)
 }
 NBTESTCLASSES = 100
+EVALPARAMS = ('bs', 'nbepisodes', 'nbseeds', 'store', 'workers')
 
 
 
 
-#ttype = torch.FloatTensor;
-ttype = torch.cuda.FloatTensor;
-
-
-# Generate the full list of inputs, labels, and the target label for an episode
-def generateInputsLabelsAndTarget(params, imagedata, test=False):
-    #print(("Input Boost:", params['inputboost']))
-    #params['nbsteps'] = params['nbshots'] * ((params['prestime'] + params['interpresdelay']) * params['nbclasses']) + params['prestimetest'] 
-    inputT = np.zeros((params['nbsteps'], 1, 1, params['imagesize'], params['imagesize']))    #inputTensor, initially in numpy format... Note dimensions: number of steps x batchsize (always 1) x NbChannels (also 1) x h x w 
-    labelT = np.zeros((params['nbsteps'], 1, params['nbclasses']))      #labelTensor, initially in numpy format...
-
-    patterns=[]
-    if test:
-        cats = np.random.permutation(np.arange(len(imagedata) - NBTESTCLASSES, len(imagedata)))[:params['nbclasses']]  # Which categories to use for this *testing* episode?
-    else:
-        cats = np.random.permutation(np.arange(len(imagedata) - NBTESTCLASSES))[:params['nbclasses']]  # Which categories to use for this *training* episode?
-    #print("Test is", test, ", cats are", cats)
-    #cats = np.array(range(params['nbclasses'])) + 10
-
-    cats = np.random.permutation(cats)
-    #print(cats)
-
-    # We show one picture of each category, with labels, then one picture of one of these categories as a test, without label
-    # But each of the categories may undergo rotation by 0, 90, 180 or 270deg
-    # NOTE: We randomly assign one rotation to all the possible categories, not just the ones selected for the episode - it makes the coding simpler
-    rots = np.random.randint(4, size=len(imagedata))
-
-    #rots.fill(0)
-
-    testcat = random.choice(cats) # select the class on which we'll test in this episode
-    unpermcats = cats.copy()
-
-    # Inserting the character images and labels in the input tensor at the proper places
-    location = 0
-    for nc in range(params['nbshots']):
-        np.random.shuffle(cats)   # Presentations occur in random order
-        for ii, catnum in enumerate(cats):
-            #print(catnum)
-            p = random.choice(imagedata[catnum])
-            for nr in range(rots[catnum]):
-                p = np.rot90(p)
-            p = skimage.transform.resize(p, (31, 31))
-            for nn in range(params['prestime']):
-                #numi =nc * (params['nbclasses'] * (params['prestime']+params['interpresdelay'])) + ii * (params['prestime']+params['interpresdelay']) + nn
-
-                inputT[location][0][0][:][:] = p[:][:]
-                labelT[location][0][np.where(unpermcats == catnum)] = 1
-                #if nn == 0:
-                #    print(labelT[location][0])
-                location += 1
-            location += params['interpresdelay']
-
-    # Inserting the test character
-    p = random.choice(imagedata[testcat])
-    for nr in range(rots[testcat]):
-        p = np.rot90(p)
-    p = skimage.transform.resize(p, (31, 31))
-    for nn in range(params['prestimetest']):
-        inputT[location][0][0][:][:] = p[:][:]
-        location += 1
-        
-    # Generating the test label
-    testlabel = np.zeros(params['nbclasses'])
-    testlabel[np.where(unpermcats == testcat)] = 1
-    #print(testcat, testlabel)
-
-    #pdb.set_trace()
-        
-    
-    assert(location == params['nbsteps'])
-
-    inputT = torch.from_numpy(inputT).type(ttype)  # Convert from numpy to Tensor
-    labelT = torch.from_numpy(labelT).type(ttype)
-    targetL = torch.from_numpy(testlabel).type(ttype)
-
-    return inputT, labelT, targetL
-
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
+def loadnetworks(params, seeds):
+    # Loads the networks trained with each of the seeds (and the parameters they were trained with)
+    nets, loadedparams = [], None
+    for myseed in seeds:
+        #suffix="_Wactiv_tanh_alpha_free_flare_0_gamma_0.75_imgsize_31_ipd_0_lr_3e-05_nbclasses_5_nbf_64_nbiter_5000000_nbshots_1_prestime_1_prestimetest_1_rule_oja_steplr_1000000.0_rngseed_"+str(myseed)
+        suffix="_Wactiv_tanh_alpha_free_flare_0_gamma_0.666_imgsize_31_ipd_0_lr_3e-05_nbclasses_5_nbf_64_nbiter_5000000_nbshots_1_prestime_1_prestimetest_1_rule_oja_steplr_1000000.0_rngseed_"+str(myseed)+"_5000000"
+        with open('./tmp/results'+suffix+'.dat', 'rb') as fo:
+            for nbobj in range(4):  # w, alpha, eta and losses: the state dict below has the parameters
+                pickle.load(fo)
+            paramdictLoadedFromFile = pickle.load(fo)
+        netparams = dict(params)
+        netparams.update(paramdictLoadedFromFile)
+        netparams.update({key: params[key] for key in EVALPARAMS})  # The settings of this test run take precedence over the saved training settings
+        net = Network(netparams, device=device)
+        net.load_state_dict(torch.load('./tmp/torchmodel'+suffix + '.txt', map_location=device))
+        nets.append(net)
+        if loadedparams is None:
+            loadedparams = netparams
+    return nets, loadedparams
 
 
 def train(paramdict=None):
@@ -162,156 +114,95 @@ def train(paramdict=None):
     params.update(defaultParams)
     if paramdict:
         params.update(paramdict)
-    
-    #pdb.set_trace()
-
-    print("Loading Omniglot data...")
-    imagedata = []
-    imagefilenames=[]
-    for basedir in ('./omniglot-master/python/images_background/', 
-                    './omniglot-master/python/images_evaluation/'):
-        alphabetdirs = glob.glob(basedir+'*')
-        print(alphabetdirs[:4])
-        for alphabetdir in alphabetdirs:
-            chardirs = glob.glob(alphabetdir+"/*")
-            for chardir in chardirs:
-                chardata = []
-                charfiles = glob.glob(chardir+'/*')
-                for fn in charfiles:
-                    filedata = plt.imread(fn)
-                    chardata.append(filedata)
-                imagedata.append(chardata)
-                imagefilenames.append(fn)
-    # imagedata is now a list of lists of numpy arrays 
-    # imagedata[CharactertNumber][FileNumber] -> numpy(105,105)
-    np.random.shuffle(imagedata)  # Randomize order of characters 
+
+    # All the networks are loaded once, and evaluated together on the same episodes (see ensemble.py)
+    seeds = list(range(params['nbseeds']))
+    print("Loading networks for seeds", seeds)
+    nets, params = loadnetworks(params, seeds)
+    ens = ensemble.Ensemble(nets)
+    print("Passed params: ", params)
+    print(platform.uname())
+    sys.stdout.flush()
+    params['nbsteps'] = params['nbshots'] * ((params['prestime'] + params['ipd']) * params['nbclasses']) + params['prestimetest']  # Total number of steps per episode
+
+    if params['store']:
+        # Preprocessed, memory-mapped store (see omnistore.py)
+        print("Loading Omniglot data from store", params['store'])
+        imagedata = omnistore.OmniglotStore(params['store'])
+        if imagedata.imgsize is not None and imagedata.imgsize != params['imgsize']:
+            raise ValueError("The store was built with imgsize " + str(imagedata.imgsize) + ", but imgsize is " + str(params['imgsize']))
+        imagedata.shuffle()  # Randomize order of characters
+    else:
+        print("Loading Omniglot data...")
+        imagedata = []
+        imagefilenames=[]
+        for basedir in ('./omniglot-master/python/images_background/', 
+                        './omniglot-master/python/images_evaluation/'):
+            alphabetdirs = glob.glob(basedir+'*')
+            print(alphabetdirs[:4])
+            for alphabetdir in alphabetdirs:
+                chardirs = glob.glob(alphabetdir+"/*")
+                for chardir in chardirs:
+                    chardata = []
+                    charfiles = glob.glob(chardir+'/*')
+                    for fn in charfiles:
+                        filedata = plt.imread(fn)
+                        chardata.append(filedata)
+                    imagedata.append(chardata)
+                    imagefilenames.append(fn)
+        # imagedata is now a list of lists of numpy arrays 
+        # imagedata[CharactertNumber][FileNumber] -> numpy(105,105)
+        np.random.shuffle(imagedata)  # Randomize order of characters 
     print(len(imagedata))
     print(imagedata[1][2].shape)
     print("Data loaded!")
-
+    # All drawings in all four rotations, at the final size: episode generation only indexes this array (see omnistore.py)
+    print("Precomputing resized and rotated images...")
+    imagedata = omnistore.rotationcache(imagedata, params['imgsize'])
+
+    # Test episodes are generated in batches of params['bs'], optionally in background worker processes (see episodepool.py)
+    pool = None
+    if params['workers'] > 0:
+        pool = episodepool.EpisodePool(omniglot.generateBatch, (params, imagedata, True), params['workers'], 0, device=device)
+
+    nbepisodes = params['nbepisodes']
+    nbcorrect = np.zeros(len(seeds), dtype='int64')
+    all_losses = []
+    nowtime = time.time()
+    print("Starting episodes...")
+    sys.stdout.flush()
+    with torch.no_grad():
+        numepisode = 0
+        while numepisode < nbepisodes:
+            if pool is not None:
+                inputs, labels, target = next(pool)
+            else:
+                inputs, labels, target = omniglot.generateInputsLabelsAndTarget(params, imagedata, test=True, device=device)
+            E = min(params['bs'], nbepisodes - numepisode)
+            inputs, labels, target = inputs[:, :E], labels[:, :E], target[:E]
+            y = ens(inputs, labels)  # nbseeds x E x nbclasses
+            nbcorrect += (y.argmax(2) == target.argmax(1)).sum(1).cpu().numpy()
+            # Binary cross-entropy of each episode, as computed by torch.nn.BCELoss
+            losses = -(target * torch.clamp(torch.log(y), min=-100) + (1 - target) * torch.clamp(torch.log(1 - y), min=-100)).mean(2)
+            all_losses.append(losses.cpu().numpy())
+            numepisode += E
+    if pool is not None:
+        pool.close()
+    all_losses = np.concatenate(all_losses, axis=1)  # nbseeds x nbepisodes
+    print("Time spent on", nbepisodes, "episodes x", len(seeds), "networks:", time.time() - nowtime)
 
     successrates = []
-    totaliter = 0 
-    totalmistakes = 0
-
-    for myseed in range(10):
-
-
-        #suffix="_Wactiv_tanh_alpha_free_flare_0_gamma_0.75_imgsize_31_ipd_0_lr_3e-05_nbclasses_5_nbf_64_nbiter_5000000_nbshots_1_prestime_1_prestimetest_1_rule_oja_steplr_1000000.0_rngseed_"+str(myseed)
-        suffix="_Wactiv_tanh_alpha_free_flare_0_gamma_0.666_imgsize_31_ipd_0_lr_3e-05_nbclasses_5_nbf_64_nbiter_5000000_nbshots_1_prestime_1_prestimetest_1_rule_oja_steplr_1000000.0_rngseed_"+str(myseed)+"_5000000"
-        with open('./tmp/results'+suffix+'.dat', 'rb') as fo:
-            tmpw = torch.nn.Parameter(torch.from_numpy(pickle.load(fo)).type(ttype))
-            tmpalpha = torch.nn.Parameter(torch.from_numpy(pickle.load(fo)).type(ttype))
-            tmpeta = torch.nn.Parameter(torch.from_numpy(pickle.load(fo)).type(ttype))
-            tmplss = pickle.load(fo)
-            paramdictLoadedFromFile = pickle.load(fo)
-        
-        params.update(paramdictLoadedFromFile)
-
-        
-        print("Initializing network")
-        net = Network(params)
-        #net.cuda()
-        
-        print ("Size of all optimized parameters:", [x.size() for x in net.parameters()])
-        allsizes = [torch.numel(x.data.cpu()) for x in net.parameters()]
-        print ("Size (numel) of all optimized elements:", allsizes)
-        print ("Total size (numel) of all optimized elements:", sum(allsizes))
-
-        
-        print("Passed params: ", params)
-        print(platform.uname())
-        sys.stdout.flush()
-        params['nbsteps'] = params['nbshots'] * ((params['prestime'] + params['interpresdelay']) * params['nbclasses']) + params['prestimetest']  # Total number of steps per episode
-        
-        net.load_state_dict(torch.load('./tmp/torchmodel'+suffix + '.txt'))
-        
-        
-        
-        params['nbiter'] = 100
-
-
-
-        # Initialize random seeds ; not sure if really useful here...
-        #print("Setting random seed to", params['rngseed'])
-        #np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
-        #print(click.get_current_context().params)
-
-        total_loss = 0.0
-        #print("Initializing optimizer")
-        ##optimizer = torch.optim.Adam([net.w, net.alpha, net.eta], lr=params['learningrate'])
-        #optimizer = torch.optim.Adam(net.parameters(), lr=params['learningrate'])
-        all_losses = []
-        #print_every = 20
-        nowtime = time.time()
-        print("Starting episodes...")
-        sys.stdout.flush()
-
-        nbmistakes = 0
-
-        for numiter in range(params['nbiter']):
-            
-            hebb = net.initialZeroHebb()
-            #optimizer.zero_grad()
-
-
-            is_test_step = 1
-
-            inputs, labels, target = generateInputsLabelsAndTarget(params, imagedata, test=is_test_step)
-
-
-            for numstep in range(params['nbsteps']):
-                y, hebb = net(Variable(inputs[numstep], requires_grad=False), Variable(labels[numstep], requires_grad=False), hebb)
-
-            #loss = (y[0] - Variable(target, requires_grad=False)).pow(2).sum()
-            criterion = torch.nn.BCELoss()
-            loss = criterion(y[0], Variable(target, requires_grad=False))
-
-            #if is_test_step == False:
-            #    loss.backward()
-            #    optimizer.step()
-
-            lossnum = loss.data[0]
-            #total_loss  += lossnum
-            if is_test_step:
-                total_loss = lossnum
-
-            if is_test_step: # (numiter+1) % params['print_every'] == 0:
-
-                print(numiter, "====")
-                td = target.cpu().numpy()
-                yd = y.data.cpu().numpy()[0]
-                #print("y: ", yd[:10])
-                #print("target: ", td[:10])
-                if np.argmax(td) != np.argmax(yd):
-                    print("Mistake!")
-                    nbmistakes += 1
-                #print("target: ", target.unsqueeze(0)[0][:10])
-                absdiff = np.abs(td-yd)
-                #print("Mean / median / max abs diff:", np.mean(absdiff), np.median(absdiff), np.max(absdiff))
-                #print("Correlation (full / sign): ", np.corrcoef(td, yd)[0][1], np.corrcoef(np.sign(td), np.sign(yd))[0][1])
-                #print inputs[numstep]
-                previoustime = nowtime
-                nowtime = time.time()
-                #print("Time spent on last", params['print_every'], "iters: ", nowtime - previoustime)
-                #total_loss /= params['print_every']
-                #print("Mean loss over last", params['print_every'], "iters:", total_loss)
-                #print("Loss on single withheld-data episode:", lossnum)
-                all_losses.append(total_loss)
-                #print ("Eta: ", net.eta.data.cpu().numpy())
-                sys.stdout.flush()
-                sys.stderr.flush()
-
-                total_loss = 0
-
-        all_losses = np.array(all_losses)
-        print("Mean / std all losses :", np.mean(all_losses), np.std(all_losses))
-        print("1st Quartile / median / 3rd Quartile all losses :", np.percentile(all_losses, 25), np.percentile(all_losses, 50), np.percentile(all_losses, 75))
-        print("Max of all losses :", np.max(all_losses))
-        print("Nb of mistakes :", nbmistakes, "over", numiter+1, "trials - (", 100.0 - 100.0 * nbmistakes / (numiter+1), " % correct )")
-        successrates.append(100.0 - 100.0 * nbmistakes / (numiter+1))
-        totalmistakes += nbmistakes
-        totaliter += params['nbiter']
+    for ns, myseed in enumerate(seeds):
+        successrate = nbcorrect[ns] / nbepisodes
+        CI = 1.96 * np.sqrt(successrate * (1.0 - successrate) / nbepisodes)
+        print("Seed", myseed, "====")
+        print("Mean / std all losses :", np.mean(all_losses[ns]), np.std(all_losses[ns]))
+        print("1st Quartile / median / 3rd Quartile all losses :", np.percentile(all_losses[ns], 25), np.percentile(all_losses[ns], 50), np.percentile(all_losses[ns], 75))
+        print("Max of all losses :", np.max(all_losses[ns]))
+        print("Nb of mistakes :", nbepisodes - nbcorrect[ns], "over", nbepisodes, "trials - (", 100.0 * successrate, "+/-", 100.0 * CI, " % correct, 95% CI )")
+        successrates.append(100.0 * successrate)
+    totalmistakes = int(len(seeds) * nbepisodes - nbcorrect.sum())
+    totaliter = len(seeds) * nbepisodes
 
     print ("Mean / stdev success rate across runs: ", np.mean(successrates), np.std(successrates))
     totalsuccessrate = 1.0 - totalmistakes / totaliter
@@ -333,7 +224,12 @@ def train(paramdict=None):
 @click.option('--learningrate', default=defaultParams['learningrate'])
 @click.option('--print_every', default=defaultParams['print_every'])
 @click.option('--rngseed', default=defaultParams['rngseed'])
-def main(nbclasses, nbshots, prestime, prestimetest, interpresdelay, nbiter, learningrate, print_every, rngseed):
+@click.option('--store', default=defaultParams['store'])
+@click.option('--workers', default=defaultParams['workers'])
+@click.option('--nbseeds', default=defaultParams['nbseeds'])
+@click.option('--nbepisodes', default=defaultParams['nbepisodes'])
+@click.option('--bs', default=defaultParams['bs'])
+def main(nbclasses, nbshots, prestime, prestimetest, interpresdelay, nbiter, learningrate, print_every, rngseed, store, workers, nbseeds, nbepisodes, bs):
     train(paramdict=dict(click.get_current_context().params))
     #print(dict(click.get_current_context().params))
 
@@ -74,12 +74,11 @@ NBSTEPS = NBPRESCYCLES * ((PRESTIME + INTERPRESDELAY) * NBPATTERNS) + PRESTIMETE
 
 
 
-#ttype = torch.FloatTensor;         # For CPU
-ttype = torch.cuda.FloatTensor;     # For GPU
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 # Generate the full list of inputs for an episode. The inputs are returned as a PyTorch tensor of shape NbSteps x 1 x NbNeur
-def generateInputsAndTarget():
+def generateInputsAndTarget(device=None, dtype=torch.float32):
     inputT = np.zeros((NBSTEPS, 1, NBNEUR)) #inputTensor, initially in numpy format...
 
     # Create the random patterns to be memorized in an episode
@@ -110,8 +109,8 @@ def generateInputsAndTarget():
     for nn in range(NBSTEPS):
         inputT[nn][0][-1] = 1.0  # Bias neuron.
         inputT[nn] *= 20.0       # Strengthen inputs
-    inputT = torch.from_numpy(inputT).type(ttype)  # Convert from numpy to Tensor
-    target = torch.from_numpy(testpattern).type(ttype)
+    inputT = torch.from_numpy(inputT).to(device=device, dtype=dtype)  # Convert from numpy to Tensor
+    target = torch.from_numpy(testpattern).to(device=device, dtype=dtype)
 
     return inputT, target
 
@@ -119,13 +118,14 @@ def generateInputsAndTarget():
 
 
 class NETWORK(nn.Module):
-    def __init__(self):
+    def __init__(self, device=None, dtype=torch.float32):
         super(NETWORK, self).__init__()
+        self.device, self.dtype = device, dtype
         # Notice that the vectors are row vectors, and the matrices are transposed wrt the usual order, following apparent pytorch conventions
         # Each *column* of w targets a single output neuron
-        self.w = Variable(.01 * torch.randn(NBNEUR, NBNEUR).type(ttype), requires_grad=True)   # The matrix of fixed (baseline) weights
-        self.alpha = Variable(.01 * torch.randn(NBNEUR, NBNEUR).type(ttype), requires_grad=True)  # The matrix of plasticity coefficients
-        self.eta = Variable(.01 * torch.ones(1).type(ttype), requires_grad=True)  # The eta coefficient is learned
+        self.w = Variable(.01 * torch.randn(NBNEUR, NBNEUR).to(device=device, dtype=dtype), requires_grad=True)   # The matrix of fixed (baseline) weights
+        self.alpha = Variable(.01 * torch.randn(NBNEUR, NBNEUR).to(device=device, dtype=dtype), requires_grad=True)  # The matrix of plasticity coefficients
+        self.eta = Variable(.01 * torch.ones(1).to(device=device, dtype=dtype), requires_grad=True)  # The eta coefficient is learned
         self.zeroDiagAlpha()  # No plastic autapses
 
     def forward(self, input, yin, hebb):
@@ -140,10 +140,10 @@ class NETWORK(nn.Module):
         return yout, hebb
 
     def initialZeroState(self):
-        return Variable(torch.zeros(1, NBNEUR).type(ttype))
+        return Variable(torch.zeros(1, NBNEUR, device=self.device, dtype=self.dtype))
 
     def initialZeroHebb(self):
-        return Variable(torch.zeros(NBNEUR, NBNEUR).type(ttype))
+        return Variable(torch.zeros(NBNEUR, NBNEUR, device=self.device, dtype=self.dtype))
 
     def zeroDiagAlpha(self):
         # Zero out the diagonal of the matrix of alpha coefficients: no plastic autapses
@@ -156,7 +156,7 @@ np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_
 
 
 
-net = NETWORK()
+net = NETWORK(device=device)
 optimizer = torch.optim.Adam([net.w, net.alpha, net.eta], lr=ADAMLEARNINGRATE)
 total_loss = 0.0; all_losses = []
 print_every = 100
@@ -171,7 +171,7 @@ for numiter in range(params['nbiter']):
     optimizer.zero_grad()
 
     # Generate the inputs and target pattern for this episode
-    inputs, target = generateInputsAndTarget()
+    inputs, target = generateInputsAndTarget(device=device)
 
     # Run the episode!
     for numstep in range(NBSTEPS):
@@ -84,11 +84,10 @@ RNGSEED = params['rngseed']
 #INTERPRESDELAY = 1      # Duration of zero-input interval between presentations
 #NBSTEPS = NBPRESCYCLES * ((PRESTIME + INTERPRESDELAY) * NBPATTERNS) + PRESTIMETEST  # Total number of steps per episode
 
-#ttype = torch.FloatTensor;
-ttype = torch.cuda.FloatTensor;
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 # Generate the full list of inputs for an episode. The inputs are returned as a PyTorch tensor of shape NbSteps x 1 x NbNeur
-def generateInputsAndTarget():
+def generateInputsAndTarget(device=None, dtype=torch.float32):
     #inputT = np.zeros((NBSTEPS, 1, NBNEUR)) #inputTensor, initially in numpy format...
     inputT = np.zeros((NBSTEPS, 1, PATTERNSIZE)) #inputTensor, initially in numpy format...
 
@@ -125,8 +124,8 @@ def generateInputsAndTarget():
     for nn in range(NBSTEPS):
         #inputT[nn][0][-1] = 1.0  # Bias neuron.
         inputT[nn] *= 100.0       # Strengthen inputs
-    inputT = torch.from_numpy(inputT).type(ttype)  # Convert from numpy to Tensor
-    target = torch.from_numpy(testpattern).type(ttype)
+    inputT = torch.from_numpy(inputT).to(device=device, dtype=dtype)  # Convert from numpy to Tensor
+    target = torch.from_numpy(testpattern).to(device=device, dtype=dtype)
 
     return inputT, target
 
@@ -136,9 +135,10 @@ def generateInputsAndTarget():
 
 
 class NETWORK(nn.Module):
-    def __init__(self):
+    def __init__(self, device=None, dtype=torch.float32):
         super(NETWORK, self).__init__()
-        self.lstm = torch.nn.LSTM(PATTERNSIZE, NBHIDDENNEUR).cuda() #input size, hidden size
+        self.device, self.dtype = device, dtype
+        self.lstm = torch.nn.LSTM(PATTERNSIZE, NBHIDDENNEUR).to(device=device, dtype=dtype) #input size, hidden size
         self.hidden = self.initialZeroState() # Note that the "hidden state" is a tuple (hidden state, cells state)
 
 
@@ -175,8 +175,8 @@ class NETWORK(nn.Module):
         #return yout, hebb
 
     def initialZeroState(self):
-        return (Variable(torch.zeros(1, 1, NBHIDDENNEUR).type(ttype)),
-                                Variable(torch.zeros(1, 1, NBHIDDENNEUR).type(ttype)))
+        return (Variable(torch.zeros(1, 1, NBHIDDENNEUR, device=self.device, dtype=self.dtype)),
+                                Variable(torch.zeros(1, 1, NBHIDDENNEUR, device=self.device, dtype=self.dtype)))
 
 
 if len(sys.argv) == 2:
@@ -187,7 +187,7 @@ np.set_printoptions(precision=3)
 np.random.seed(RNGSEED); random.seed(RNGSEED); torch.manual_seed(RNGSEED)
 
 
-net = NETWORK()
+net = NETWORK(device=device)
 optimizer = torch.optim.Adam(net.parameters(), lr=ADAMLEARNINGRATE)
 total_loss = 0.0; all_losses = []
 print_every = 100
@@ -201,7 +201,7 @@ for numiter in range(params['nbiter']):
     net.hidden = net.initialZeroState()
 
     # Generate the inputs and target pattern for this episode
-    inputs, target = generateInputsAndTarget()
+    inputs, target = generateInputsAndTarget(device=device)
 
     # Run the episode!
     y = net(Variable(inputs, requires_grad=False))[-1][0]
@@ -17,7 +17,7 @@
 # This program is meant as a simple instructional example for differentiable plasticity. It is fully functional but not very flexible.
 
 # Usage: python simple.py [rngseed], where rngseed is an optional parameter specifying the seed of the random number generator. 
-# To use it on a GPU or CPU, toggle comments on the 'ttype' declaration below.
+# It runs on the GPU if one is available, otherwise on the CPU.
 
 
 
@@ -61,12 +61,11 @@ np.set_printoptions(precision=3)
 np.random.seed(RNGSEED); random.seed(RNGSEED); torch.manual_seed(RNGSEED)
 
 
-#ttype = torch.FloatTensor;         # For CPU
-ttype = torch.cuda.FloatTensor;     # For GPU
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 # Generate the full list of inputs for an episode. The inputs are returned as a PyTorch tensor of shape NbSteps x 1 x NbNeur
-def generateInputsAndTarget():
+def generateInputsAndTarget(device=None, dtype=torch.float32):
     inputT = np.zeros((NBSTEPS, 1, NBNEUR)) #inputTensor, initially in numpy format...
 
     # Create the random patterns to be memorized in an episode
@@ -97,21 +96,22 @@ def generateInputsAndTarget():
     for nn in range(NBSTEPS):
         inputT[nn][0][-1] = 1.0  # Bias neuron.
         inputT[nn] *= 20.0       # Strengthen inputs
-    inputT = torch.from_numpy(inputT).type(ttype)  # Convert from numpy to Tensor
-    target = torch.from_numpy(testpattern).type(ttype)
+    inputT = torch.from_numpy(inputT).to(device=device, dtype=dtype)  # Convert from numpy to Tensor
+    target = torch.from_numpy(testpattern).to(device=device, dtype=dtype)
 
     return inputT, target
 
 
 
 class NETWORK(nn.Module):
-    def __init__(self):
+    def __init__(self, device=None, dtype=torch.float32):
         super(NETWORK, self).__init__()
+        self.device, self.dtype = device, dtype
         # Notice that the vectors are row vectors, and the matrices are transposed wrt the usual order, following apparent pytorch conventions
         # Each *column* of w targets a single output neuron
-        self.w = Variable(.01 * torch.randn(NBNEUR, NBNEUR).type(ttype), requires_grad=True)   # The matrix of fixed (baseline) weights
-        self.alpha = Variable(.01 * torch.randn(NBNEUR, NBNEUR).type(ttype), requires_grad=True)  # The matrix of plasticity coefficients
-        self.eta = Variable(.01 * torch.ones(1).type(ttype), requires_grad=True)  # The weight decay term / "learning rate" of plasticity - trainable, but shared across all connections
+        self.w = Variable(.01 * torch.randn(NBNEUR, NBNEUR).to(device=device, dtype=dtype), requires_grad=True)   # The matrix of fixed (baseline) weights
+        self.alpha = Variable(.01 * torch.randn(NBNEUR, NBNEUR).to(device=device, dtype=dtype), requires_grad=True)  # The matrix of plasticity coefficients
+        self.eta = Variable(.01 * torch.ones(1).to(device=device, dtype=dtype), requires_grad=True)  # The weight decay term / "learning rate" of plasticity - trainable, but shared across all connections
 
     def forward(self, input, yin, hebb):
         # Run the network for one timestep
@@ -121,14 +121,14 @@ class NETWORK(nn.Module):
 
     def initialZeroState(self):
         # Return an initialized, all-zero hidden state
-        return Variable(torch.zeros(1, NBNEUR).type(ttype))
+        return Variable(torch.zeros(1, NBNEUR, device=self.device, dtype=self.dtype))
 
     def initialZeroHebb(self):
         # Return an initialized, all-zero Hebbian trace
-        return Variable(torch.zeros(NBNEUR, NBNEUR).type(ttype))
+        return Variable(torch.zeros(NBNEUR, NBNEUR, device=self.device, dtype=self.dtype))
 
 
-net = NETWORK()
+net = NETWORK(device=device)
 optimizer = torch.optim.Adam([net.w, net.alpha, net.eta], lr=ADAMLEARNINGRATE)
 total_loss = 0.0; all_losses = []
 print_every = 10
@@ -141,7 +141,7 @@ for numiter in range(2000):
     optimizer.zero_grad()
 
     # Generate the inputs and target pattern for this episode
-    inputs, target = generateInputsAndTarget()
+    inputs, target = generateInputsAndTarget(device=device)
 
     # Run the episode!
     for numstep in range(NBSTEPS):
@@ -44,7 +44,9 @@ import platform
 
 import numpy as np
 
-
+import hebbtrace  # Fused Hebbian trace updates
+import mazeenv  # Vectorised maze environment
+import discount  # Discounted returns and advantages
 
 
 
@@ -64,9 +66,11 @@ TOTALNBINPUTS =  RFSIZE * RFSIZE + ADDITIONALINPUTS + NBACTIONS
 # RNN with trainable modulated plasticity ("backpropamine")
 class Network(nn.Module):
     
-    def __init__(self, isize, hsize): 
+    def __init__(self, isize, hsize, lowrank=0): 
         super(Network, self).__init__()
         self.hsize, self.isize  = hsize, isize 
+        self.clipval = 2.0  # Maximum magnitude of the Hebbian traces
+        self.lowrank = lowrank  # If > 0, store the Hebbian traces as up to this many outer-product factors while they remain low-rank (see hebbtrace.py)
 
         self.i2h = torch.nn.Linear(isize, hsize)    # Weights from input to recurrent layer
         self.w =  torch.nn.Parameter(.001 * torch.rand(hsize, hsize))   # Baseline (non-plastic) component of the plastic recurrent layer
@@ -91,12 +95,17 @@ class Network(nn.Module):
 
 
             # Each *column* of w, alpha and hebb contains the inputs weights to a single neuron
-            hactiv = torch.tanh( self.i2h(inputs) + hidden[0].unsqueeze(1).bmm(self.w + torch.mul(self.alpha, hebb)).squeeze(1)  )  # Update the h-state
+            if isinstance(hebb, hebbtrace.LowRankHebb):
+                # Low-rank trace: the plastic part of the recurrent input is computed from the factors of hebb
+                hactiv = torch.tanh( self.i2h(inputs) + hidden[0].mm(self.w) + hebb.vm(hidden[0], self.alpha) )
+            else:
+                hactiv = torch.tanh( self.i2h(inputs) + hidden[0].unsqueeze(1).bmm(self.w + torch.mul(self.alpha, hebb)).squeeze(1)  )  # Update the h-state
             activout = self.h2o(hactiv)  # Pure linear, raw scores - to be softmaxed later, outside the function
             valueout = self.h2v(hactiv)
 
             # Now computing the Hebbian updates...
-            deltahebb = torch.bmm(hidden[0].unsqueeze(2), hactiv.unsqueeze(1))  # Batched outer product of previous hidden state with new hidden state
+            # deltahebb is the batched outer product of previous hidden state with new hidden state:
+            # deltahebb = torch.bmm(hidden[0].unsqueeze(2), hactiv.unsqueeze(1))
             
             # We also need to compute the eta (the plasticity rate), wich is determined by neuromodulation
             # Note that this is "simple" neuromodulation.
@@ -111,9 +120,10 @@ class Network(nn.Module):
             myeta = self.modfanout(myeta) 
             
             
-            # Updating Hebbian traces, with a hard clip (other choices are possible)
-            self.clipval = 2.0
-            hebb = torch.clamp(hebb + myeta * deltahebb, min=-self.clipval, max=self.clipval)
+            # Updating Hebbian traces, with a hard clip (other choices are possible, see hebbtrace.py)
+            # This is equivalent to: hebb = torch.clamp(hebb + myeta * deltahebb, min=-self.clipval, max=self.clipval)
+            # but deltahebb is never explicitly computed or stored.
+            hebb = hebbtrace.hebbupdate(hebb, hidden[0], hactiv, myeta, 'clip', self.clipval)
 
             hidden = (hactiv, hebb)
             return activout, valueout, hidden
@@ -126,6 +136,8 @@ class Network(nn.Module):
 
     # In plastic networks, we must also initialize the Hebbian state:
     def initialZeroHebb(self, BATCHSIZE):
+        if self.lowrank > 0:
+            return hebbtrace.LowRankHebb.zeros(BATCHSIZE, self.hsize, self.hsize, self.lowrank, 'clip', self.clipval, device=self.w.device, dtype=self.w.dtype)
         return Variable(torch.zeros(BATCHSIZE, self.hsize, self.hsize) , requires_grad=False)
 
 
@@ -146,7 +158,10 @@ def train(paramdict):
     print("Passed params: ", params)
     print(platform.uname())
     #params['nbsteps'] = params['nbshots'] * ((params['prestime'] + params['interpresdelay']) * params['nbclasses']) + params['prestimetest']  # Total number of steps per episode
-    suffix = "btchFixmod_"+"".join([str(x)+"_" if pair[0] is not 'nbsteps' and pair[0] is not 'rngseed' and pair[0] is not 'save_every' and pair[0] is not 'test_every' and pair[0] is not 'pe' else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
+    suffix = "btchFixmod_"+"".join([str(x)+"_" if pair[0] not in ('nbsteps', 'rngseed', 'save_every', 'test_every', 'pe', 'lowrank', 'lam') else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1]   # Turning the parameters into a nice suffix for filenames
+    if params['lam'] != 1.0:
+        suffix += "_lam_" + str(params['lam'])   # GAE runs get their own files; lambda = 1.0 keeps the old suffix
+    suffix += "_rngseed_" + str(params['rngseed'])
 
     # Initialize random seeds (first two redundant?)
     print("Setting random seeds")
@@ -157,7 +172,7 @@ def train(paramdict):
     use_cuda = torch.cuda.is_available()
     device = torch.device("cuda" if use_cuda else "cpu")
     
-    net = Network(TOTALNBINPUTS, params['hs']).to(device)  # Creating the network
+    net = Network(TOTALNBINPUTS, params['hs'], params['lowrank']).to(device)  # Creating the network
     
     print ("Shape of all optimized parameters:", [x.size() for x in net.parameters()])
     allsizes = [torch.numel(x.data.cpu()) for x in net.parameters()]
@@ -174,21 +189,11 @@ def train(paramdict):
     BATCHSIZE = params['bs']
 
     LABSIZE = params['msize'] 
-    lab = np.ones((LABSIZE, LABSIZE))
     CTR = LABSIZE // 2 
 
-
-    # Grid maze
-    lab[1:LABSIZE-1, 1:LABSIZE-1].fill(0)
-    for row in range(1, LABSIZE - 1):
-        for col in range(1, LABSIZE - 1):
-            if row % 2 == 0 and col % 2 == 0:
-                lab[row, col] = 1
-    # Not strictly necessary, but cleaner since we start the agent at the
-    # center for each episode; may help loclization in some maze sizes
-    # (including 13 and 9, but not 11) by introducing a detectable irregularity
-    # in the center:
-    lab[CTR,CTR] = 0 
+    # Grid maze, and the batch of environments that simulates all the agents at once (see mazeenv.py)
+    lab = mazeenv.gridmaze(LABSIZE)
+    env = mazeenv.MazeEnv(lab, BATCHSIZE, params['eplen'], params['rew'], params['wp'], RFSIZE, ADDITIONALINPUTS, NBACTIONS)
 
 
 
@@ -226,19 +231,7 @@ def train(paramdict):
         # Select the reward location for this episode - not on a wall!
         # And not on the center either! (though not sure how useful that restriction is...)
         # We always start the episode from the center 
-        posr = {}; posc = {}
-        rposr = {}; rposc = {}
-        for nb in range(BATCHSIZE):
-            # Note: it doesn't matter if the reward is on the center (see below). All we need is not to put it on a wall or pillar (lab=1)
-            myrposr = 0; myrposc = 0
-            while lab[myrposr, myrposc] == 1 or (myrposr == CTR and myrposc == CTR):
-                myrposr = np.random.randint(1, LABSIZE - 1)
-                myrposc = np.random.randint(1, LABSIZE - 1)
-            rposr[nb] = myrposr; rposc[nb] = myrposc
-            #print("Reward pos:", rposr, rposc)
-            # Agent always starts an episode from the center
-            posc[nb] = CTR
-            posr[nb] = CTR
+        inputs = env.reset()
 
         optimizer.zero_grad()
         loss = 0
@@ -263,18 +256,6 @@ def train(paramdict):
 
 
 
-            inputs = np.zeros((BATCHSIZE, TOTALNBINPUTS), dtype='float32') 
-        
-            labg = lab.copy()
-            for nb in range(BATCHSIZE):
-                inputs[nb, 0:RFSIZE * RFSIZE] = labg[posr[nb] - RFSIZE//2:posr[nb] + RFSIZE//2 +1, posc[nb] - RFSIZE //2:posc[nb] + RFSIZE//2 +1].flatten() * 1.0
-                
-                # Previous chosen action
-                inputs[nb, RFSIZE * RFSIZE +1] = 1.0 # Bias neuron
-                inputs[nb, RFSIZE * RFSIZE +2] = numstep / params['eplen']
-                inputs[nb, RFSIZE * RFSIZE +3] = 1.0 * reward[nb]
-                inputs[nb, RFSIZE * RFSIZE + ADDITIONALINPUTS + numactionschosen[nb]] = 1
-            
             inputsC = torch.from_numpy(inputs).to(device)
 
             ## Running the network
@@ -286,43 +267,9 @@ def train(paramdict):
             actionschosen = distrib.sample()  
             logprobs.append(distrib.log_prob(actionschosen))
             numactionschosen = actionschosen.data.cpu().numpy()  # We want to break gradients
-            reward = np.zeros(BATCHSIZE, dtype='float32')
-
-
-            for nb in range(BATCHSIZE):
-                myreward = 0
-                numactionchosen = numactionschosen[nb]
-
-                tgtposc = posc[nb]
-                tgtposr = posr[nb]
-                if numactionchosen == 0:  # Up
-                    tgtposr -= 1
-                elif numactionchosen == 1:  # Down
-                    tgtposr += 1
-                elif numactionchosen == 2:  # Left
-                    tgtposc -= 1
-                elif numactionchosen == 3:  # Right
-                    tgtposc += 1
-                else:
-                    raise ValueError("Wrong Action")
-                
-                reward[nb] = 0.0  # The reward for this step
-                if lab[tgtposr][tgtposc] == 1:
-                    reward[nb] -= params['wp']
-                else:
-                    posc[nb] = tgtposc
-                    posr[nb] = tgtposr
-
-                # Did we hit the reward location ? Increase reward and teleport!
-                # Note that it doesn't matter if we teleport onto the reward, since reward hitting is only evaluated after the (obligatory) move...
-                # But we still avoid it.
-                if rposr[nb] == posr[nb] and rposc[nb] == posc[nb]:
-                    reward[nb] += params['rew']
-                    posr[nb]= np.random.randint(1, LABSIZE - 1)
-                    posc[nb] = np.random.randint(1, LABSIZE - 1)
-                    while lab[posr[nb], posc[nb]] == 1 or (rposr[nb] == posr[nb] and rposc[nb] == posc[nb]):
-                        posr[nb] = np.random.randint(1, LABSIZE - 1)
-                        posc[nb] = np.random.randint(1, LABSIZE - 1)
+
+            # Move all the agents; wall penalties, rewards and teleports are computed in the environment (see mazeenv.py)
+            reward, inputs = env.step(numactionschosen)
 
             rewards.append(reward)
             vs.append(v)
@@ -343,14 +290,13 @@ def train(paramdict):
         # Episode is done, now let's do the actual computations of rewards and losses for the A2C algorithm
 
 
-        R = torch.zeros(BATCHSIZE).to(device)
+        # Returns and advantages for the whole episode at once (see discount.py), with a single host-to-device copy of the rewards
         gammaR = params['gr']
-        for numstepb in reversed(range(params['eplen'])) :
-            R = gammaR * R + torch.from_numpy(rewards[numstepb]).to(device)
-            ctrR = R - vs[numstepb][0]
-            lossv += ctrR.pow(2).sum() / BATCHSIZE
-            loss -= (logprobs[numstepb] * ctrR.detach()).sum() / BATCHSIZE  
-            #pdb.set_trace()
+        rewardsT = torch.from_numpy(np.stack(rewards)).to(device)
+        Rs = discount.returns(rewardsT, gammaR)
+        values = torch.stack(vs)[:, 0, :]  # The value prediction of the first element in the batch is used as baseline for all of them
+        lossv = (Rs - values).pow(2).sum() / BATCHSIZE
+        loss -= (torch.stack(logprobs) * discount.advantages(rewardsT, values, gammaR, params['lam'])).sum() / BATCHSIZE
 
 
 
@@ -419,6 +365,7 @@ if __name__ == "__main__":
     parser.add_argument("--blossv", type=float, help="coefficient for value prediction loss", default=.1)
     parser.add_argument("--msize", type=int, help="size of the maze; must be odd", default=11)
     parser.add_argument("--gr", type=float, help="gammaR: discounting factor for rewards", default=.9)
+    parser.add_argument("--lam", type=float, help="lambda of generalized advantage estimation (1.0: plain discounted returns minus value, as in standard A2C)", default=1.0)
     parser.add_argument("--gc", type=float, help="gradient norm clipping", default=4.0)
     parser.add_argument("--lr", type=float, help="learning rate (Adam optimizer)", default=1e-4)
     parser.add_argument("--eplen", type=int, help="length of episodes", default=200)
@@ -428,6 +375,7 @@ if __name__ == "__main__":
     parser.add_argument("--nbiter", type=int, help="number of learning cycles", default=1000000)
     parser.add_argument("--save_every", type=int, help="number of cycles between successive save points", default=50)
     parser.add_argument("--pe", type=int, help="number of cycles between successive printing of information", default=10)
+    parser.add_argument("--lowrank", type=int, help="store Hebbian traces as up to this many outer-product factors while they remain low-rank (0: always dense)", default=0)
     args = parser.parse_args(); argvars = vars(args); argdict =  { k : argvars[k] for k in argvars if argvars[k] != None }
     
     train(argdict)
@@ -0,0 +1,139 @@
+# Backpropamine: differentiable neuromdulated plasticity.
+#
+# Copyright (c) 2018-2019 Uber Technologies, Inc.
+#
+# Licensed under the Uber Non-Commercial License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at the root directory of this project.
+#
+# See the License file in this repository for the specific language governing
+# permissions and limitations under the License.
+
+
+# Vectorised batch of Grid Maze environments.
+#
+# All the agents of a batch are simulated at once with NumPy array operations,
+# instead of per-agent Python loops over dicts of positions. The task is
+# the same as in the original training loops: each agent starts at the center
+# of the maze, and a reward location (not on a wall, and not at the center) is
+# chosen at random for each agent at the start of each episode. Hitting a wall
+# costs 'wp' and leaves the agent in place; reaching the reward location gives
+# 'rew' and teleports the agent to a random free location (other than the
+# reward location).
+#
+# Note: the random draws for reward locations and teleports are made for all
+# agents at once, so for a given seed the sequence of episodes differs from
+# the one produced by the original per-agent loops (the distributions and
+# rewards are the same).
+
+import numpy as np
+
+
+# Moves for actions 0 to 3: Up, Down, Left, Right (row, column)
+MOVES = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]])
+
+
+def gridmaze(labsize):
+    # Builds the Grid Maze of size labsize (must be odd): walls all around, and
+    # a pillar at every (even, even) position, except at the center
+    lab = np.ones((labsize, labsize))
+    lab[1:labsize-1, 1:labsize-1].fill(0)
+    for row in range(1, labsize - 1):
+        for col in range(1, labsize - 1):
+            if row % 2 == 0 and col % 2 == 0:
+                lab[row, col] = 1
+    # Not strictly necessary, but cleaner since we start the agent at the
+    # center for each episode; may help loclization in some maze sizes
+    # (including 13 and 9, but not 11) by introducing a detectable irregularity
+    # in the center:
+    lab[labsize // 2, labsize // 2] = 0
+    return lab
+
+
+def observationtable(lab, rfsize=3):
+    # Precomputes, for every cell of the maze (indexed by row * labsize + col):
+    # - obs: the flattened rfsize x rfsize patch of the maze around the cell (labsize^2 x rfsize^2, float32),
+    # - validmoves: whether each of the MOVES from this cell leads to a free cell (labsize^2 x len(MOVES), bool).
+    # Positions outside the maze count as walls (this only matters for the
+    # border cells, which are walls and are never occupied by an agent).
+    # Since the maze is fixed for a whole run, the observation of any agent
+    # is then a single lookup: obs[posr * labsize + posc].
+    labsize = lab.shape[0]
+    pad = max(rfsize // 2, 1)
+    padded = np.ones((labsize + 2 * pad, labsize + 2 * pad), dtype='float32')
+    padded[pad:pad+labsize, pad:pad+labsize] = lab
+    rfrange = np.arange(rfsize) - rfsize // 2
+    obs = np.stack([padded[pad+dr:pad+dr+labsize, pad+dc:pad+dc+labsize].flatten() for dr in rfrange for dc in rfrange], axis=1)
+    validmoves = np.stack([padded[pad+dr:pad+dr+labsize, pad+dc:pad+dc+labsize].flatten() == 0 for dr, dc in MOVES], axis=1)
+    return obs, validmoves
+
+
+class MazeEnv:
+
+    def __init__(self, lab, bs, eplen, rew, wp, rfsize=3, addinput=4, nbactions=4):
+        # lab: the maze (1 = wall), which must be surrounded by walls
+        # bs: number of agents in the batch; eplen: length of episodes (used for the 'time' input)
+        # rew, wp: reward for hitting the reward location, penalty for hitting a wall
+        # The observation of each agent is made of the rfsize x rfsize patch of the maze around it (see observationtable()),
+        # 'addinput' additional inputs (unused, bias, time, previous reward) and the one-hot previous action.
+        self.lab = lab
+        self.labsize = lab.shape[0]
+        self.bs, self.eplen, self.rew, self.wp = bs, eplen, rew, wp
+        self.rfsize, self.addinput, self.nbactions = rfsize, addinput, nbactions
+        self.nbinputs = rfsize * rfsize + addinput + nbactions
+        self.ctr = self.labsize // 2
+        self.obs, self.validmoves = observationtable(lab, rfsize)
+
+    def randomcells(self, n, excluder, excludec):
+        # Draws n random free cells, each different from the corresponding (excluder, excludec)
+        r = np.zeros(n, dtype='int64'); c = np.zeros(n, dtype='int64')
+        todo = np.arange(n)
+        while todo.size > 0:
+            r[todo] = np.random.randint(1, self.labsize - 1, size=todo.size)
+            c[todo] = np.random.randint(1, self.labsize - 1, size=todo.size)
+            todo = todo[(self.lab[r[todo], c[todo]] == 1) | ((r[todo] == excluder[todo]) & (c[todo] == excludec[todo]))]
+        return r, c
+
+    def observe(self):
+        # Returns the inputs for the current step, as a bs x nbinputs float32 array
+        inputs = np.zeros((self.bs, self.nbinputs), dtype='float32')
+        inputs[:, :self.rfsize * self.rfsize] = self.obs[self.posr * self.labsize + self.posc]
+        inputs[:, self.rfsize * self.rfsize + 1] = 1.0  # Bias neuron
+        inputs[:, self.rfsize * self.rfsize + 2] = self.numstep / self.eplen
+        inputs[:, self.rfsize * self.rfsize + 3] = self.reward
+        inputs[np.arange(self.bs), self.rfsize * self.rfsize + self.addinput + self.actions] = 1  # Previously chosen action
+        return inputs
+
+    def reset(self):
+        # Starts a new episode for all agents; returns the inputs for the first step
+        # The reward location is not on a wall, and not on the center either (though it doesn't really matter)
+        center = np.full(self.bs, self.ctr)
+        self.rposr, self.rposc = self.randomcells(self.bs, center, center)
+        # Agents always start an episode from the center
+        self.posr, self.posc = center.copy(), center.copy()
+        self.reward = np.zeros(self.bs, dtype='float32')
+        self.actions = np.zeros(self.bs, dtype='int64')
+        self.numstep = 0
+        return self.observe()
+
+    def step(self, actions):
+        # Applies the chosen actions (integer array of size bs); returns the rewards for this step and the inputs for the next step
+        actions = np.asarray(actions, dtype='int64')
+        if np.any((actions < 0) | (actions >= self.nbactions)):
+            raise ValueError("Wrong Action")
+        wall = ~self.validmoves[self.posr * self.labsize + self.posc, actions]
+        reward = np.where(wall, -self.wp, 0.0).astype('float32')
+        self.posr = np.where(wall, self.posr, self.posr + MOVES[actions, 0])
+        self.posc = np.where(wall, self.posc, self.posc + MOVES[actions, 1])
+
+        # Did we hit the reward location ? Increase reward and teleport!
+        # Note that it doesn't matter if we teleport onto the reward, since reward hitting is only evaluated after the (obligatory) move...
+        # But we still avoid it.
+        hit = np.nonzero((self.posr == self.rposr) & (self.posc == self.rposc))[0]
+        if hit.size > 0:
+            reward[hit] += self.rew
+            self.posr[hit], self.posc[hit] = self.randomcells(hit.size, self.rposr[hit], self.rposc[hit])
+
+        self.reward, self.actions = reward, actions
+        self.numstep += 1
+        return reward, self.observe()
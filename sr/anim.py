@@ -18,6 +18,7 @@ from OpusHdfsCopy import transferFileToHdfsDir, checkHdfs
 import platform
 
 import modul
+import evalruntime  # Inference-only runtime (no gradients, in-place trace updates)
 from modul import Network
 
 import numpy as np
@@ -66,9 +67,11 @@ def train(paramdict):
     np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
     #print(click.get_current_context().params)
     
-    net = Network(params)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    net = Network(params).to(device)
     # YOU MAY NEED TO CHANGE THE DIRECTORY HERE:
-    net.load_state_dict(torch.load('./tmp/torchmodel_'+suffix + '.dat'))
+    evalruntime.load(net, './tmp/torchmodel_'+suffix + '.dat', device)
+    torch.set_grad_enabled(False)  # We only run the network
 
 
     print ("Shape of all optimized parameters:", [x.size() for x in net.parameters()])
@@ -162,10 +165,10 @@ def train(paramdict):
             inputs[0, RFSIZE * RFSIZE +2] = numstep / params['eplen']
             inputs[0, RFSIZE * RFSIZE +3] = 1.0 * reward # Reward from previous time step
             inputs[0, RFSIZE * RFSIZE + ADDINPUT + numactionchosen] = 1
-            inputsC = torch.from_numpy(inputs).cuda()
+            inputsC = torch.from_numpy(inputs).to(device)
 
             ## Running the network
-            y, v, hidden, hebb, et, pw = net(Variable(inputsC, requires_grad=False), hidden, hebb, et, pw)  # y  should output raw scores, not probas
+            y, v, hidden, hebb, et, pw = net(inputsC, hidden, hebb, et, pw)  # y  should output raw scores, not probas
 
 
             y = F.softmax(y, dim=1)
@@ -5,6 +5,9 @@ from torch.autograd import Variable
 import numpy as np
 import torch.nn.functional as F
 
+import hebbtrace  # Fused Hebbian trace updates
+import statepool  # Preallocated state for rollouts without gradients
+
 
 
 
@@ -16,8 +19,43 @@ import torch.nn.functional as F
 
 
 
+def _newpool(net, traces):
+    # A StatePool (see statepool.py) for net, with the BS x HS x HS traces named in 'traces'
+    if net.params.get('lowrank', 0) > 0:
+        raise ValueError("State pools don't support low-rank Hebbian traces")
+    BATCHSIZE, HS = net.params['bs'], net.params['hs']
+    shapes = {'hidden': (BATCHSIZE, HS)}
+    for name in traces:
+        shapes[name] = (BATCHSIZE, HS, HS)
+    return statepool.StatePool(shapes, {'weff': (BATCHSIZE, HS, HS), 'recurrent': (BATCHSIZE, HS)}, device=net.device, dtype=net.dtype)
+
+
+def _recurrent(net, hidden, plastic):
+    # (w + alpha * plastic) hidden, batched (BS x HS x 1), where the rows of w and plastic are the input weights to a single neuron.
+    # In place mode (evaluation, see evalruntime.py), the effective weights are written into a scratch buffer reused at each step.
+    BATCHSIZE, HS = net.params['bs'], net.params['hs']
+    if not net.inplace:
+        return torch.matmul((net.w + torch.mul(net.alpha, plastic)), hidden.view(BATCHSIZE, HS, 1))
+    if net.weff is None or net.weff.shape != plastic.shape or net.weff.device != plastic.device:
+        net.weff = torch.empty_like(plastic)
+    return torch.bmm(torch.addcmul(net.w, net.alpha, plastic, out=net.weff), hidden.view(BATCHSIZE, HS, 1))
+
+
+def _poolactiv(net, inputs, pool, plastic):
+    # New hidden activations of net (written into the next state of pool), with the current state of pool and
+    # the plastic weights 'plastic': the shared first half of all the forward_pool() methods below
+    if torch.is_grad_enabled():
+        raise RuntimeError("forward_pool() is only for rollouts without gradients (use torch.no_grad())")
+    BATCHSIZE, HS = net.params['bs'], net.params['hs']
+    hidden, recurrent = pool['hidden'], pool.scratch['recurrent']
+    # The rows of w and plastic are the input weights to a single neuron
+    weff = torch.addcmul(net.w, net.alpha, plastic, out=pool.scratch['weff'])
+    torch.bmm(weff, hidden.view(BATCHSIZE, HS, 1), out=recurrent.view(BATCHSIZE, HS, 1))
+    return torch.addmm(net.i2h.bias, inputs, net.i2h.weight.t(), out=pool.nextstate()['hidden']).add_(recurrent).tanh_()
+
+
 class NonPlasticRNN(nn.Module):
-    def __init__(self, params):
+    def __init__(self, params, device=None, dtype=torch.float32):
         super(NonPlasticRNN, self).__init__()
         # NOTE: 'outputsize' excludes the value and neuromodulator outputs!
         for paramname in ['outputsize', 'inputsize', 'hs', 'bs', 'fm']:
@@ -27,11 +65,12 @@ class NonPlasticRNN(nn.Module):
         # Doesn't work with our version of PyTorch:
         #self.device = torch.device("cuda:0" if self.params['device'] == 'gpu' else "cpu")
         self.params = params
+        self.device, self.dtype = device, dtype
         self.activ = F.tanh
-        self.i2h = torch.nn.Linear(self.params['inputsize'], params['hs']).cuda()
-        self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).cuda(), requires_grad=True) 
-        self.h2o = torch.nn.Linear(params['hs'], self.params['outputsize']).cuda()
-        self.h2v = torch.nn.Linear(params['hs'], 1).cuda()
+        self.i2h = torch.nn.Linear(self.params['inputsize'], params['hs']).to(device=device, dtype=dtype)
+        self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).to(device=device, dtype=dtype), requires_grad=True) 
+        self.h2o = torch.nn.Linear(params['hs'], self.params['outputsize']).to(device=device, dtype=dtype)
+        self.h2v = torch.nn.Linear(params['hs'], 1).to(device=device, dtype=dtype)
 
 
     def forward(self, inputs, hidden): #, hebb):
@@ -54,14 +93,14 @@ class NonPlasticRNN(nn.Module):
 
     def initialZeroState(self):
         BATCHSIZE = self.params['bs']
-        return Variable(torch.zeros(BATCHSIZE, self.params['hs']), requires_grad=False ).cuda()
+        return Variable(torch.zeros(BATCHSIZE, self.params['hs']), requires_grad=False ).to(device=self.device, dtype=self.dtype)
 
 
 
 
 
 class PlasticRNN(nn.Module):
-    def __init__(self, params):
+    def __init__(self, params, device=None, dtype=torch.float32):
         super(PlasticRNN, self).__init__()
         # NOTE: 'outputsize' excludes the value and neuromodulator outputs!
         for paramname in ['outputsize', 'inputsize', 'hs', 'bs', 'fm']:
@@ -71,14 +110,17 @@ class PlasticRNN(nn.Module):
         # Doesn't work with our version of PyTorch:
         #self.device = torch.device("cuda:0" if self.params['device'] == 'gpu' else "cpu")
         self.params = params
+        self.device, self.dtype = device, dtype
         self.activ = F.tanh
-        self.i2h = torch.nn.Linear(self.params['inputsize'], params['hs']).cuda()
-        self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).cuda(), requires_grad=True) 
-        self.alpha =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).cuda(), requires_grad=True)
-        self.eta = torch.nn.Parameter((.1 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta
-        #self.h2DA = torch.nn.Linear(params['hs'], NBDA).cuda()
-        self.h2o = torch.nn.Linear(params['hs'], self.params['outputsize']).cuda()
-        self.h2v = torch.nn.Linear(params['hs'], 1).cuda()
+        self.i2h = torch.nn.Linear(self.params['inputsize'], params['hs']).to(device=device, dtype=dtype)
+        self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).to(device=device, dtype=dtype), requires_grad=True) 
+        self.alpha =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).to(device=device, dtype=dtype), requires_grad=True)
+        self.eta = torch.nn.Parameter((.1 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta
+        #self.h2DA = torch.nn.Linear(params['hs'], NBDA).to(device=device, dtype=dtype)
+        self.h2o = torch.nn.Linear(params['hs'], self.params['outputsize']).to(device=device, dtype=dtype)
+        self.h2v = torch.nn.Linear(params['hs'], 1).to(device=device, dtype=dtype)
+        self.inplace = False  # If True (evaluation only, see evalruntime.py), the traces are updated in place
+        self.weff = None  # Scratch buffer for the effective weights, in place mode only (see _recurrent)
 
     def forward(self, inputs, hidden, hebb):
         BATCHSIZE = self.params['bs']
@@ -86,34 +128,54 @@ class PlasticRNN(nn.Module):
 
         # Here, the *rows* of w and hebb are the inputs weights to a single neuron
         # hidden = x, hactiv = y
-        hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + torch.matmul((self.w + torch.mul(self.alpha, hebb)),
-                        hidden.view(BATCHSIZE, HS, 1))).view(BATCHSIZE, HS)
+        if isinstance(hebb, hebbtrace.LowRankHebb):
+            # Low-rank trace: the plastic part of the recurrent input is computed from the factors of hebb
+            hactiv = self.activ(self.i2h(inputs) + torch.matmul(hidden.view(BATCHSIZE, HS), self.w.t()) + hebb.mv(self.alpha, hidden.view(BATCHSIZE, HS)))
+        else:
+            hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + _recurrent(self, hidden, hebb)).view(BATCHSIZE, HS)
         activout = self.h2o(hactiv)  # Pure linear, raw scores - will be softmaxed by the calling program
         valueout = self.h2v(hactiv)
 
         # Now computing the Hebbian updates...
         
-        # deltahebb has shape BS x HS x HS
+        # deltahebb (the batched outer product of hactiv and hidden) has shape BS x HS x HS
         # Each row of hebb contain the input weights to a neuron
-        deltahebb =  torch.bmm(hactiv.view(BATCHSIZE, HS, 1), hidden.view(BATCHSIZE, 1, HS)) # batched outer product...should it be other way round?
-        hebb = torch.clamp(hebb + self.eta * deltahebb, min=-1.0, max=1.0)
+        # hebb = torch.clamp(hebb + self.eta * deltahebb, min=-1.0, max=1.0)
+        hebb = hebbtrace.hebbupdate(hebb, hactiv.view(BATCHSIZE, HS), hidden.view(BATCHSIZE, HS), self.eta, 'clip', clipval=1.0, out=hebb if self.inplace else None)
 
         hidden = hactiv
 
         return activout, valueout, hidden, hebb
 
+    def initialStatePool(self):
+        return _newpool(self, ['hebb'])
+
+    def forward_pool(self, inputs, pool):
+        # Same as forward(), for rollouts without gradients: the state is read from pool (see statepool.py), and
+        # the new state is written into its other set of buffers. Returns the action scores and the value.
+        hidden, hebb = pool['hidden'], pool['hebb']
+        hactiv = _poolactiv(self, inputs, pool, hebb)
+        activout = self.h2o(hactiv)
+        valueout = self.h2v(hactiv)
+        hebbtrace.hebbupdate(hebb, hactiv, hidden, self.eta, 'clip', clipval=1.0, out=pool.nextstate()['hebb'])
+        pool.swap()
+        return activout, valueout
+
     def initialZeroHebb(self):
-        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).cuda()
+        # With params['lowrank'] > 0, the Hebbian trace is stored as a list of (at most 'lowrank') outer-product factors for as long as possible (see hebbtrace.py)
+        if self.params.get('lowrank', 0) > 0:
+            return hebbtrace.LowRankHebb.zeros(self.params['bs'], self.params['hs'], self.params['hs'], self.params['lowrank'], 'clip', 1.0, device=self.device, dtype=self.dtype)
+        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
 
     def initialZeroState(self):
         BATCHSIZE = self.params['bs']
-        return Variable(torch.zeros(BATCHSIZE, self.params['hs']), requires_grad=False ).cuda()
+        return Variable(torch.zeros(BATCHSIZE, self.params['hs']), requires_grad=False ).to(device=self.device, dtype=self.dtype)
 
 
 
 
 class SimpleModulRNN(nn.Module):
-    def __init__(self, params):
+    def __init__(self, params, device=None, dtype=torch.float32):
         super(SimpleModulRNN, self).__init__()
         # NOTE: 'outputsize' excludes the value and neuromodulator outputs!
         for paramname in ['outputsize', 'inputsize', 'hs', 'bs', 'fm']:
@@ -123,14 +185,17 @@ class SimpleModulRNN(nn.Module):
         # Doesn't work with our version of PyTorch:
         #self.device = torch.device("cuda:0" if self.params['device'] == 'gpu' else "cpu")
         self.params = params
+        self.device, self.dtype = device, dtype
         self.activ = F.tanh
-        self.i2h = torch.nn.Linear(self.params['inputsize'], params['hs']).cuda()
-        self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).cuda(), requires_grad=True) 
-        self.alpha =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).cuda(), requires_grad=True)
-        self.eta = torch.nn.Parameter((.1 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta (only for the non-modulated part, if any!)
-        self.h2DA = torch.nn.Linear(params['hs'], NBDA).cuda()
-        self.h2o = torch.nn.Linear(params['hs'], self.params['outputsize']).cuda()
-        self.h2v = torch.nn.Linear(params['hs'], 1).cuda()
+        self.i2h = torch.nn.Linear(self.params['inputsize'], params['hs']).to(device=device, dtype=dtype)
+        self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).to(device=device, dtype=dtype), requires_grad=True) 
+        self.alpha =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).to(device=device, dtype=dtype), requires_grad=True)
+        self.eta = torch.nn.Parameter((.1 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta (only for the non-modulated part, if any!)
+        self.h2DA = torch.nn.Linear(params['hs'], NBDA).to(device=device, dtype=dtype)
+        self.h2o = torch.nn.Linear(params['hs'], self.params['outputsize']).to(device=device, dtype=dtype)
+        self.h2v = torch.nn.Linear(params['hs'], 1).to(device=device, dtype=dtype)
+        self.inplace = False  # If True (evaluation only, see evalruntime.py), the traces are updated in place
+        self.weff = None  # Scratch buffer for the effective weights, in place mode only (see _recurrent)
 
     def forward_test(self, inputs, hidden, hebb):
         NBDA = 1
@@ -149,8 +214,11 @@ class SimpleModulRNN(nn.Module):
 
         # Here, the *rows* of w and hebb are the inputs weights to a single neuron
         # hidden = x, hactiv = y
-        hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + torch.matmul((self.w + torch.mul(self.alpha, hebb)),
-                        hidden.view(BATCHSIZE, HS, 1))).view(BATCHSIZE, HS)
+        if isinstance(hebb, hebbtrace.LowRankHebb):
+            # Low-rank trace: the plastic part of the recurrent input is computed from the factors of hebb
+            hactiv = self.activ(self.i2h(inputs) + torch.matmul(hidden.view(BATCHSIZE, HS), self.w.t()) + hebb.mv(self.alpha, hidden.view(BATCHSIZE, HS)))
+        else:
+            hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + _recurrent(self, hidden, hebb)).view(BATCHSIZE, HS)
         activout = self.h2o(hactiv)  # Pure linear, raw scores - will be softmaxed by the calling program
         valueout = self.h2v(hactiv)
 
@@ -166,15 +234,11 @@ class SimpleModulRNN(nn.Module):
         else:
             raise ValueError("Which transformation for DAout ?")
         
-        # deltahebb has shape BS x HS x HS
+        # deltahebb (the batched outer product of hactiv and hidden) has shape BS x HS x HS
         # Each row of hebb contain the input weights to a neuron
-        deltahebb =  torch.bmm(hactiv.view(BATCHSIZE, HS, 1), hidden.view(BATCHSIZE, 1, HS)) # batched outer product...should it be other way round?
-
 
-        hebb1 = torch.clamp(hebb + DAout.view(BATCHSIZE, 1, 1) * deltahebb, min=-1.0, max=1.0)
-        if self.params['fm'] == 0:
-            # Non-modulated part
-            hebb2 = torch.clamp(hebb + self.eta * deltahebb, min=-1.0, max=1.0)
+        # Modulated part: hebb1 = torch.clamp(hebb + DAout.view(BATCHSIZE, 1, 1) * deltahebb, min=-1.0, max=1.0)
+        # Non-modulated part: hebb2 = torch.clamp(hebb + self.eta * deltahebb, min=-1.0, max=1.0)
         # Soft Clamp (note that it's different from just putting a tanh on top of a freely varying value):
         #hebb1 = torch.clamp( hebb +  torch.clamp(DAout.view(BATCHSIZE, 1, 1) * deltahebb, min=0.0) * (1 - hebb) +  
         #        torch.clamp(DAout.view(BATCHSIZE, 1, 1)  * deltahebb, max=0.0) * (hebb + 1) , min=-1.0, max=1.0)
@@ -184,30 +248,62 @@ class SimpleModulRNN(nn.Module):
         #hebb2 = hebb + self.eta * deltahebb
 
         if self.params['fm'] == 1:
-            hebb = hebb1
+            eta = DAout.view(BATCHSIZE, 1, 1)
         elif self.params['fm'] == 0:
-            # Combine the modulated and non-modulated part
-            hebb = torch.cat( (hebb1[:, :self.params['hs']//2, :], hebb2[:,  self.params['hs'] // 2:, :]), dim=1) # Maybe along dim=2 instead?...
+            # Combine the modulated and non-modulated part: the first half of the rows of hebb uses DAout, the second half uses eta
+            eta = torch.cat( (DAout.view(BATCHSIZE, 1, 1).expand(BATCHSIZE, HS // 2, 1), self.eta.view(1, 1, 1).expand(BATCHSIZE, HS - HS // 2, 1)), dim=1) # Maybe along dim=2 instead?...
         else:
             raise ValueError("Must select whether fully modulated or not (params['fm'])")
+        hebb = hebbtrace.hebbupdate(hebb, hactiv, hidden.view(BATCHSIZE, HS), eta, 'clip', clipval=1.0, out=hebb if self.inplace else None)
 
         hidden = hactiv
 
         return activout, valueout, DAout, hidden, hebb
 
+    def initialStatePool(self):
+        return _newpool(self, ['hebb'])
+
+    def forward_pool(self, inputs, pool):
+        # Same as forward(), for rollouts without gradients (see PlasticRNN.forward_pool). Returns the action scores, the value and the modulator output.
+        BATCHSIZE, HS = self.params['bs'], self.params['hs']
+        hidden, hebb = pool['hidden'], pool['hebb']
+        hactiv = _poolactiv(self, inputs, pool, hebb)
+        activout = self.h2o(hactiv)
+        valueout = self.h2v(hactiv)
+        if self.params['da'] == 'tanh':
+            DAout = F.tanh(self.h2DA(hactiv))
+        elif self.params['da'] == 'sig':
+            DAout = F.sigmoid(self.h2DA(hactiv))
+        elif self.params['da'] == 'lin':
+            DAout =  self.h2DA(hactiv)
+        else:
+            raise ValueError("Which transformation for DAout ?")
+        if self.params['fm'] == 1:
+            eta = DAout.view(BATCHSIZE, 1, 1)
+        elif self.params['fm'] == 0:
+            eta = torch.cat( (DAout.view(BATCHSIZE, 1, 1).expand(BATCHSIZE, HS // 2, 1), self.eta.view(1, 1, 1).expand(BATCHSIZE, HS - HS // 2, 1)), dim=1)
+        else:
+            raise ValueError("Must select whether fully modulated or not (params['fm'])")
+        hebbtrace.hebbupdate(hebb, hactiv, hidden, eta, 'clip', clipval=1.0, out=pool.nextstate()['hebb'])
+        pool.swap()
+        return activout, valueout, DAout
+
     def initialZeroHebb(self):
-        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).cuda()
+        # With params['lowrank'] > 0, the Hebbian trace is stored as a list of (at most 'lowrank') outer-product factors for as long as possible (see hebbtrace.py)
+        if self.params.get('lowrank', 0) > 0:
+            return hebbtrace.LowRankHebb.zeros(self.params['bs'], self.params['hs'], self.params['hs'], self.params['lowrank'], 'clip', 1.0, device=self.device, dtype=self.dtype)
+        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
 
     def initialZeroState(self):
         BATCHSIZE = self.params['bs']
-        return Variable(torch.zeros(BATCHSIZE, self.params['hs']), requires_grad=False ).cuda()
+        return Variable(torch.zeros(BATCHSIZE, self.params['hs']), requires_grad=False ).to(device=self.device, dtype=self.dtype)
 
 
 
 
 
 class RetroModulRNN(nn.Module):
-    def __init__(self, params):
+    def __init__(self, params, device=None, dtype=torch.float32):
         super(RetroModulRNN, self).__init__()
         # NOTE: 'outputsize' excludes the value and neuromodulator outputs!
         for paramname in ['outputsize', 'inputsize', 'hs', 'bs', 'fm']:
@@ -217,23 +313,25 @@ class RetroModulRNN(nn.Module):
         # Doesn't work with our version of PyTorch:
         #self.device = torch.device("cuda:0" if self.params['device'] == 'gpu' else "cpu")
         self.params = params
+        self.device, self.dtype = device, dtype
         self.activ = F.tanh
-        self.i2h = torch.nn.Linear(self.params['inputsize'], params['hs']).cuda()
-        self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).cuda(), requires_grad=True) 
-        self.alpha =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).cuda(), requires_grad=True)
-        self.eta = torch.nn.Parameter((.1 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same eta (only for the non-modulated part, if any!)
-        self.etaet = torch.nn.Parameter((.1 * torch.ones(1)).cuda(), requires_grad=True)  # Everyone has the same etaet
-        self.h2DA = torch.nn.Linear(params['hs'], NBDA).cuda()
-        self.h2o = torch.nn.Linear(params['hs'], self.params['outputsize']).cuda()
-        self.h2v = torch.nn.Linear(params['hs'], 1).cuda()
+        self.i2h = torch.nn.Linear(self.params['inputsize'], params['hs']).to(device=device, dtype=dtype)
+        self.w =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).to(device=device, dtype=dtype), requires_grad=True) 
+        self.alpha =  torch.nn.Parameter((.01 * torch.t(torch.rand(params['hs'], params['hs']))).to(device=device, dtype=dtype), requires_grad=True)
+        self.eta = torch.nn.Parameter((.1 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same eta (only for the non-modulated part, if any!)
+        self.etaet = torch.nn.Parameter((.1 * torch.ones(1)).to(device=device, dtype=dtype), requires_grad=True)  # Everyone has the same etaet
+        self.h2DA = torch.nn.Linear(params['hs'], NBDA).to(device=device, dtype=dtype)
+        self.h2o = torch.nn.Linear(params['hs'], self.params['outputsize']).to(device=device, dtype=dtype)
+        self.h2v = torch.nn.Linear(params['hs'], 1).to(device=device, dtype=dtype)
+        self.inplace = False  # If True (evaluation only, see evalruntime.py), the traces are updated in place
+        self.weff = None  # Scratch buffer for the effective weights, in place mode only (see _recurrent)
 
     def forward(self, inputs, hidden, hebb, et, pw):
             NBDA = 1
             BATCHSIZE = self.params['bs']
             HS = self.params['hs']
     
-            hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + torch.matmul((self.w + torch.mul(self.alpha, pw)),
-                            hidden.view(BATCHSIZE, HS, 1))).view(BATCHSIZE, HS)
+            hactiv = self.activ(self.i2h(inputs).view(BATCHSIZE, HS, 1) + _recurrent(self, hidden, pw)).view(BATCHSIZE, HS)
             activout = self.h2o(hactiv)  # Pure linear, raw scores - will be softmaxed later
             valueout = self.h2v(hactiv)
 
@@ -250,43 +348,106 @@ class RetroModulRNN(nn.Module):
                 raise ValueError("Which transformation for DAout ?")
             
             if self.params['rule'] == 'hebb':
-                deltahebb =  torch.bmm(hactiv.view(BATCHSIZE, HS, 1), hidden.view(BATCHSIZE, 1, HS)) # batched outer product...should it be other way round?
+                # deltahebb is the batched outer product of hactiv and hidden; it is never explicitly computed (see hebbtrace.py)
+                deltahebb = None
             elif self.params['rule'] == 'oja':
                 deltahebb =  torch.mul(hactiv.view(BATCHSIZE, HS, 1), (hidden.view(BATCHSIZE, 1, HS) - torch.mul(self.w.view(1, HS, HS), hactiv.view(BATCHSIZE, HS, 1))))
             else:
                 raise ValueError("Must specify learning rule ('hebb' or 'oja')")
 
-            # Hard clamp
-            deltapw = DAout.view(BATCHSIZE,1,1) * et
-            pw1 = torch.clamp(pw + deltapw, min=-1.0, max=1.0)
+            # Hard clamp: pw1 = torch.clamp(pw + DAout.view(BATCHSIZE,1,1) * et, min=-1.0, max=1.0)
+            pw1 = hebbtrace.clipadd(pw, DAout.view(BATCHSIZE,1,1), et, 1.0, out=pw if self.inplace else None)
             
             # Should we have a fully neuromodulated network, or only half?
             if self.params['fm'] == 1:
                 pw = pw1
             elif self.params['fm']==0:
-                hebb = torch.clamp(hebb + self.eta * deltahebb, min=-1.0, max=1.0)
-                pw = torch.cat( (hebb[:, :self.params['hs']//2, :], pw1[:,  self.params['hs'] // 2:, :]), dim=1) # Maybe along dim=2 instead?...
+                if deltahebb is None:
+                    hebb = hebbtrace.hebbupdate(hebb, hactiv, hidden.view(BATCHSIZE, HS), self.eta, 'clip', clipval=1.0, out=hebb if self.inplace else None)
+                elif self.inplace:
+                    hebb = hebb.add_(self.eta * deltahebb).clamp_(min=-1.0, max=1.0)
+                else:
+                    hebb = torch.clamp(hebb + self.eta * deltahebb, min=-1.0, max=1.0)
+                if self.inplace:
+                    pw = pw1
+                    pw[:, :self.params['hs']//2, :].copy_(hebb[:, :self.params['hs']//2, :])
+                else:
+                    pw = torch.cat( (hebb[:, :self.params['hs']//2, :], pw1[:,  self.params['hs'] // 2:, :]), dim=1) # Maybe along dim=2 instead?...
             else:
                 raise ValueError("Must select whether fully modulated or not")
 
             # Updating the eligibility trace - always a simple decay term. 
             # Note that self.etaet != self.eta (which is used for hebb, i.e. the non-modulated part)
             deltaet = deltahebb
-            et = (1 - self.etaet) * et + self.etaet *  deltaet
+            if deltaet is None:
+                et = hebbtrace.hebbupdate(et, hactiv, hidden.view(BATCHSIZE, HS), self.etaet, 'decay', out=et if self.inplace else None)
+            elif self.inplace:
+                et = et.mul_(1 - self.etaet).add_(self.etaet * deltaet)
+            else:
+                et = (1 - self.etaet) * et + self.etaet *  deltaet
             
             hidden = hactiv
             return activout, valueout, DAout, hidden, hebb, et, pw
+
+    def initialStatePool(self):
+        # The non-modulated Hebbian trace is only used with fm = 0
+        return _newpool(self, ['et', 'pw'] if self.params['fm'] == 1 else ['hebb', 'et', 'pw'])
+
+    def forward_pool(self, inputs, pool):
+        # Same as forward(), for rollouts without gradients (see PlasticRNN.forward_pool). Returns the action scores, the value and the modulator output.
+        BATCHSIZE, HS = self.params['bs'], self.params['hs']
+        old, new = pool.state(), pool.nextstate()
+        hidden, et, pw = old['hidden'], old['et'], old['pw']
+        hactiv = _poolactiv(self, inputs, pool, pw)
+        activout = self.h2o(hactiv)
+        valueout = self.h2v(hactiv)
+        if self.params['da'] == 'tanh':
+            DAout = F.tanh(self.h2DA(hactiv))
+        elif self.params['da'] == 'sig':
+            DAout = F.sigmoid(self.h2DA(hactiv))
+        elif self.params['da'] == 'lin':
+            DAout =  self.h2DA(hactiv)
+        else:
+            raise ValueError("Which transformation for DAout ?")
+
+        if self.params['rule'] == 'hebb':
+            deltahebb = None
+        elif self.params['rule'] == 'oja':
+            # Written into the scratch buffer of the effective weights, which are no longer needed
+            deltahebb = torch.mul(self.w, hactiv.view(BATCHSIZE, HS, 1), out=pool.scratch['weff'])
+            deltahebb.neg_().add_(hidden.view(BATCHSIZE, 1, HS)).mul_(hactiv.view(BATCHSIZE, HS, 1))
+        else:
+            raise ValueError("Must specify learning rule ('hebb' or 'oja')")
+
+        hebbtrace.clipadd(pw, DAout.view(BATCHSIZE,1,1), et, 1.0, out=new['pw'])
+        if self.params['fm'] == 0:
+            if deltahebb is None:
+                hebbtrace.hebbupdate(old['hebb'], hactiv, hidden, self.eta, 'clip', clipval=1.0, out=new['hebb'])
+            else:
+                torch.addcmul(old['hebb'], self.eta, deltahebb, out=new['hebb']).clamp_(min=-1.0, max=1.0)
+            new['pw'][:, :HS//2, :].copy_(new['hebb'][:, :HS//2, :])
+        elif self.params['fm'] != 1:
+            raise ValueError("Must select whether fully modulated or not")
+
+        if deltahebb is None:
+            hebbtrace.hebbupdate(et, hactiv, hidden, self.etaet, 'decay', out=new['et'])
+        else:
+            torch.mul(et, 1 - self.etaet, out=new['et']).addcmul_(self.etaet, deltahebb)
+        pool.swap()
+        return activout, valueout, DAout
         
         
         
 
     def initialZeroHebb(self):
-        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).cuda()
+        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
     
     def initialZeroPlasticWeights(self):
-        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).cuda()
+        return Variable(torch.zeros(self.params['bs'], self.params['hs'], self.params['hs']) , requires_grad=False).to(device=self.device, dtype=self.dtype)
     def initialZeroState(self):
-        return Variable(torch.zeros(self.params['bs'], self.params['hs']), requires_grad=False ).cuda()
+        return Variable(torch.zeros(self.params['bs'], self.params['hs']), requires_grad=False ).to(device=self.device, dtype=self.dtype)
+
+
 
 
 
@@ -302,3 +463,32 @@ class RetroModulRNN(nn.Module):
 
 
 
+if __name__ == '__main__':
+    # Checks that forward_pool() computes the same steps as forward(), for all the plastic networks (python3 modul.py)
+    torch.manual_seed(0)
+    base = {'outputsize': 4, 'inputsize': 6, 'hs': 8, 'bs': 3, 'fm': 1, 'da': 'tanh', 'rule': 'hebb'}
+    configs = [(PlasticRNN, {}), (SimpleModulRNN, {'fm': 1}), (SimpleModulRNN, {'fm': 0}),
+               (RetroModulRNN, {'fm': 1}), (RetroModulRNN, {'fm': 0}), (RetroModulRNN, {'fm': 0, 'rule': 'oja'})]
+    with torch.no_grad():
+        for netclass, changes in configs:
+            params = dict(base, **changes)
+            net = netclass(params)
+            net.alpha.uniform_(-1.0, 1.0)  # Large plastic weights, so that the traces matter
+            names = ['hebb', 'et', 'pw'] if netclass is RetroModulRNN else ['hebb']
+            pool = net.initialStatePool()
+            for numepisode in range(2):
+                pool.reset()
+                hidden = net.initialZeroState()
+                traces = [net.initialZeroHebb() for name in names]
+                for numstep in range(6):
+                    inputs = torch.randn(params['bs'], params['inputsize'])
+                    outputs = net(inputs, hidden, *traces)
+                    pooloutputs = net.forward_pool(inputs, pool)
+                    hidden, traces = outputs[len(pooloutputs)], list(outputs[len(pooloutputs) + 1:])
+                    for x, y in zip(outputs, pooloutputs):
+                        assert torch.allclose(x, y, atol=1e-6), (netclass.__name__, changes, numstep)
+                    assert torch.allclose(hidden, pool['hidden'], atol=1e-6)
+                    for name, trace in zip(names, traces):
+                        if name in pool.state():
+                            assert torch.allclose(trace, pool[name], atol=1e-6), (netclass.__name__, changes, name, numstep)
+            print(netclass.__name__, changes, "OK")
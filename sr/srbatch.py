@@ -29,6 +29,10 @@ import numpy as np
 import glob
 
 import modul  # The code for the actual backrpopamine network
+import bpttckpt  # Checkpointed BPTT (optional, see --ckpt)
+import plasticcell  # TorchScript version of the networks (optional, see --jit)
+import discount  # Discounted returns and advantages
+import srtask  # Vectorised generation of the cues and trial schedules
 
 
 
@@ -40,6 +44,32 @@ np.set_printoptions(precision=4)
 ADDINPUT = 4 # 1 inputs for the previous reward, 1 inputs for numstep, 1 unused,  1 "Bias" inputs
 
 
+def runnetwork(net, params, inputs, state, cell=None):
+    # Runs the network for one step. 'state' is the tuple of recurrent states
+    # used by this type of network: (hidden,) for 'rnn', (hidden, hebb) for
+    # 'plastic' and 'modplast', (hidden, hebb, et, pw) for 'modul'.
+    # If 'cell' (a scripted plasticcell.PlasticCell sharing the parameters of
+    # net) is given, it is used instead of net.
+    # Returns the raw action scores, the value prediction and the new state.
+    if cell is not None:
+        y, v, DAout, state = cell(inputs, list(state))
+        return y, v, tuple(state)
+    if params['type'] == 'modplast':
+        y, v, DAout, hidden, hebb = net(inputs, *state)
+        return y, v, (hidden, hebb)
+    elif params['type'] == 'modul':
+        y, v, DAout, hidden, hebb, et, pw  = net(inputs, *state)
+        return y, v, (hidden, hebb, et, pw)
+    elif params['type'] == 'plastic':
+        y, v, hidden, hebb = net(inputs, *state)
+        return y, v, (hidden, hebb)
+    elif params['type'] == 'rnn':
+        y, v, hidden = net(inputs, *state)
+        return y, v, (hidden,)
+    else:
+        raise ValueError("Network type unknown or not yet implemented!")
+
+
 def train(paramdict):
     #params = dict(click.get_current_context().params)
 
@@ -51,7 +81,10 @@ def train(paramdict):
     print("Passed params: ", params)
     print(platform.uname())
     #params['nbsteps'] = params['nbshots'] * ((params['prestime'] + params['interpresdelay']) * params['nbclasses']) + params['prestimetest']  # Total number of steps per episode
-    suffix = "SRB_"+"".join([str(x)+"_" if pair[0] != 'pe' and pair[0] != 'nbsteps' and pair[0] != 'rngseed' and pair[0] != 'save_every' and pair[0] != 'test_every' else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1] + "_rngseed_" + str(params['rngseed'])   # Turning the parameters into a nice suffix for filenames
+    suffix = "SRB_"+"".join([str(x)+"_" if pair[0] != 'pe' and pair[0] != 'nbsteps' and pair[0] != 'rngseed' and pair[0] != 'save_every' and pair[0] != 'test_every' and pair[0] != 'ckpt' and pair[0] != 'ckptmem' and pair[0] != 'lowrank' and pair[0] != 'jit' and pair[0] != 'lam' else '' for pair in sorted(zip(params.keys(), params.values()), key=lambda x:x[0] ) for x in pair])[:-1]   # Turning the parameters into a nice suffix for filenames
+    if params['lam'] != 1.0:
+        suffix += "_lam_" + str(params['lam'])   # GAE runs get their own files; lambda = 1.0 keeps the old suffix
+    suffix += "_rngseed_" + str(params['rngseed'])
     print(suffix)
 
     #NBINPUTBITS = params['ni'] + 1 
@@ -64,23 +97,46 @@ def train(paramdict):
     #device = torch.device("cuda:0" if self.params['device'] == 'gpu' else "cpu")
     BS = params['bs']
 
+    # Checkpointed BPTT: only store the recurrent state every SEGLEN steps, and recompute the segments during the backward pass.
+    # The segment length is chosen from the memory budget, counting the BS x HS x HS tensors in each saved state (3 for 'modul',
+    # 1 for the other plastic networks), and about twice as many for the graph of each time step.
+    CKPT = params.get('ckpt', 0)
+    if CKPT and params.get('lowrank', 0) > 0:
+        raise ValueError("Checkpointed BPTT does not support low-rank Hebbian traces")
+    JIT = params.get('jit', 0)
+    if JIT and params.get('lowrank', 0) > 0:
+        raise ValueError("The TorchScript cell does not support low-rank Hebbian traces")
+    if CKPT:
+        HSQ = 4 * BS * params['hs'] * params['hs']
+        NBTRACES = 3 if params['type'] == 'modul' else 1
+        SEGLEN = bpttckpt.chooseseglen(params['eplen'], NBTRACES * HSQ, 2 * NBTRACES * HSQ, params['ckptmem'] * 2**30)
+        print("Checkpointed BPTT, with segments of", SEGLEN, "steps")
+
     # Initialize random seeds (first two redundant?)
     print("Setting random seeds")
     np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
     #print(click.get_current_context().params)
 
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
     print("Initializing network")
     if params['type'] == 'modul':
-        net = modul.RetroModulRNN(params)
+        net = modul.RetroModulRNN(params, device=device)
     elif params['type'] == 'modplast':
-        net = modul.SimpleModulRNN(params)
+        net = modul.SimpleModulRNN(params, device=device)
     elif params['type'] == 'plastic':
-        net = modul.PlasticRNN(params)
+        net = modul.PlasticRNN(params, device=device)
     elif params['type'] == 'rnn':
-        net = modul.NonPlasticRNN(params)
+        net = modul.NonPlasticRNN(params, device=device)
     else:
         raise ValueError("Network type unknown or not yet implemented: "+params['type'])
 
+    # Optionally, run the network through a TorchScript cell that shares its parameters (see plasticcell.py)
+    # The networks of modul.py always hard-clamp their plastic weights, hence addpw=3.
+    cell = None
+    if JIT:
+        cell = torch.jit.script(plasticcell.PlasticCell(net, params['type'], params['da'], 3, params['fm'], params['rule']))
+
     print ("Shape of all optimized parameters:", [x.size() for x in net.parameters()])
     allsizes = [torch.numel(x.data.cpu()) for x in net.parameters()]
     print ("Size (numel) of all optimized elements:", allsizes)
@@ -183,121 +239,55 @@ def train(paramdict):
         if params['type'] == 'modul':
             et = net.initialZeroHebb() # Eligibility Trace is identical to Hebbian Trace in shape
             pw = net.initialZeroPlasticWeights()
+        if params['type'] == 'modul':
+            state = (hidden, hebb, et, pw)
+        elif params['type'] == 'rnn':
+            state = (hidden,)
+        else:
+            state = (hidden, hebb)
         numactionchosen = 0
 
 
-        # Generate the cues. Make sure they're all different (important when using very small cues for debugging, e.g. cs=2, ni=2)
-        cuedata=[]
-        for nb in range(BS):
-            cuedata.append([])
-            for ncue in range(params['ni']):
-                assert len(cuedata[nb]) == ncue
-                foundsame = 1
-                cpt = 0
-                while foundsame > 0 :
-                    cpt += 1
-                    if cpt > 10000:
-                        # This should only occur with very weird parameters, e.g. cs=2, ni>4
-                        raise ValueError("Could not generate a full list of different cues")
-                    foundsame = 0
-                    candidate = np.random.randint(2, size=params['cs']) * 2 - 1
-                    for backtrace in range(ncue):
-                        if np.array_equal(cuedata[nb][backtrace], candidate):
-                            foundsame = 1
-
-                cuedata[nb].append(candidate)
-
-
-        reward = np.zeros(BS)
+        # Generate the cues and the trial schedule of the whole episode, for all batch elements at once (see srtask.py).
+        # Cues are all different within each episode (important when using very small cues for debugging, e.g. cs=2, ni=2)
+        cuedata, correctcue, cues, gosteps, hascc, trialends = srtask.generateepisodes(BS, params['eplen'], params['ni'], params['cs'])
+        stimuli = srtask.stimuli(cuedata, cues, NBINPUTBITS, params['inputsize'])
+        flips = np.random.rand(params['eplen'], BS) < params['pf']
+        nbtrials = trialends.sum(axis=0)
+        totalnbtrials += int(trialends.sum())
+        nbtrialswithcc += int((trialends & hascc).sum())
+
+
+        reward = np.zeros(BS, dtype='float32')
         sumreward = np.zeros(BS)
         rewards = []
         vs = []
         logprobs = []
-        cues=[]
-        for nb in range(BS):
-            cues.append([])
         dist = 0
         numactionschosen = np.zeros(BS, dtype='int32')
 
-        #reward = 0.0
-        #rewards = []
-        #vs = []
-        #logprobs = []
-        #sumreward = 0.0
-        nbtrials = np.zeros(BS)
-        nbrewardabletrials = np.zeros(BS)
-        thistrialhascorrectcue = np.zeros(BS)
-        triallength = np.zeros(BS, dtype='int32')
-        correctcue = np.random.randint(params['ni'], size=BS)
-
-        trialstep = np.zeros(BS, dtype='int32')  
+        # In checkpointed mode, the episode itself runs without gradients; we
+        # store what we need to re-run it segment by segment afterwards.
+        ckptstates = []; ckptinputs = []; ckptactions = []
+        torch.set_grad_enabled(not CKPT)
 
         #print("EPISODE ", numepisode)
         for numstep in range(params['eplen']):
 
-            #if params['clamp'] == 0:
-            inputs = np.zeros((BS, params['inputsize']), dtype='float32') 
-            #else:
-            #    inputs = np.zeros((1, params['hs']), dtype='float32')
+            # Cues, "go" cue, bias and time are precomputed; only the previous reward and action depend on the agent
+            inputs = stimuli[numstep].copy()
+            inputs[:, NBINPUTBITS + 2] = reward # Reward from previous time step
+            if numstep > 0:
+                inputs[np.arange(BS), NBINPUTBITS + ADDINPUT + numactionschosen] = 1  # Previously chosen action
 
-            for nb in range(BS):
-            
-                if trialstep[nb] == 0:
-                    thistrialhascorrectcue[nb] = 0
-                    # Trial length is randomly modulated for each trial; first time step always -1 (i.e. no input cue), last time step always response-cue (i.e. NBINPUTBITS-1).
-                    #triallength = params['ni'] // 2  + 3 + np.random.randint(1 + params['ni'])  # 3 fixed-cue time steps (1st, last and next-to-last) + some random nb of no-cue time steps
-                    triallength[nb] = params['ni'] // 2  + 3 + np.random.randint(params['ni'])  # 3 fixed-cue time steps (1st, last and next-to-last) + some random nb of no-cue time steps
-                    
-                    
-                    
-                    # In any trial, we only show half the cues (randomly chosen), once each:
-                    mycues = [x for x in range(params['ni'])]
-                    random.shuffle(mycues); mycues = mycues[:len(mycues) // 2]
-                    # The rest is filled with no-input time steps (i.e. cue = -1), but also with the 3 fixed-cue steps (1st, last, next-to-last) 
-                    for nc in range(triallength[nb] - 3  - len(mycues)):
-                        mycues.append(-1)
-                    random.shuffle(mycues)
-                    mycues.insert(0, -1); mycues.append(params['ni']); mycues.append(-1)  # The first and last time step have no input (cue -1), the next-to-last has the response cue.
-                    assert(len(mycues) == triallength[nb])
-                    cues[nb] = mycues
-
-            
-                inputs[nb, :NBINPUTBITS] = 0
-                if cues[nb][trialstep[nb]] > -1 and cues[nb][trialstep[nb]] < params['ni']:
-                    #inputs[0, cues[trialstep]] = 1.0
-                    inputs[nb, :NBINPUTBITS-1] = cuedata[nb][cues[nb][trialstep[nb]]][:]
-                    if cues[nb][trialstep[nb]] == correctcue[nb]:
-                        thistrialhascorrectcue[nb] = 1
-                if cues[nb][trialstep[nb]] == params['ni']:
-                    inputs[nb, NBINPUTBITS-1] = 1  # "Go" cue
-                    
-
-                inputs[nb, NBINPUTBITS + 0] = 1.0 # Bias neuron, probably not necessary
-                inputs[nb,NBINPUTBITS +  1] = numstep / params['eplen']
-                inputs[nb, NBINPUTBITS + 2] = 1.0 * reward[nb] # Reward from previous time step
-                if numstep > 0:
-                    inputs[nb, NBINPUTBITS + ADDINPUT + numactionschosen[nb]] = 1  # Previously chosen action
-
-            inputsC = torch.from_numpy(inputs).cuda()
-            # Might be better:
-            #if rposr == posr and rposc = posc:
-            #    inputs[0][-4] = 100.0
-            #else:
-            #    inputs[0][-4] = 0
-            
-            # Running the network
+            inputsC = torch.from_numpy(inputs).to(device)
+            if CKPT:
+                if numstep % SEGLEN == 0:
+                    ckptstates.append(state)
+                ckptinputs.append(inputsC)
 
             ## Running the network
-            if params['type'] == 'modplast':
-                y, v, DAout, hidden, hebb = net(Variable(inputsC, requires_grad=False), hidden, hebb)  # y  should output raw scores, not probas
-            elif params['type'] == 'modul':
-                y, v, DAout, hidden, hebb, et, pw  = net(Variable(inputsC, requires_grad=False), hidden, hebb, et, pw)  # y  should output raw scores, not probas
-            elif params['type'] == 'plastic':
-                y, v, hidden, hebb = net(Variable(inputsC, requires_grad=False), hidden, hebb)  # y  should output raw scores, not probas
-            elif params['type'] == 'rnn':
-                y, v, hidden = net(Variable(inputsC, requires_grad=False), hidden)  # y  should output raw scores, not probas
-            else:
-                raise ValueError("Network type unknown or not yet implemented!")
+            y, v, state = runnetwork(net, params, Variable(inputsC, requires_grad=False), state, cell)  # y  should output raw scores, not probas
 
 
 
@@ -306,64 +296,22 @@ def train(paramdict):
             distrib = torch.distributions.Categorical(y)
             actionschosen = distrib.sample()  
             logprobs.append(distrib.log_prob(actionschosen))
+            if CKPT:
+                ckptactions.append(actionschosen)
             numactionschosen = actionschosen.data.cpu().numpy()    # Turn to scalar
 
             if PRINTTRACE:
                 print("Step ", numstep, " Inputs (1st in batch): ", inputs[0,:params['inputsize']], " - Outputs(0): ", y.data.cpu().numpy()[0,:], " - action chosen(0): ", numactionschosen[0],
-                        "TrialLen(0):", triallength[0], "trialstep(0):", trialstep[0], "TTHCC(0): ", thistrialhascorrectcue[0], " -Reward (previous step): ", reward[0], ", cues(0):", cues[0], ", cc(0):", correctcue[0])
-
-                #print("Step ", numstep, " Inputs: ", inputs[0,:params['inputsize']], " - Outputs: ", y.data.cpu().numpy(), " - action chosen: ", numactionchosen,
-                #        " - mean abs pw: ", np.mean(np.abs(pw.data.cpu().numpy())), "TrialLen:", triallength, "trialstep:", trialstep, "TTHCC: ", thistrialhascorrectcue, " -Reward (previous step): ", reward, ", cues:", cues, ", cc:", correctcue)
-
-            reward = np.zeros(BS, dtype='float32')
-
-            for nb in range(BS):
-                if numactionschosen[nb] == 1:
-                    # Small penalty for any non-rest action taken
-                    reward[nb]  -= params['wp']
-            
-            
-            ### DEBUGGING
-            ## Easiest possible episode-dependent response (i.e. the easiest
-            ## possible problem that actually require meta-learning, with ni=2)
-            ## This one works pretty wel... But harder ones don't work well!
-            #if numactionchosen == correctcue :
-            #        reward = params['rew']
-            #else:
-            #        reward = -params['rew']
-
-
-                trialstep[nb] += 1
-                if trialstep[nb] == triallength[nb] - 1:
-                    # This was the next-to-last step of the trial (and we showed the response signal, unless it was the first few steps in episode). 
-                    assert(cues[nb][trialstep[nb] - 1] == params['ni'] or numstep < 2)
-                    # We must deliver reward (which will be perceived by the agent at the next step), positive or negative, depending on response
-                    if thistrialhascorrectcue[nb] and numactionschosen[nb] == 1:
-                        reward[nb] += params['rew']
-                    elif (not thistrialhascorrectcue[nb]) and numactionschosen[nb] == 0:
-                        reward[nb] += params['rew']
-                    else:
-                        reward[nb] -= params['rew']
-
-                    if np.random.rand() < params['pf']:
-                        reward[nb] = -reward[nb]
-                
-                if trialstep[nb] == triallength[nb]:
-                    # This was the last step of the trial (and we showed no input)
-                    assert(cues[nb][trialstep[nb] - 1] == -1 or numstep < 2)
-                    nbtrials[nb] += 1
-                    totalnbtrials += 1
-                    if thistrialhascorrectcue[nb]:
-                        nbtrialswithcc += 1
-                        #nbrewardabletrials += 1 
-                    # Trial is dead, long live trial
-                    trialstep[nb] = 0
-
-                    # We initialize the hidden state between trials!
-                    #if params['is'] == 1:
-                    #    hidden = net.initialZeroState()
+                        "Cue(0):", cues[numstep, 0], "Go(0):", gosteps[numstep, 0], "TTHCC(0): ", hascc[numstep, 0], " -Reward (previous step): ", reward[0], ", cc(0):", correctcue[0])
 
+            # Small penalty for any non-rest action taken
+            reward = np.where(numactionschosen == 1, -params['wp'], 0.0).astype('float32')
 
+            # On the "go" step of each trial, we must deliver reward (which will be perceived by the agent at the next step),
+            # positive or negative, depending on whether the response matches the presence of the target cue in the trial
+            correct = np.where(hascc[numstep], numactionschosen == 1, numactionschosen == 0)
+            reward += np.where(gosteps[numstep], np.where(correct, params['rew'], -params['rew']), 0.0).astype('float32')
+            reward = np.where(gosteps[numstep] & flips[numstep], -reward, reward)
 
             rewards.append(reward)
             vs.append(v)
@@ -380,14 +328,15 @@ def train(paramdict):
             ##if PRINTTRACE:
             ##    print("Probabilities:", y.data.cpu().numpy(), "Picked action:", numactionchosen, ", got reward", reward)
         
-        R = Variable(torch.zeros(BS).cuda(), requires_grad=False)
+        # (In checkpointed mode, this computes the value of the loss, but not its gradient)
+        # Returns and advantages for the whole episode at once (see discount.py), with a single host-to-device copy of the rewards
         gammaR = params['gr']
-        for numstepb in reversed(range(params['eplen'])) :
-            R = gammaR * R + Variable(torch.from_numpy(rewards[numstepb]).cuda(), requires_grad=False)
-            ctrR = R - vs[numstepb][0]
-            lossv += ctrR.pow(2).sum() / BS
-            loss -= (logprobs[numstepb] * ctrR.detach()).sum() / BS  # Need to check if detach() is OK
-            #pdb.set_trace()
+        rewardsT = torch.from_numpy(np.stack(rewards)).to(device)
+        Rs = discount.returns(rewardsT, gammaR)
+        values = torch.stack(vs)[:, 0, :]  # The value prediction of the first element in the batch is used as baseline for all of them
+        advs = discount.advantages(rewardsT, values, gammaR, params['lam'])
+        lossv = (Rs - values).pow(2).sum() / BS
+        loss -= (torch.stack(logprobs) * advs).sum() / BS
 
 
         # Episode is done, now let's do the actual computations
@@ -457,7 +406,33 @@ def train(paramdict):
 
         #for p in net.parameters():
         #    p.grad.data.clamp_(-params['clamp'], params['clamp'])
-        loss.backward()
+        if CKPT:
+            torch.set_grad_enabled(True)
+
+            # Re-runs steps start to end-1 with gradients, and returns their contribution to the loss (computed as above)
+            def runsegment(start, end, state):
+                if JIT:
+                    # The whole segment runs in a single scripted loop, and the loss is computed for all its steps at once
+                    ys, values, DAouts, state = cell.scan(torch.stack(ckptinputs[start:end]), list(state))
+                    ys = F.softmax(ys, dim=2)
+                    logprob = torch.distributions.Categorical(ys).log_prob(torch.stack(ckptactions[start:end]))
+                    ctrR = Rs[start:end] - values[:, 0, :]
+                    segloss = (params['bent'] * ys.pow(2).sum() - (logprob * advs[start:end]).sum() + params['blossv'] * ctrR.pow(2).sum()) / BS
+                    return tuple(state), segloss / params['eplen']
+                segloss = 0
+                for numstep in range(start, end):
+                    y, v, state = runnetwork(net, params, ckptinputs[numstep], state)
+                    y = F.softmax(y, dim=1)
+                    logprob = torch.distributions.Categorical(y).log_prob(ckptactions[numstep])
+                    ctrR = Rs[numstep] - v[0]
+                    segloss += params['bent'] * y.pow(2).sum() / BS
+                    segloss -= (logprob * advs[numstep]).sum() / BS
+                    segloss += params['blossv'] * ctrR.pow(2).sum() / BS
+                return state, segloss / params['eplen']
+
+            bpttckpt.backwardsegments(runsegment, ckptstates, params['eplen'], SEGLEN)
+        else:
+            loss.backward()
         all_grad_norms.append(torch.nn.utils.clip_grad_norm(net.parameters(), params['gc']))
         if numepisode > 100:  # Burn-in period for meanreward
             optimizer.step()
@@ -485,7 +460,7 @@ def train(paramdict):
             if params['type'] == 'plastic' or params['type'] == 'lstmplastic':
                 print("ETA: ", float(net.eta), "alpha[0,1]: ", net.alpha.data.cpu().numpy()[0,1], "w[0,1]: ", net.w.data.cpu().numpy()[0,1] )
             elif params['type'] == 'modul' or params['type'] == 'modul2':
-                print("ETA: ", net.eta.data.cpu().numpy(), " etaet: ", net.etaet.data.cpu().numpy(), " mean-abs pw: ", np.mean(np.abs(pw.data.cpu().numpy())))
+                print("ETA: ", net.eta.data.cpu().numpy(), " etaet: ", net.etaet.data.cpu().numpy(), " mean-abs pw: ", np.mean(np.abs(state[3].data.cpu().numpy())))
             elif params['type'] == 'rnn':
                 print("w[0,1]: ", net.w.data.cpu().numpy()[0,1] )
 
@@ -579,6 +554,7 @@ if __name__ == "__main__":
     #parser.add_argument("--msize", type=int, help="size of the maze; must be odd", default=9)
     parser.add_argument("--da", help="transformation function of DA signal (tanh or sig or lin)", default='tanh')
     parser.add_argument("--gr", type=float, help="gammaR: discounting factor for rewards", default=.9)
+    parser.add_argument("--lam", type=float, help="lambda of generalized advantage estimation (1.0: plain discounted returns minus value, as in standard A2C)", default=1.0)
     parser.add_argument("--lr", type=float, help="learning rate (Adam optimizer)", default=1e-4)
     parser.add_argument("--fm", type=int, help="if using neuromodulation, do we modulate the whole network (1) or just half (0) ?", default=1)
     #parser.add_argument("--na", type=int, help="number of actions (excluding \"rest\" action)", default=2)
@@ -606,6 +582,10 @@ if __name__ == "__main__":
     parser.add_argument("--nbiter", type=int, help="number of learning cycles", default=1000000)
     parser.add_argument("--save_every", type=int, help="number of cycles between successive save points", default=200)
     parser.add_argument("--pe", type=int, help="'print every', number of cycles between successive printing of information", default=100)
+    parser.add_argument("--ckpt", type=int, help="checkpointed BPTT: store the recurrent state only every few steps and recompute during the backward pass (1) or not (0) ?", default=0)
+    parser.add_argument("--jit", type=int, help="run the network through a TorchScript cell, with a scripted loop over segments in checkpointed mode (1) or not (0) ?", default=0)
+    parser.add_argument("--lowrank", type=int, help="for 'plastic' and 'modplast' networks, store Hebbian traces as up to this many outer-product factors while they remain low-rank (0: always dense)", default=0)
+    parser.add_argument("--ckptmem", type=float, help="memory budget (in GB) for checkpointed BPTT, used to choose the length of the recomputed segments", default=16.0)
     #parser.add_argument("--", type=int, help="", default=1e-4)
     args = parser.parse_args(); argvars = vars(args); argdict =  { k : argvars[k] for k in argvars if argvars[k] != None }
     #train()
@@ -69,15 +69,17 @@ def train(paramdict):
     np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
     #print(click.get_current_context().params)
 
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
     print("Initializing network")
     if params['type'] == 'modul':
-        net = modul.RetroModulRNN(params)
+        net = modul.RetroModulRNN(params, device=device)
     elif params['type'] == 'modplast':
-        net = modul.SimpleModulRNN(params)
+        net = modul.SimpleModulRNN(params, device=device)
     elif params['type'] == 'plastic':
-        net = modul.PlasticRNN(params)
+        net = modul.PlasticRNN(params, device=device)
     elif params['type'] == 'rnn':
-        net = modul.NonPlasticRNN(params)
+        net = modul.NonPlasticRNN(params, device=device)
     else:
         raise ValueError("Network type unknown or not yet implemented: "+params['type'])
 
@@ -237,7 +239,7 @@ def train(paramdict):
                 if numstep > 0:
                     inputs[nb, NBINPUTBITS + ADDINPUT + numactionschosen[nb]] = 1  # Previously chosen action
 
-            inputsC = torch.from_numpy(inputs).cuda()
+            inputsC = torch.from_numpy(inputs).to(device)
             # Might be better:
             #if rposr == posr and rposc = posc:
             #    inputs[0][-4] = 100.0
@@ -339,10 +341,10 @@ def train(paramdict):
             ##if PRINTTRACE:
             ##    print("Probabilities:", y.data.cpu().numpy(), "Picked action:", numactionchosen, ", got reward", reward)
         
-        R = Variable(torch.zeros(BS).cuda(), requires_grad=False)
+        R = Variable(torch.zeros(BS, device=device), requires_grad=False)
         gammaR = params['gr']
         for numstepb in reversed(range(params['eplen'])) :
-            R = gammaR * R + Variable(torch.from_numpy(rewards[numstepb]).cuda(), requires_grad=False)
+            R = gammaR * R + Variable(torch.from_numpy(rewards[numstepb]).to(device), requires_grad=False)
             ctrR = R - vs[numstepb][0]
             lossv += ctrR.pow(2).sum() / BS
             loss -= (logprobs[numstepb] * ctrR.detach()).sum() / BS  # Need to check if detach() is OK
@@ -21,6 +21,7 @@ import numpy as np
 import glob
 
 import modul
+import evalruntime  # Inference-only runtime (no gradients, in-place trace updates)
 
 
 
@@ -75,19 +76,28 @@ def train(paramdict):
         np.random.seed(params['rngseed']); random.seed(params['rngseed']); torch.manual_seed(params['rngseed'])
         #print(click.get_current_context().params)
 
+        use_cuda = torch.cuda.is_available()
+        device = torch.device("cuda" if use_cuda else "cpu")
         print("Initializing network")
         if params['type'] == 'modul':
-            net = modul.RetroModulRNN(params)
+            net = modul.RetroModulRNN(params, device=device)
         elif params['type'] == 'modplast':
-            net = modul.SimpleModulRNN(params)
+            net = modul.SimpleModulRNN(params, device=device)
         elif params['type'] == 'plastic':
-            net = modul.PlasticRNN(params)
+            net = modul.PlasticRNN(params, device=device)
         elif params['type'] == 'rnn':
-            net = modul.NonPlasticRNN(params)
+            net = modul.NonPlasticRNN(params, device=device)
         else:
             raise ValueError("Network type unknown or not yet implemented: "+params['type'])
 
-        net.load_state_dict(torch.load('./tmp/torchmodel_'+suffix+'.dat'))
+        evalruntime.load(net, './tmp/torchmodel_'+suffix+'.dat', device)
+        torch.set_grad_enabled(False)  # We only run the network
+        # Preallocated buffer for the modulator output at each step (copied to the host once, at the end of the episode)
+        # Only the neuromodulated networks have a modulator output
+        MODULATED = params['type'] in ('modplast', 'modul')
+        recorder = evalruntime.Recorder(params['eplen'], {'DA': (BS, 1)} if MODULATED else {}, device=device)
+        # The state of plastic networks (h-state and traces) lives in a StatePool, allocated once (see statepool.py)
+        pool = net.initialStatePool() if params['type'] != 'rnn' and params.get('lowrank', 0) == 0 else None
 
         print ("Shape of all optimized parameters:", [x.size() for x in net.parameters()])
         allsizes = [torch.numel(x.data.cpu()) for x in net.parameters()]
@@ -127,12 +137,15 @@ def train(paramdict):
             #optimizer.zero_grad()
             loss = 0
             lossv = 0
-            hidden = net.initialZeroState()
-            if params['type'] != 'rnn':
-                hebb = net.initialZeroHebb()
-            if params['type'] == 'modul':
-                et = net.initialZeroHebb() # Eligibility Trace is identical to Hebbian Trace in shape
-                pw = net.initialZeroPlasticWeights()
+            if pool is not None:
+                pool.reset()
+            else:
+                hidden = net.initialZeroState()
+                if params['type'] != 'rnn':
+                    hebb = net.initialZeroHebb()
+                if params['type'] == 'modul':
+                    et = net.initialZeroHebb() # Eligibility Trace is identical to Hebbian Trace in shape
+                    pw = net.initialZeroPlasticWeights()
             numactionchosen = 0
 
 
@@ -231,7 +244,7 @@ def train(paramdict):
                     if numstep > 0:
                         inputs[nb, NBINPUTBITS + ADDINPUT + numactionschosen[nb]] = 1  # Previously chosen action
 
-                inputsC = torch.from_numpy(inputs).cuda()
+                inputsC = torch.from_numpy(inputs).to(device)
                 # Might be better:
                 #if rposr == posr and rposc = posc:
                 #    inputs[0][-4] = 100.0
@@ -241,14 +254,18 @@ def train(paramdict):
                 # Running the network
 
                 ## Running the network
-                if params['type'] == 'modplast':
-                    y, v, DAout, hidden, hebb = net(Variable(inputsC, requires_grad=False), hidden, hebb)  # y  should output raw scores, not probas
+                if pool is not None and MODULATED:
+                    y, v, DAout = net.forward_pool(inputsC, pool)
+                elif pool is not None:
+                    y, v = net.forward_pool(inputsC, pool)
+                elif params['type'] == 'modplast':
+                    y, v, DAout, hidden, hebb = net(inputsC, hidden, hebb)  # y  should output raw scores, not probas
                 elif params['type'] == 'modul':
-                    y, v, DAout, hidden, hebb, et, pw  = net(Variable(inputsC, requires_grad=False), hidden, hebb, et, pw)  # y  should output raw scores, not probas
+                    y, v, DAout, hidden, hebb, et, pw  = net(inputsC, hidden, hebb, et, pw)  # y  should output raw scores, not probas
                 elif params['type'] == 'plastic':
-                    y, v, hidden, hebb = net(Variable(inputsC, requires_grad=False), hidden, hebb)  # y  should output raw scores, not probas
+                    y, v, hidden, hebb = net(inputsC, hidden, hebb)  # y  should output raw scores, not probas
                 elif params['type'] == 'rnn':
-                    y, v, hidden = net(Variable(inputsC, requires_grad=False), hidden)  # y  should output raw scores, not probas
+                    y, v, hidden = net(inputsC, hidden)  # y  should output raw scores, not probas
                 else:
                     raise ValueError("Network type unknown or not yet implemented!")
 
@@ -271,7 +288,8 @@ def train(paramdict):
 
                 cuesshown0.append(cues[0][trialstep[0]])
                 rewardsprevstep0.append(float(reward[0]))
-                modulator0.append(float(DAout[0]))
+                if MODULATED:
+                    recorder.record(numstep, DA=DAout)
                 
                 reward = np.zeros(BS, dtype='float32')
                 
@@ -340,10 +358,13 @@ def train(paramdict):
                 ##if PRINTTRACE:
                 ##    print("Probabilities:", y.data.cpu().numpy(), "Picked action:", numactionchosen, ", got reward", reward)
             
-            R = Variable(torch.zeros(BS).cuda(), requires_grad=False)
+            if MODULATED:
+                modulator0 = list(recorder.numpy()['DA'][:, 0, 0])
+
+            R = torch.zeros(BS, device=device)
             gammaR = params['gr']
             for numstepb in reversed(range(params['eplen'])) :
-                R = gammaR * R + Variable(torch.from_numpy(rewards[numstepb]).cuda(), requires_grad=False)
+                R = gammaR * R + torch.from_numpy(rewards[numstepb]).to(device)
                 ctrR = R - vs[numstepb][0]
                 lossv += ctrR.pow(2).sum() / BS
                 loss -= (logprobs[numstepb] * ctrR.detach()).sum() / BS  # Need to check if detach() is OK
@@ -444,7 +465,7 @@ def train(paramdict):
                 if params['type'] == 'plastic' or params['type'] == 'lstmplastic':
                     print("ETA: ", float(net.eta), "alpha[0,1]: ", net.alpha.data.cpu().numpy()[0,1], "w[0,1]: ", net.w.data.cpu().numpy()[0,1] )
                 elif params['type'] == 'modul' or params['type'] == 'modul2':
-                    print("ETA: ", net.eta.data.cpu().numpy(), " etaet: ", net.etaet.data.cpu().numpy(), " mean-abs pw: ", np.mean(np.abs(pw.data.cpu().numpy())))
+                    print("ETA: ", net.eta.data.cpu().numpy(), " etaet: ", net.etaet.data.cpu().numpy(), " mean-abs pw: ", np.mean(np.abs((pool['pw'] if pool is not None else pw).data.cpu().numpy())))
                 elif params['type'] == 'rnn':
                     print("w[0,1]: ", net.w.data.cpu().numpy()[0,1] )
             
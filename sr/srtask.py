@@ -0,0 +1,105 @@
+# Backpropamine: differentiable neuromdulated plasticity.
+#
+# Copyright (c) 2018-2019 Uber Technologies, Inc.
+#
+# Licensed under the Uber Non-Commercial License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at the root directory of this project.
+#
+# See the License file in this repository for the specific language governing
+# permissions and limitations under the License.
+
+
+# Vectorised episode generator for the stimulus-response task of srbatch.py.
+#
+# Since the cues and the trial schedule of an episode don't depend on the
+# actions of the agent, they are generated for the whole batch and the whole
+# episode at once, with NumPy array operations. Each trial has a random length
+# L = ni // 2 + 3 + randint(ni): no cue at the first step, then half of the
+# cues (chosen at random, shown once each, in random order) among L - 3 steps
+# otherwise without cue, then the "go" cue, then a final step without cue.
+# The agent's response is evaluated on the "go" step.
+#
+# The distributions are the same as with the original per-element loops,
+# but for a given seed the sequence of episodes is different.
+
+import numpy as np
+
+
+def generatecues(bs, ni, cs, maxtries=10000):
+    # Returns bs x ni x cs random cues (vectors of -1/1), all different within each batch element
+    if ni > 2 ** cs:
+        raise ValueError("Could not generate a full list of different cues")
+    cuedata = np.random.randint(2, size=(bs, ni, cs)) * 2 - 1
+    for ntry in range(maxtries):
+        same = np.all(cuedata[:, :, None, :] == cuedata[:, None, :, :], axis=3)  # bs x ni x ni
+        dup = np.any(np.tril(same, k=-1), axis=2)  # Cues identical to an earlier one in the list are drawn again
+        if not dup.any():
+            return cuedata
+        cuedata[dup] = np.random.randint(2, size=(int(dup.sum()), cs)) * 2 - 1
+    # This should only occur with very weird parameters, e.g. cs=2, ni>4
+    raise ValueError("Could not generate a full list of different cues")
+
+
+def generateepisodes(bs, eplen, ni, cs):
+    # Returns, for a batch of bs episodes:
+    # - cuedata: bs x ni x cs, the cues of each episode,
+    # - correctcue: bs, the index of the target cue,
+    # - cues: eplen x bs, the cue shown at each step (-1: none, ni: "go" cue),
+    # - gosteps: eplen x bs (bool), the steps at which the response is evaluated,
+    # - hascc: eplen x bs (bool), whether the current trial contains the target cue,
+    # - trialends: eplen x bs (bool), the last step of each trial.
+    cuedata = generatecues(bs, ni, cs)
+    correctcue = np.random.randint(ni, size=bs)
+
+    minlen = ni // 2 + 3
+    maxlen = minlen + ni - 1
+    nbtrials = eplen // minlen + 1  # Enough trials to cover the episode
+    lengths = minlen + np.random.randint(ni, size=(bs, nbtrials))
+
+    # The shown cues of each trial (the first ni // 2 of a random permutation) and their positions among the L - 3 inner steps
+    shown = np.argsort(np.random.rand(bs, nbtrials, ni), axis=2)[:, :, :ni // 2]
+    nbinner = maxlen - 3
+    keys = np.random.rand(bs, nbtrials, nbinner)
+    keys[np.arange(nbinner) >= (lengths - 3)[:, :, None]] = 2.0  # Steps beyond the end of the trial come last
+    slots = np.argsort(keys, axis=2)[:, :, :ni // 2]
+
+    trials = np.full((bs, nbtrials, maxlen), -1, dtype='int64')
+    bidx, tidx = np.meshgrid(np.arange(bs), np.arange(nbtrials), indexing='ij')
+    trials[bidx[:, :, None], tidx[:, :, None], 1 + slots] = shown
+    trials[bidx, tidx, lengths - 2] = ni
+    trialhascc = np.any(shown == correctcue[:, None, None], axis=2)
+
+    # Concatenate the trials of each batch element, and keep the first eplen steps
+    pos = np.arange(maxlen)
+    valid = (pos < lengths[:, :, None]).reshape(bs, -1)
+    stepidx = np.cumsum(valid, axis=1) - 1
+    keep = valid & (stepidx < eplen)
+    rows = np.repeat(np.arange(bs), nbtrials * maxlen).reshape(bs, -1)[keep]
+    steps = stepidx[keep]
+
+    def flatten(x):
+        out = np.zeros((eplen, bs), dtype=x.dtype)
+        out[steps, rows] = np.broadcast_to(x, (bs, nbtrials, maxlen)).reshape(bs, -1)[keep]
+        return out
+
+    cues = flatten(trials)
+    gosteps = flatten(pos == lengths[:, :, None] - 2)
+    trialends = flatten(pos == lengths[:, :, None] - 1)
+    hascc = flatten(trialhascc[:, :, None])
+    return cuedata, correctcue, cues, gosteps, hascc, trialends
+
+
+def stimuli(cuedata, cues, nbinputbits, inputsize):
+    # Returns the eplen x bs x inputsize float32 array of all the inputs that don't depend on the agent:
+    # the cue bits, the "go" bit, the bias and the time. (The previous reward and action are filled in during the episode.)
+    eplen, bs = cues.shape
+    ni = cuedata.shape[1]
+    inputs = np.zeros((eplen, bs, inputsize), dtype='float32')
+    iscue = (cues > -1) & (cues < ni)
+    stepi, bi = np.nonzero(iscue)
+    inputs[stepi, bi, :nbinputbits - 1] = cuedata[bi, cues[stepi, bi]]
+    inputs[:, :, nbinputbits - 1] = (cues == ni)  # "Go" cue
+    inputs[:, :, nbinputbits + 0] = 1.0  # Bias neuron, probably not necessary
+    inputs[:, :, nbinputbits + 1] = (np.arange(eplen) / eplen)[:, None]
+    return inputs